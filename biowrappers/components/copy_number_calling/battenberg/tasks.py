@@ -17,6 +17,7 @@ import remixt.cn_model
 
 from biowrappers.components.utils import make_directory
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.io.store import open_store
 
 
 def prepare_battenberg_allele_counts(
@@ -199,7 +200,7 @@ def run_battenberg(
     cn_data['total_1'] = cn_data['major_1'] + cn_data['minor_1']
     cn_data['total_2'] = cn_data['major_2'] + cn_data['minor_2']
 
-    with pd.HDFStore(results_filename, 'w') as store:
+    with open_store(results_filename, 'w') as store:
         store['cn'] = cn_data
         store['mix'] = pd.Series([1. - tumour_content, tumour_content])
         store['brk_cn'] = pd.DataFrame(columns=['prediction_id', 'cn_1', 'cn_2'])
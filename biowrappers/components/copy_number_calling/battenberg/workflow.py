@@ -106,7 +106,7 @@ def create_battenberg_workflow(
 
     workflow.transform(
         name='merge_results',
-        ctx={'mem': 8},
+        ctx=utils.merge_ctx,
         func=hdf5_tasks.merge_hdf5,
         args=(
             pypeliner.managed.InputFile('results', 'sample_id', template=results_files),
@@ -114,6 +114,7 @@ def create_battenberg_workflow(
         ),
         kwargs={
             'table_names': '/sample_{}',
+            'num_workers': utils.merge_ctx['ncpus'],
         },
     )
 
@@ -114,7 +114,7 @@ def create_clonehd_workflow(
 
     workflow.transform(
         name='merge_results',
-        ctx={'mem': 8},
+        ctx=utils.merge_ctx,
         func=hdf5_tasks.merge_hdf5,
         args=(
             pypeliner.managed.InputFile('results', 'sample_id', template=results_files),
@@ -122,6 +122,7 @@ def create_clonehd_workflow(
         ),
         kwargs={
             'table_names': '/sample_{}',
+            'num_workers': utils.merge_ctx['ncpus'],
         },
     )
 
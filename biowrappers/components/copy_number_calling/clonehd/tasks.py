@@ -13,6 +13,7 @@ import remixt.cn_model
 
 from biowrappers.components.utils import make_directory
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.io.store import open_store
 
 
 def read_chromosome_lengths(chrom_info_filename):
@@ -359,7 +360,7 @@ def report(
     else:
         brk_cn = None
 
-    with pd.HDFStore(results_filename, 'w') as store:
+    with open_store(results_filename, 'w') as store:
         store['mix'] = pd.Series(mix)
         store['cn'] = cn_table
         if brk_cn is not None:
@@ -1,8 +1,10 @@
 import pandas as pd
 
+from biowrappers.components.io.store import open_store
+
 
 def select_solution(selected_file, results_file, config):
-    with pd.HDFStore(selected_file, 'w') as selected_store, pd.HDFStore(results_file, 'r') as results_store:
+    with open_store(selected_file, 'w') as selected_store, pd.HDFStore(results_file, 'r') as results_store:
         stats = results_store['stats']
         if (stats['proportion_divergent'] < config['max_prop_diverge']).any():
             stats = stats[stats['proportion_divergent'] < config['max_prop_diverge']].copy()
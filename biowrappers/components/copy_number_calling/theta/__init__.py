@@ -75,7 +75,7 @@ def create_theta_workflow(
 
     workflow.transform(
         name='merge_results',
-        ctx={'mem': 8},
+        ctx=utils.merge_ctx,
         func=hdf5_tasks.merge_hdf5,
         args=(
             pypeliner.managed.InputFile('results', 'sample_id', template=results_template),
@@ -83,6 +83,7 @@ def create_theta_workflow(
         ),
         kwargs={
             'table_names': '/sample_{}',
+            'num_workers': utils.merge_ctx['ncpus'],
         },
     )
 
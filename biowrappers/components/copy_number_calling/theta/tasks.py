@@ -8,6 +8,7 @@ import remixt.seqdataio
 import remixt.analysis.haplotype
 
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.io.store import open_store
 import biowrappers.components.utils as utils
 
 
@@ -118,7 +119,7 @@ def write_results(theta_prefix, output_filename, run_info, **kwargs):
     breakpoints_filename = kwargs.get('breakpoints_filename', None)
     num_clones = kwargs.get('num_clones', None)
 
-    store = pd.HDFStore(output_filename, 'w')
+    store = open_store(output_filename, 'w')
 
     solution_name = 'BEST'
     if num_clones is not None:
@@ -159,7 +160,7 @@ def write_results(theta_prefix, output_filename, run_info, **kwargs):
 
 
 def write_empty_results(output_filename, run_info):
-    store = pd.HDFStore(output_filename, 'w')
+    store = open_store(output_filename, 'w')
     store['mix'] = pd.Series()
     store['cn'] = pd.DataFrame()
     store['brk_cn'] = pd.DataFrame()
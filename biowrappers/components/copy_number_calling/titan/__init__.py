@@ -135,9 +135,11 @@ def create_titan_workflow(
         ),
     )
 
+    merge_ctx = dict(utils.merge_ctx, num_retry=3, mem_retry_increment=2)
+
     workflow.transform(
         name='merge_results',
-        ctx={'mem': 8, 'num_retry': 3, 'mem_retry_increment': 2},
+        ctx=merge_ctx,
         func=hdf5_tasks.merge_hdf5,
         args=(
             pypeliner.managed.InputFile('results', 'sample_id', template=results_files),
@@ -145,6 +147,7 @@ def create_titan_workflow(
         ),
         kwargs={
             'table_names': '/sample_{}',
+            'num_workers': merge_ctx['ncpus'],
         },
     )
 
@@ -8,6 +8,7 @@ import remixt.analysis.haplotype
 import shutil
 
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.io.store import open_store
 from biowrappers.components.copy_number_calling.common.utils import calculate_allele_counts
 
 
@@ -294,7 +295,7 @@ def select_solution(
 
         cn_data['prevalence'] = cn_data['prevalence'].fillna(0).astype(float)
 
-    with pd.HDFStore(results_filename, 'w') as store:
+    with open_store(results_filename, 'w') as store:
         store['mix'] = pd.Series(mix)
         store['cn'] = cn_data
 
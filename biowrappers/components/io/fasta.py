@@ -0,0 +1,107 @@
+'''
+Vectorised access to windows of reference sequence.
+'''
+import numpy as np
+import pysam
+
+
+class FastaWindowReader(object):
+    '''
+    Read the reference sequence around many positions at once.
+
+    Uncompressed FASTA files are memory mapped and the bases of every window are gathered through the faidx line layout
+    with numpy indexing, so there is no seek or read per position and concurrent jobs share the page cache. For bgzip
+    compressed FASTA files each block of at most `max_block_size` bases covering the requested positions is fetched once
+    and sliced.
+    '''
+
+    def __init__(self, fasta_file, max_block_size=int(1e7)):
+        self.max_block_size = max_block_size
+
+        # Opening with pysam builds the faidx index if it is missing
+        self._fasta = pysam.FastaFile(fasta_file)
+
+        self._index = {}
+
+        with open(fasta_file + '.fai') as fh:
+            for line in fh:
+                fields = line.rstrip('\n').split('\t')
+
+                self._index[fields[0]] = tuple(int(x) for x in fields[1:5])
+
+        with open(fasta_file, 'rb') as fh:
+            is_compressed = fh.read(2) == b'\x1f\x8b'
+
+        if is_compressed:
+            self._data = None
+
+        else:
+            self._data = np.memmap(fasta_file, dtype=np.uint8, mode='r')
+
+    def close(self):
+        self._fasta.close()
+
+        self._data = None
+
+    def get_chrom_length(self, chrom):
+        return self._index[chrom][0]
+
+    def get_contexts(self, chrom, coords, flank=1):
+        '''
+        Get the sequence of `flank` bases either side of each 1 based position in `coords`, as `pysam.FastaFile.fetch(chrom,
+        coord - 1 - flank, coord + flank)` would return it. Windows are clipped at the ends of the chromosome.
+        '''
+        coords = np.asarray(coords, dtype=np.int64)
+
+        length = self.get_chrom_length(chrom)
+
+        width = 2 * flank + 1
+
+        pos = coords[:, np.newaxis] - 1 + np.arange(-flank, flank + 1)[np.newaxis, :]
+
+        is_valid = (pos >= 0) & (pos < length)
+
+        bases = np.zeros(pos.shape, dtype=np.uint8)
+
+        bases[is_valid] = self._get_bases(chrom, pos[is_valid])
+
+        # Bytes views drop trailing nulls, windows clipped at the start of the chromosome also need leading nulls dropped
+        contexts = bases.view('S{0}'.format(width)).ravel()
+
+        contexts = [x.lstrip(b'\x00').decode('ascii') for x in contexts]
+
+        return contexts
+
+    def _get_bases(self, chrom, pos):
+        if self._data is not None:
+            length, offset, line_bases, line_width = self._index[chrom]
+
+            return self._data[offset + (pos // line_bases) * line_width + pos % line_bases]
+
+        bases = np.zeros(len(pos), dtype=np.uint8)
+
+        if len(pos) == 0:
+            return bases
+
+        order = np.argsort(pos, kind='mergesort')
+
+        sorted_pos = pos[order]
+
+        block_start = 0
+
+        while block_start < len(sorted_pos):
+            block_beg = sorted_pos[block_start]
+
+            block_stop = np.searchsorted(sorted_pos, block_beg + self.max_block_size, side='left')
+
+            block_end = sorted_pos[block_stop - 1] + 1
+
+            seq = self._fasta.fetch(chrom, int(block_beg), int(block_end))
+
+            seq = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+
+            bases[order[block_start:block_stop]] = seq[sorted_pos[block_start:block_stop] - block_beg]
+
+            block_start = block_stop
+
+        return bases
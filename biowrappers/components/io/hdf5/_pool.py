@@ -0,0 +1,80 @@
+'''
+Process pool for reading tables from many stores concurrently.
+'''
+from collections import deque
+
+import multiprocessing
+
+
+class ReaderPool(object):
+    '''
+    Run read functions in worker processes and return their results in the order they were submitted.
+
+    Each worker opens its own store, since HDF5 files cannot be shared between threads. `imap` reads at most
+    `max_pending` results ahead of the consumer, so memory stays bounded while one writer appends the results in a
+    deterministic order. With a single worker everything runs in the calling process.
+
+    The pool should be created before opening any stores in the calling process so workers do not inherit open HDF5
+    handles.
+    '''
+
+    def __init__(self, num_workers=1, max_pending=None):
+        if max_pending is None:
+            max_pending = 2 * num_workers
+
+        self.num_workers = num_workers
+
+        self.max_pending = max(1, max_pending)
+
+        if num_workers > 1:
+            self._pool = multiprocessing.Pool(num_workers)
+
+        else:
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+        else:
+            self.terminate()
+
+    def map(self, func, args_list):
+        return list(self.imap(func, args_list))
+
+    def imap(self, func, args_list):
+        if self._pool is None:
+            for args in args_list:
+                yield func(*args)
+
+            return
+
+        pending = deque()
+
+        for args in args_list:
+            pending.append(self._pool.apply_async(func, args))
+
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().get()
+
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+            self._pool.join()
+
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+
+            self._pool.join()
+
+            self._pool = None
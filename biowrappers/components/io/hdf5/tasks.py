@@ -3,38 +3,69 @@ Created on Nov 4, 2015
 
 @author: Andrew Roth
 '''
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import gzip
+import os
 import pandas as pd
 import re
+import shutil
 
+from biowrappers.components.io.hdf5._pool import ReaderPool
+from biowrappers.components.io.store import ParquetStore, get_store_backend, open_store
 from biowrappers.components.utils import flatten_input
 from pandas.api.types import CategoricalDtype
 
+_meta_data_table_regex = re.compile('.*/meta/.*/meta$')
+
+# Table catalogues of read only stores in least recently used order, see _get_table_catalogue
+_table_catalogue_cache = OrderedDict()
+
+_table_catalogue_cache_size = 1024
+
+
 def concatenate_tables(
     in_files,
     out_file,
     drop_duplicates=False,
     in_memory=True,
-    non_numeric_as_category=True
+    non_numeric_as_category=True,
+    chunk_size=int(1e5),
+    num_workers=1
 ):
+    '''
+    Concatenate tables with the same names from a list of stores.
+
+    With `in_memory` set to False tables are copied in chunks of `chunk_size` rows. Categories and string widths are
+    then taken from the stored table meta data where possible, so each input is only read once.
+
+    Inputs are read by `num_workers` processes and written in input order. Tasks using more than one worker should
+    request as many cpus in their ctx, workflows use `merge_ctx` from `biowrappers.components.utils` and pass its ncpus.
+    '''
     in_files = flatten_input(in_files)
 
+    is_parquet = [get_store_backend(x) == 'parquet' for x in in_files + [out_file]]
+
+    if all(is_parquet) and not drop_duplicates:
+        _concatenate_parquet_parts(in_files, out_file)
+
     # Only support drop duplicatess in memory
-    if drop_duplicates or in_memory:
+    elif drop_duplicates or in_memory:
         _concatenate_tables_in_memory(
             in_files,
             out_file,
             drop_duplicates=drop_duplicates,
-            non_numeric_as_category=non_numeric_as_category
+            non_numeric_as_category=non_numeric_as_category,
+            num_workers=num_workers
         )
 
     else:
         _concatenate_tables_on_disk(
             in_files,
             out_file,
-            non_numeric_as_category=non_numeric_as_category
+            non_numeric_as_category=non_numeric_as_category,
+            chunk_size=chunk_size,
+            num_workers=num_workers
         )
 
 
@@ -42,19 +73,16 @@ def _concatenate_tables_in_memory(
     in_files,
     out_file,
     drop_duplicates=False,
-    non_numeric_as_category=True
+    non_numeric_as_category=True,
+    num_workers=1
 ):
 
     tables = defaultdict(list)
 
-    for file_name in in_files:
-        in_store = pd.HDFStore(file_name, 'r')
-
-        for table_name in _iter_table_names(in_store):
-            df = in_store[table_name]
-            tables[table_name].append(df)
-
-        in_store.close()
+    with ReaderPool(num_workers) as pool:
+        for file_tables in pool.imap(_read_tables, [(x,) for x in in_files]):
+            for table_name, df in file_tables:
+                tables[table_name].append(df)
 
     for table_name in tables:
         # TODO: check columns / types are equivalent
@@ -78,7 +106,7 @@ def _concatenate_tables_in_memory(
                     tables[table_name][col] = tables[table_name][col].astype(str)
                 tables[table_name][col] = tables[table_name][col].astype('category')
 
-    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+    out_store = open_store(out_file, 'w', complevel=9, complib='blosc')
 
     for table_name in tables:
         if tables[table_name].empty:
@@ -89,118 +117,328 @@ def _concatenate_tables_in_memory(
     out_store.close()
 
 
-def _concatenate_tables_on_disk(in_files, out_file, non_numeric_as_category=True):
-    if non_numeric_as_category:
-        col_categories = _get_column_categories(in_files)
+def _concatenate_tables_on_disk(
+    in_files,
+    out_file,
+    non_numeric_as_category=True,
+    chunk_size=int(1e5),
+    num_workers=1
+):
+    with ReaderPool(num_workers) as pool:
+        if non_numeric_as_category:
+            col_categories = _get_column_categories(in_files, chunk_size=chunk_size, pool=pool)
 
-    else:
-        min_itemsize = _get_min_itemsize(in_files)
+        else:
+            min_itemsize = _get_min_itemsize(in_files, chunk_size=chunk_size, pool=pool)
 
-    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+        chunks = []
 
-    table_columns = defaultdict(set)
+        for file_name, file_chunks in zip(in_files, pool.map(_get_table_chunks, [(x, chunk_size) for x in in_files])):
+            for table_name, start, stop in file_chunks:
+                chunks.append((file_name, table_name, start, stop))
 
-    for file_name in in_files:
-        in_store = pd.HDFStore(file_name, 'r')
+        out_store = open_store(out_file, 'w', complevel=9, complib='blosc')
 
-        for table_name in _iter_table_names(in_store):
-            df = in_store[table_name]
+        table_columns = {}
 
-            table_columns[table_name].update(df.columns)
+        num_rows = defaultdict(int)
+
+        for (_, table_name, _, _), df in zip(chunks, pool.imap(_read_table_chunk, chunks)):
+            if table_name not in table_columns:
+                table_columns[table_name] = list(df.columns)
 
             if df.empty:
                 continue
 
-            non_numeric_cols = _get_non_numeric_columns(df)
-
             if non_numeric_as_category:
-                for col in non_numeric_cols:
+                for col, categories in col_categories[table_name].items():
+                    if col not in df.columns:
+                        continue
+
                     if df[col].dtype.name == 'category':
-                        df[col] = df[col].cat.set_categories(col_categories[table_name][col])
+                        df[col] = df[col].cat.set_categories(categories)
 
                     else:
-                        df[col] = df[col].astype(CategoricalDtype(categories=col_categories[table_name][col]))
+                        df[col] = df[col].astype(CategoricalDtype(categories=categories))
 
                 out_store.append(table_name, df, format='table')
 
             else:
-                for col in non_numeric_cols:
-                    df[col] = df[col].astype(str)
+                for col in min_itemsize[table_name]:
+                    if col in df.columns:
+                        df[col] = df[col].astype(str)
 
                 out_store.append(table_name, df, min_itemsize=min_itemsize[table_name], format='table')
 
-        for table_name, columns in table_columns.items():
-            out_store.append(table_name, pd.DataFrame(columns=columns), format='table')
+            num_rows[table_name] += df.shape[0]
 
-        in_store.close()
+    # Empty frames cannot be appended in table format
+    for table_name, columns in table_columns.items():
+        if num_rows[table_name] == 0:
+            out_store.put(table_name, pd.DataFrame(columns=columns))
 
     out_store.close()
 
 
-def _get_min_itemsize(file_list):
+def _concatenate_parquet_parts(in_files, out_file):
+    '''
+    Concatenate Parquet stores by linking their part files into the output store without decoding them.
+
+    Empty parts are dropped. Tables whose parts do not share a schema are read and rewritten as one part instead.
+    '''
+    import pyarrow.parquet as pq
+
+    part_files = defaultdict(list)
+
+    for file_name in in_files:
+        in_store = ParquetStore(file_name, 'r')
+
+        for table_name in in_store.keys():
+            part_files[table_name].extend(in_store.get_part_files(table_name))
+
+    out_store = ParquetStore(out_file, 'w')
+
+    for table_name, table_part_files in part_files.items():
+        non_empty_part_files = [x for x in table_part_files if pq.ParquetFile(x).metadata.num_rows > 0]
+
+        # Keep one empty part so the table and its columns are preserved
+        if len(non_empty_part_files) == 0:
+            non_empty_part_files = table_part_files[:1]
+
+        schemas = [pq.read_schema(x) for x in non_empty_part_files]
+
+        if all(x.equals(schemas[0], check_metadata=False) for x in schemas):
+            table_path = out_store.get_table_path(table_name)
+
+            os.makedirs(table_path)
+
+            for part_idx, part_file in enumerate(non_empty_part_files):
+                _link_or_copy(part_file, os.path.join(table_path, 'part-{0:05d}.parquet'.format(part_idx)))
+
+        else:
+            df = pd.concat([pq.read_table(x).to_pandas() for x in non_empty_part_files])
+
+            out_store.put(table_name, df)
+
+    out_store.close()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _get_min_itemsize(file_list, chunk_size=int(1e5), pool=None):
     '''
     Get the minimum string size for all columns in a list of tables from a list of HDFStores.
     '''
 
-    min_sizes = {}
+    if pool is None:
+        pool = ReaderPool(1)
 
-    for file_name in file_list:
-        hdf_store = pd.HDFStore(file_name, 'r')
+    min_sizes = {}
 
-        for table_name in _iter_table_names(hdf_store):
+    for file_sizes in pool.imap(_get_file_min_itemsize, [(x, chunk_size) for x in file_list]):
+        for table_name, sizes in file_sizes.items():
             if table_name not in min_sizes:
                 min_sizes[table_name] = {}
 
-            df = hdf_store[table_name]
+            for col, size in sizes.items():
+                if (col not in min_sizes[table_name]) or (size > min_sizes[table_name][col]):
+                    min_sizes[table_name][col] = size
 
-            if df.empty:
-                continue
+    return min_sizes
 
-            for col in _get_non_numeric_columns(df):
-                df[col] = df[col].astype(str)
 
-                size = max(8, df[col].str.len().max())
+def _get_file_min_itemsize(file_name, chunk_size):
+    min_sizes = {}
 
-                if (col not in min_sizes[table_name]) or (size > min_sizes[table_name][col]):
-                    min_sizes[table_name][col] = size
+    with open_store(file_name, 'r') as hdf_store:
+        for table_name in _iter_table_names(hdf_store):
+            _, sizes = _get_non_numeric_meta_data(
+                hdf_store, table_name, with_categories=False, chunk_size=chunk_size)
 
-        hdf_store.close()
+            min_sizes[table_name] = dict((col, max(8, size)) for col, size in sizes.items())
 
     return min_sizes
 
 
-def _get_column_categories(file_list):
+def _get_column_categories(file_list, chunk_size=int(1e5), pool=None):
     '''
     Find the union set of categories for each column across tables.
     '''
 
-    categories = {}
+    if pool is None:
+        pool = ReaderPool(1)
 
-    for file_name in file_list:
-        hdf_store = pd.HDFStore(file_name, 'r')
+    categories = {}
 
-        for table_name in _iter_table_names(hdf_store):
+    for file_categories in pool.imap(_get_file_column_categories, [(x, chunk_size) for x in file_list]):
+        for table_name, table_categories in file_categories.items():
             if table_name not in categories:
                 categories[table_name] = {}
 
-            df = hdf_store[table_name]
+            for col, values in table_categories.items():
+                if col not in categories[table_name]:
+                    categories[table_name][col] = set()
 
-            if df.empty:
-                continue
+                categories[table_name][col].update(values)
 
-            for col in _get_non_numeric_columns(df):
-                df[col] = df[col].astype('category')
+    # Sort so the category codes do not depend on set ordering
+    for table_name in categories:
+        for col in categories[table_name]:
+            categories[table_name][col] = _sort_categories(categories[table_name][col])
 
-                if col not in categories[table_name]:
-                    categories[table_name][col] = set()
+    return categories
+
+
+def _sort_categories(values):
+    '''
+    Sort category values, grouping them by type if values of different types, such as int and str, cannot be compared.
+    '''
 
-                categories[table_name][col].update(set(df[col].cat.categories))
+    try:
+        return sorted(values)
 
-        hdf_store.close()
+    except TypeError:
+        return sorted(values, key=lambda x: (type(x).__name__, str(x)))
+
+
+def _get_file_column_categories(file_name, chunk_size):
+    categories = {}
+
+    with open_store(file_name, 'r') as hdf_store:
+        for table_name in _iter_table_names(hdf_store):
+            categories[table_name], _ = _get_non_numeric_meta_data(
+                hdf_store, table_name, with_categories=True, chunk_size=chunk_size)
 
     return categories
 
 
+def _get_non_numeric_meta_data(store, table_name, with_categories=True, chunk_size=int(1e5)):
+    '''
+    Get the categories and maximum string size of each non-numeric column of a table.
+
+    Table format HDF5 tables hold the categories of categorical columns in meta data tables and the width of string
+    columns in the table description, so these are found without reading any rows. String columns are only scanned
+    when their categories are required, and tables in other formats are scanned in chunks.
+    '''
+
+    categories = {}
+
+    sizes = {}
+
+    scan_columns = None
+
+    if isinstance(store, pd.HDFStore) and store.get_storer(table_name).is_table:
+        scan_columns = []
+
+        for axis in store.get_storer(table_name).values_axes:
+            if getattr(axis, 'meta', None) == 'category':
+                for col in axis.values:
+                    categories[col] = set(axis.metadata)
+
+                    sizes[col] = _get_max_str_len(pd.Series(axis.metadata))
+
+            elif axis.kind == 'string':
+                for col in axis.values:
+                    sizes[col] = axis.itemsize
+
+                    if with_categories:
+                        scan_columns.append(col)
+
+        if len(scan_columns) == 0:
+            return categories, sizes
+
+    for df in _iter_table_chunks(store, table_name, chunk_size, columns=scan_columns):
+        if df.empty:
+            continue
+
+        for col in _get_non_numeric_columns(df):
+            if df[col].dtype.name == 'category':
+                values = df[col].cat.categories
+
+            else:
+                values = df[col].dropna().unique()
+
+            categories.setdefault(col, set()).update(values)
+
+            if scan_columns is None:
+                sizes[col] = max(sizes.get(col, 0), _get_max_str_len(df[col]))
+
+    return categories, sizes
+
+
+def _get_max_str_len(values):
+    if len(values) == 0:
+        return 0
+
+    return int(values.astype(str).str.len().max())
+
+
+def _iter_table_chunks(store, table_name, chunk_size, columns=None):
+    '''
+    Iterate over a table in chunks of at most `chunk_size` rows. Fixed format HDF5 tables cannot be read in parts and
+    are returned whole.
+    '''
+
+    if isinstance(store, pd.HDFStore) and not store.get_storer(table_name).is_table:
+        df = store[table_name]
+
+        if columns is not None:
+            df = df[columns]
+
+        yield df
+
+    else:
+        for df in store.select(table_name, columns=columns, chunksize=chunk_size):
+            yield df
+
+
+def _get_table_chunks(file_name, chunk_size):
+    '''
+    Split the tables of a store into (table_name, start, stop) row ranges of at most `chunk_size` rows. Tables which
+    cannot be read in parts have a single range with start and stop set to None.
+    '''
+
+    chunks = []
+
+    with open_store(file_name, 'r') as store:
+        for table_name in _iter_table_names(store):
+            if isinstance(store, pd.HDFStore) and store.get_storer(table_name).is_table:
+                num_rows = store.get_storer(table_name).nrows
+
+                # Empty tables still give one chunk so the columns are known
+                for start in range(0, max(num_rows, 1), chunk_size):
+                    chunks.append((table_name, start, min(start + chunk_size, num_rows)))
+
+            else:
+                chunks.append((table_name, None, None))
+
+    return chunks
+
+
+def _read_table_chunk(file_name, table_name, start, stop):
+    with open_store(file_name, 'r') as store:
+        if start is None:
+            return store[table_name]
+
+        else:
+            return store.select(table_name, start=start, stop=stop)
+
+
+def _read_tables(file_name):
+    '''
+    Read all non-metadata tables from a store as a list of (table_name, df) pairs.
+    '''
+
+    with open_store(file_name, 'r') as store:
+        return [(x, store[x]) for x in _iter_table_names(store)]
+
+
 def _get_non_numeric_columns(df):
     '''
     Find the set of non-numeric (int, float, complex) columns in a table.
@@ -214,28 +452,62 @@ def _iter_table_names(store):
     Returns an iterator over all non-metadata tables in Pandas HDFStore.
     '''
 
-    meta_data_tables = _get_meta_data_tables(store)
+    return iter(_get_table_catalogue(store))
 
-    for table_name in store.keys():
-        if table_name in meta_data_tables:
-            continue
 
-        yield table_name
+def _get_table_catalogue(store):
+    '''
+    Get the list of non-metadata tables in a store.
+
+    Listing the keys of an HDFStore walks every node in the file, so the catalogue of a store opened read only is cached
+    by file name, modification time and size. The multiple passes of a merge then only list each input once per process.
+    Only the `_table_catalogue_cache_size` most recently used catalogues are kept, so long lived workers do not grow.
+    '''
+
+    cache_key = _get_table_catalogue_cache_key(store)
+
+    if cache_key in _table_catalogue_cache:
+        catalogue = _table_catalogue_cache.pop(cache_key)
+
+        _table_catalogue_cache[cache_key] = catalogue
+
+        return list(catalogue)
+
+    keys = store.keys()
+
+    meta_data_tables = _get_meta_data_tables(store, keys=keys)
+
+    catalogue = [x for x in keys if x not in meta_data_tables]
+
+    if cache_key is not None:
+        _table_catalogue_cache[cache_key] = tuple(catalogue)
 
+        while len(_table_catalogue_cache) > _table_catalogue_cache_size:
+            _table_catalogue_cache.popitem(last=False)
 
-def _get_meta_data_tables(store):
+    return catalogue
+
+
+def _get_table_catalogue_cache_key(store):
+    if (not isinstance(store, pd.HDFStore)) or (getattr(store, '_mode', None) != 'r'):
+        return None
+
+    file_name = os.path.abspath(store.filename)
+
+    stat = os.stat(file_name)
+
+    return (file_name, stat.st_mtime, stat.st_size)
+
+
+def _get_meta_data_tables(store, keys=None):
     '''
     Find all tables in and HDFStore which are pandas meta-data tables.
     '''
 
-    meta_tables = set()
+    if keys is None:
+        keys = store.keys()
 
-    for table_name in store.keys():
-        for meta_table_name in store.keys():
-            if (re.search('.*/meta/.*/meta$', meta_table_name) is not None) and meta_table_name.startswith(table_name):
-                meta_tables.add(meta_table_name)
-
-    return meta_tables
+    return set(x for x in keys if _meta_data_table_regex.search(x) is not None)
 
 
 def convert_hdf5_to_tsv(in_file, key, out_file, compress=False, index=False):
@@ -243,7 +515,8 @@ def convert_hdf5_to_tsv(in_file, key, out_file, compress=False, index=False):
     Convert and pandas HDF5 table to tsv format.
     '''
 
-    df = pd.read_hdf(in_file, key)
+    with open_store(in_file, 'r') as store:
+        df = store[key]
 
     if compress:
         f_open = gzip.open
@@ -255,26 +528,30 @@ def convert_hdf5_to_tsv(in_file, key, out_file, compress=False, index=False):
         df.to_csv(fh, index=index, sep='\t')
 
 
-def merge_hdf5(in_files, out_file, table_names='{}'):
+def merge_hdf5(in_files, out_file, table_names='{}', num_workers=1):
     '''
     Merge pandas HDF5 tables
+
+    Inputs are read by `num_workers` processes. Tasks using more than one worker should request as many cpus in their
+    ctx, workflows use `merge_ctx` from `biowrappers.components.utils` and pass its ncpus.
     '''
 
-    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+    in_files = list(in_files.items())
 
-    for file_key, file_name in in_files.items():
-        in_store = pd.HDFStore(file_name, 'r')
+    with ReaderPool(num_workers) as pool:
+        out_store = open_store(out_file, 'w', complevel=9, complib='blosc')
 
-        # Compatability with dictionary keyed by single or multiple values
-        if not isinstance(file_key, tuple):
-            file_key = (file_key,)
+        for (file_key, _), file_tables in zip(in_files, pool.imap(_read_tables, [(x,) for _, x in in_files])):
+            # Compatability with dictionary keyed by single or multiple values
+            if not isinstance(file_key, tuple):
+                file_key = (file_key,)
 
-        for table_name in _iter_table_names(in_store):
-            df = in_store[table_name]
+            for table_name, df in file_tables:
+                # Workaround: currently cannot store empty dataframe in table format
+                format = 'table'
+                if len(df.index) == 0:
+                    format = None
 
-            # Workaround: currently cannot store empty dataframe in table format
-            format = 'table'
-            if len(df.index) == 0:
-                format = None
+                out_store.put(table_names.format(*file_key) + '/' + table_name, df, format=format)
 
-            out_store.put(table_names.format(*file_key) + '/' + table_name, df, format=format)
+        out_store.close()
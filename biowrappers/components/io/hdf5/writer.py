@@ -0,0 +1,122 @@
+'''
+Streaming writer for pandas HDF5 tables.
+'''
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from biowrappers.components.io.store import open_store
+from pandas.api.types import CategoricalDtype
+
+
+class HDFTableWriter(object):
+    '''
+    Write DataFrames to tables in an HDFStore, appending them in table format once `chunk_size` rows are buffered.
+
+    Columns listed in `categories` are stored as categoricals with a fixed set of categories, so every chunk appended
+    to a table is compatible and strings are stored once in the category meta data. Writing a value which is not one of
+    the categories of its column raises a ValueError. Rows are numbered continuously within each table.
+
+    Tables which only ever received empty DataFrames are written in fixed format, since empty frames cannot be
+    appended in table format. File names ending in `.parquet` are written with the Parquet backend of `open_store`.
+    '''
+
+    def __init__(
+            self,
+            file_name,
+            categories=None,
+            chunk_size=int(1e5),
+            complevel=9,
+            complib='blosc'):
+
+        if categories is None:
+            categories = {}
+
+        self.categories = dict((col, CategoricalDtype(categories=x)) for col, x in categories.items())
+
+        self.chunk_size = chunk_size
+
+        self._store = open_store(file_name, 'w', complevel=complevel, complib=complib)
+
+        self._buffers = defaultdict(list)
+
+        self._buffer_sizes = defaultdict(int)
+
+        self._num_rows = defaultdict(int)
+
+        self._num_written = defaultdict(int)
+
+        self._empty_tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, table_name, df):
+        if df.empty:
+            if self._num_rows[table_name] == 0:
+                self._empty_tables[table_name] = df
+
+            return
+
+        self._empty_tables.pop(table_name, None)
+
+        self._buffers[table_name].append(df)
+
+        self._buffer_sizes[table_name] += df.shape[0]
+
+        self._num_rows[table_name] += df.shape[0]
+
+        if self._buffer_sizes[table_name] >= self.chunk_size:
+            self._flush(table_name)
+
+    def close(self):
+        try:
+            for table_name in list(self._buffers.keys()):
+                self._flush(table_name)
+
+            for table_name, df in self._empty_tables.items():
+                self._store.put(table_name, df)
+
+        finally:
+            self._store.close()
+
+    def _flush(self, table_name):
+        dfs = self._buffers.pop(table_name, [])
+
+        num_rows = self._buffer_sizes.pop(table_name, 0)
+
+        if num_rows == 0:
+            return
+
+        df = pd.concat(dfs)
+
+        beg = self._num_written[table_name]
+
+        df.index = np.arange(beg, beg + num_rows)
+
+        self._num_written[table_name] += num_rows
+
+        for col in df.columns:
+            if col in self.categories:
+                df[col] = _to_categorical(df[col], self.categories[col], table_name)
+
+        self._store.append(table_name, df, format='table')
+
+
+def _to_categorical(values, dtype, table_name):
+    '''
+    Convert a column to a categorical, raising a ValueError rather than setting values outside the categories to NaN.
+    '''
+    result = values.astype(dtype)
+
+    invalid = result.isnull() & values.notnull()
+
+    if invalid.any():
+        raise ValueError('Values {0} of column {1} in table {2} are not in the categories {3}'.format(
+            list(pd.unique(values[invalid]))[:10], values.name, table_name, list(dtype.categories)))
+
+    return result
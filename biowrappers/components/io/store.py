@@ -0,0 +1,263 @@
+'''
+Pluggable table stores for pipeline results.
+
+`open_store` returns either a pandas HDFStore or a ParquetStore depending on the file name, so tasks which only use the
+common put/append/select/keys interface can write either format. Parquet requires pyarrow, which is only imported when
+a Parquet store is opened.
+'''
+import glob
+import os
+import shutil
+
+import pandas as pd
+
+hdf5_only_kwargs = ('complevel', 'complib', 'fletcher32')
+
+parquet_extension = '.parquet'
+
+
+def open_store(file_name, mode='a', backend=None, **kwargs):
+    '''
+    Open a table store.
+
+    :param file_name: Path of the store. Names ending in `.parquet` use the Parquet backend unless `backend` is given.
+    :param mode: One of r, w or a as for pandas.HDFStore.
+    :param backend: Optional explicit backend, either hdf5 or parquet.
+
+    Remaining keyword arguments are passed to the store. HDF5 compression options are ignored by the Parquet backend.
+    '''
+    if backend is None:
+        backend = get_store_backend(file_name)
+
+    if backend == 'hdf5':
+        return pd.HDFStore(file_name, mode, **kwargs)
+
+    elif backend == 'parquet':
+        for key in hdf5_only_kwargs:
+            kwargs.pop(key, None)
+
+        return ParquetStore(file_name, mode, **kwargs)
+
+    else:
+        raise ValueError('Unknown table store backend {0}'.format(backend))
+
+
+def get_store_backend(file_name):
+    if file_name.rstrip('/').endswith(parquet_extension):
+        return 'parquet'
+
+    else:
+        return 'hdf5'
+
+
+class ParquetStore(object):
+    '''
+    Directory of Parquet datasets with a subset of the pandas.HDFStore interface.
+
+    Each key is stored as a directory `<key>.parquet` of part files. Every `append` adds a row group to the current part
+    file, so data written in sorted chunks gets per row group chrom/coord statistics which `select` can use to skip
+    row groups through `filters`. Appending in a new session adds a new part file. Series are stored as single column
+    tables and returned as Series.
+    '''
+
+    def __init__(self, path, mode='a', compression='snappy', row_group_size=None):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+
+        self._pq = pyarrow.parquet
+
+        self.path = path
+
+        self.mode = mode
+
+        self.compression = compression
+
+        self.row_group_size = row_group_size
+
+        self._writers = {}
+
+        if mode == 'w':
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+            os.makedirs(path)
+
+        elif mode == 'r':
+            if not os.path.isdir(path):
+                raise IOError('Parquet store {0} does not exist'.format(path))
+
+        elif not os.path.exists(path):
+            os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        return os.path.isdir(self.get_table_path(key))
+
+    def __getitem__(self, key):
+        return self.select(key)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def keys(self):
+        keys = []
+
+        for root, dirs, _ in os.walk(self.path):
+            for dir_name in sorted(dirs):
+                if dir_name.endswith(parquet_extension):
+                    rel_path = os.path.relpath(os.path.join(root, dir_name), self.path)
+
+                    keys.append('/' + rel_path[:-len(parquet_extension)].replace(os.sep, '/'))
+
+            # Table directories only contain part files
+            dirs[:] = [x for x in dirs if not x.endswith(parquet_extension)]
+
+        return sorted(keys)
+
+    def get_table_path(self, key):
+        return os.path.join(self.path, *key.strip('/').split('/')) + parquet_extension
+
+    def get_part_files(self, key):
+        return sorted(glob.glob(os.path.join(self.get_table_path(key), 'part-*.parquet')))
+
+    def put(self, key, value, **kwargs):
+        '''
+        Write a DataFrame or Series, replacing any existing table. HDF5 specific arguments such as `format` are ignored.
+        '''
+        self._check_writable()
+
+        self._close_writer(key)
+
+        table_path = self.get_table_path(key)
+
+        if os.path.exists(table_path):
+            shutil.rmtree(table_path)
+
+        self._write(key, value)
+
+        self._close_writer(key)
+
+    def append(self, key, value, **kwargs):
+        '''
+        Append a DataFrame as a new row group. HDF5 specific arguments such as `min_itemsize` are ignored.
+
+        As with HDFStore, appending an empty DataFrame does nothing.
+        '''
+        self._check_writable()
+
+        if value.empty:
+            return
+
+        self._write(key, value)
+
+    def select(self, key, columns=None, filters=None, chunksize=None):
+        '''
+        Read a table, optionally restricted to `columns` and to rows matching pyarrow `filters`, for example
+        [('chrom', '==', '1'), ('coord', '>=', 1000)]. Row groups whose statistics exclude the filters are not read.
+
+        If `chunksize` is given an iterator over DataFrames of at most `chunksize` rows is returned instead, as for
+        HDFStore. Filters are not supported when reading in chunks.
+        '''
+        self._close_writer(key)
+
+        if key not in self:
+            raise KeyError('No object named {0} in the file'.format(key))
+
+        if chunksize is not None:
+            if filters is not None:
+                raise ValueError('Filters are not supported when reading in chunks')
+
+            return self._iter_chunks(key, columns, chunksize)
+
+        table = self._pq.read_table(self.get_table_path(key), columns=columns, filters=filters)
+
+        return self._to_pandas(table)
+
+    def close(self):
+        for key in list(self._writers.keys()):
+            self._close_writer(key)
+
+    def _check_writable(self):
+        if self.mode == 'r':
+            raise ValueError('Parquet store {0} is open read only'.format(self.path))
+
+    def _write(self, key, value):
+        table = self._to_arrow(value)
+
+        if key not in self._writers:
+            table_path = self.get_table_path(key)
+
+            if not os.path.exists(table_path):
+                os.makedirs(table_path)
+
+            part_file = os.path.join(table_path, 'part-{0:05d}.parquet'.format(len(self.get_part_files(key))))
+
+            self._writers[key] = self._pq.ParquetWriter(part_file, table.schema, compression=self.compression)
+
+        self._writers[key].write_table(table, row_group_size=self.row_group_size)
+
+    def _close_writer(self, key):
+        writer = self._writers.pop(key, None)
+
+        if writer is not None:
+            writer.close()
+
+    def _iter_chunks(self, key, columns, chunksize):
+        num_chunks = 0
+
+        for part_file in self.get_part_files(key):
+            batches = self._pq.ParquetFile(part_file).iter_batches(
+                batch_size=chunksize, columns=columns, use_pandas_metadata=True)
+
+            for batch in batches:
+                num_chunks += 1
+
+                yield self._to_pandas(self._pa.Table.from_batches([batch]))
+
+        # Empty tables still yield one frame so the columns are known
+        if num_chunks == 0:
+            yield self._to_pandas(self._pq.read_table(self.get_table_path(key), columns=columns))
+
+    def _to_pandas(self, table):
+        df = table.to_pandas()
+
+        metadata = table.schema.metadata or {}
+
+        if metadata.get(b'biowrappers_series') == b'1':
+            df = df.iloc[:, 0]
+
+            if metadata.get(b'biowrappers_series_name') is None:
+                df.name = None
+
+        return df
+
+    def _to_arrow(self, value):
+        metadata = {}
+
+        if isinstance(value, pd.Series):
+            metadata[b'biowrappers_series'] = b'1'
+
+            if value.name is not None:
+                metadata[b'biowrappers_series_name'] = str(value.name).encode('utf-8')
+
+            else:
+                value = value.rename('0')
+
+            value = value.to_frame()
+
+        # Store the index as a column so row numbers survive appends
+        table = self._pa.Table.from_pandas(value, preserve_index=True)
+
+        if len(metadata) > 0:
+            metadata.update(table.schema.metadata or {})
+
+            table = table.replace_schema_metadata(metadata)
+
+        return table
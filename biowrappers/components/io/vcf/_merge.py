@@ -6,36 +6,193 @@ Created on Nov 20, 2015
 from collections import namedtuple
 
 import csv
+import heapq
+import multiprocessing
+import os
 import pysam
+import shutil
+import tempfile
 
 from biowrappers.components.utils import flatten_input
 
 chrom_map = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
 
+bgzf_eof = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
-def merge_vcfs(in_files, out_file):
+
+def merge_vcfs(in_files, out_file, compress=False, num_workers=1):
+    '''
+    Merge the sites of tabix indexed VCF files into a sites only VCF with one record per alternate allele.
+
+    :param in_files: List or dict of VCF files to merge.
+    :param out_file: Path where merged VCF will be written.
+    :param compress: If True the output is written bgzip compressed with tabix and CSI indexes, `out_file` + `.tbi` and
+        `out_file` + `.csi`. Chromosomes are then merged in parallel by `num_workers` processes, tasks using more than
+        one should request as many cpus in their ctx.
+
+    The output is sorted by construction so it does not need to be sorted before indexing.
+    '''
     in_files = flatten_input(in_files)
 
+    if compress:
+        _merge_vcfs_bgzf(in_files, out_file, num_workers=num_workers)
+
+        return
+
     with open(out_file, 'w') as out_fh:
         write_header(out_fh)
 
-        writer = csv.DictWriter(out_fh, ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO'], delimiter='\t')
-
         reader = MultiVcfReader(in_files)
 
-        for row in reader:
-            writer.writerow({'CHROM': row.chrom,
-                             'POS': row.coord,
-                             'ID': '.',
-                             'REF': row.ref,
-                             'ALT': row.alt,
-                             'QUAL': '.',
-                             'FILTER': '.',
-                             'INFO': '.'})
+        write_records(out_fh, reader)
 
         reader.close()
 
 
+def write_records(fh, records):
+    writer = csv.writer(fh, delimiter='\t', lineterminator='\n')
+
+    for row in records:
+        writer.writerow([row.chrom, row.coord, '.', row.ref, row.alt, '.', '.', '.'])
+
+
+def _merge_vcfs_bgzf(in_files, out_file, num_workers=1):
+    reader = MultiVcfReader(in_files)
+
+    chroms = reader.chroms
+
+    reader.close()
+
+    num_workers = max(1, min(num_workers, len(chroms)))
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_file) + '.', dir=os.path.dirname(os.path.abspath(out_file)))
+
+    try:
+        header_file = os.path.join(tmp_dir, 'header.vcf.gz')
+
+        _write_bgzf_text(header_file, _get_header_text())
+
+        args_list = []
+
+        for chrom_idx, chrom in enumerate(chroms):
+            args_list.append((in_files, chrom, os.path.join(tmp_dir, '{0}.vcf.gz'.format(chrom_idx))))
+
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+
+            try:
+                part_files = pool.map(_merge_chrom_star, args_list)
+
+            finally:
+                pool.terminate()
+
+                pool.join()
+
+        else:
+            part_files = [_merge_chrom(*args) for args in args_list]
+
+        _concatenate_bgzf([header_file] + part_files, out_file)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    pysam.tabix_index(out_file, preset='vcf', force=True, index=out_file + '.tbi')
+
+    pysam.tabix_index(out_file, preset='vcf', force=True, index=out_file + '.csi', csi=True)
+
+
+def _merge_chrom(in_files, chrom, out_file):
+    reader = MultiVcfReader(in_files)
+
+    out_fh = pysam.BGZFile(out_file, 'wb')
+
+    try:
+        buf = _TextBuffer(out_fh)
+
+        write_records(buf, reader.iter_chrom(chrom))
+
+        buf.flush()
+
+    finally:
+        out_fh.close()
+
+        reader.close()
+
+    return out_file
+
+
+def _merge_chrom_star(args):
+    return _merge_chrom(*args)
+
+
+def _write_bgzf_text(file_name, text):
+    out_fh = pysam.BGZFile(file_name, 'wb')
+
+    out_fh.write(text.encode('utf-8'))
+
+    out_fh.close()
+
+
+def _concatenate_bgzf(in_files, out_file):
+    '''
+    Concatenate BGZF files by copying their blocks, dropping the empty end of file block of each input.
+    '''
+    with open(out_file, 'wb') as out_fh:
+        for file_name in in_files:
+            with open(file_name, 'rb') as in_fh:
+                in_fh.seek(0, os.SEEK_END)
+
+                size = in_fh.tell()
+
+                if size >= len(bgzf_eof):
+                    in_fh.seek(size - len(bgzf_eof))
+
+                    if in_fh.read() == bgzf_eof:
+                        size -= len(bgzf_eof)
+
+                in_fh.seek(0)
+
+                while size > 0:
+                    data = in_fh.read(min(size, 2 ** 20))
+
+                    out_fh.write(data)
+
+                    size -= len(data)
+
+        out_fh.write(bgzf_eof)
+
+
+class _TextBuffer(object):
+    '''
+    Collect text written by csv.writer and pass it to a binary file in large encoded chunks.
+    '''
+
+    def __init__(self, fh, buffer_size=2 ** 16):
+        self._fh = fh
+
+        self._buffer = []
+
+        self._buffer_len = 0
+
+        self._buffer_size = buffer_size
+
+    def write(self, text):
+        self._buffer.append(text)
+
+        self._buffer_len += len(text)
+
+        if self._buffer_len >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer_len > 0:
+            self._fh.write(''.join(self._buffer).encode('utf-8'))
+
+        self._buffer = []
+
+        self._buffer_len = 0
+
+
 def get_chrom_order(chrom):
     '''
     Convert chromosome names so they will sort 1, 2, 3, ..., X, Y, MT, etc..
@@ -58,53 +215,51 @@ def get_chrom_order(chrom):
 
 
 def write_header(fh):
-    fh.write('##fileformat=VCFv4.1\n')
+    fh.write(_get_header_text())
 
-    header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
 
-    header = '\t'.join(header)
+def _get_header_text():
+    header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
 
-    fh.write('#{0}\n'.format(header))
+    return '##fileformat=VCFv4.1\n#{0}\n'.format('\t'.join(header))
 
 LightVCFRecord = namedtuple('LightVCFRecord', ['chrom', 'coord', 'ref', 'alt'])
 
 
 class MultiVcfReader(object):
+    '''
+    Merge the records of several tabix indexed VCF files.
+
+    Records are yielded once per alternate allele, sorted by chromosome, position, reference and alternate allele, with
+    identical (chrom, coord, ref, alt) records from different files reported once. Each chromosome is merged with a
+    heap over the files, so the cost is linear in the number of records times the log of the number of files.
+    '''
 
     def __init__(self, vcf_files):
         self._readers = []
 
         for file_name in vcf_files:
-            self._readers.append(pysam.Tabixfile(file_name, parser=pysam.asVCF()))
+            self._readers.append(pysam.Tabixfile(file_name, parser=pysam.asTuple()))
+
+        self._chroms = None
 
     def __iter__(self):
         for chrom in self.chroms:
-            active_iters = self._load_iters(chrom)
-
-            while len(active_iters) > 0:
-                pos_buffer = set()
-
-                min_coord = min([x.record.coord for x in active_iters])
-
-                new_active_iters = []
-
-                for chrom_iter in active_iters:
-                    while chrom_iter.coord == min_coord:
-                        record = chrom_iter.record
+            for record in self.iter_chrom(chrom):
+                yield record
 
-                        # Handles multiple alt alleles.
-                        for alt in record.alt.split(','):
-                            pos_buffer.add(LightVCFRecord(record.chrom, record.coord, record.ref, alt))
+    def iter_chrom(self, chrom):
+        chrom_iters = self._load_iters(chrom)
 
-                        chrom_iter.buffer_next_record()
+        prev_key = None
 
-                    if chrom_iter.active:
-                        new_active_iters.append(chrom_iter)
+        for key in heapq.merge(*chrom_iters):
+            if key == prev_key:
+                continue
 
-                for record in sorted(pos_buffer, key=lambda x: (get_chrom_order(x.chrom), x.coord, x.ref, x.alt)):
-                    yield record
+            prev_key = key
 
-                active_iters = new_active_iters
+            yield LightVCFRecord(chrom, key[0], key[1], key[2])
 
     def close(self):
         for reader in self._readers:
@@ -115,12 +270,17 @@ class MultiVcfReader(object):
         '''
         Get a union set of chromosomes present in VCF readers.
         '''
-        chroms = set()
+        if self._chroms is None:
+            chroms = set()
 
-        for reader in self._readers:
-            chroms.update(set(reader.contigs))
+            for reader in self._readers:
+                chroms.update(reader.contigs)
+
+            chrom_ranks = dict((x, _get_chrom_rank(x)) for x in chroms)
 
-        return sorted(chroms, key=lambda x: get_chrom_order(x))
+            self._chroms = sorted(chroms, key=lambda x: chrom_ranks[x])
+
+        return self._chroms
 
     def _load_iters(self, chrom):
         iters = []
@@ -132,31 +292,52 @@ class MultiVcfReader(object):
             except (KeyError, ValueError):
                 continue
 
-            iters.append(BufferedChromIter(chrom_iter))
+            iters.append(_iter_sorted_alleles(chrom_iter))
 
         return iters
 
 
-class BufferedChromIter(object):
+def _get_chrom_rank(chrom):
+    '''
+    Sort key for chromosomes which places numbered chromosomes, in the order given by `get_chrom_order`, before named
+    ones.
+    '''
+    chrom = get_chrom_order(chrom)
+
+    if isinstance(chrom, int):
+        return (0, chrom, '')
+
+    else:
+        return (1, 0, chrom)
+
+
+def _iter_sorted_alleles(chrom_iter):
+    '''
+    Yield (coord, ref, alt) for each alternate allele of the records from a position sorted file, ordered by coord,
+    ref and alt so the result can be merged with other files.
+    '''
+    pos_buffer = []
 
-    def __init__(self, chrom_iter):
-        self._iter = chrom_iter
+    buffer_coord = None
 
-        self.active = True
+    for record in chrom_iter:
+        coord = int(record[1])
 
-        self.buffer_next_record()
+        if coord != buffer_coord:
+            pos_buffer.sort()
 
-    def buffer_next_record(self):
-        try:
-            record = self._iter.next()
+            for key in pos_buffer:
+                yield key
 
-            self.record = LightVCFRecord(record.contig, record.pos + 1, record.ref, record.alt)
+            pos_buffer = []
 
-            self.coord = self.record.coord
+            buffer_coord = coord
 
-        except StopIteration:
-            self.active = False
+        # Handles multiple alt alleles.
+        for alt in record[4].split(','):
+            pos_buffer.append((coord, record[3], alt))
 
-            self.record = None
+    pos_buffer.sort()
 
-            self.coord = None
+    for key in pos_buffer:
+        yield key
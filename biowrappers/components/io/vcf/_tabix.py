@@ -0,0 +1,125 @@
+'''
+Read the tabix index and BGZF block layout of a bgzipped VCF without decompressing any records.
+'''
+from collections import OrderedDict, namedtuple
+
+import bisect
+import gzip
+import struct
+
+linear_window_size = 2 ** 14
+
+_pseudo_bin = 37450
+
+TabixReference = namedtuple('TabixReference', ['num_records', 'beg_offset', 'end_offset', 'window_offsets'])
+
+
+def read_tabix_index(index_file):
+    '''
+    Read the per chromosome contents of a tabix index.
+
+    Returns an OrderedDict from chromosome to TabixReference, in the order of the index. `window_offsets` holds the
+    virtual file offset of the first record overlapping each 16kb window. `num_records` and the offsets of the first and
+    last record come from the index meta data bin, and are None for indexes written without it.
+    '''
+    with gzip.open(index_file, 'rb') as fh:
+        data = fh.read()
+
+    if data[:4] != b'TBI\x01':
+        raise ValueError('{0} is not a tabix index'.format(index_file))
+
+    num_refs = _unpack('<i', data, 4)
+
+    name_len = _unpack('<i', data, 32)
+
+    names = data[36:36 + name_len].split(b'\x00')[:num_refs]
+
+    offset = 36 + name_len
+
+    index = OrderedDict()
+
+    for name in names:
+        num_records = beg_offset = end_offset = None
+
+        num_bins = _unpack('<i', data, offset)
+
+        offset += 4
+
+        for _ in range(num_bins):
+            bin_id, num_chunks = struct.unpack_from('<Ii', data, offset)
+
+            offset += 8
+
+            if bin_id == _pseudo_bin:
+                beg_offset, end_offset, num_records, _ = struct.unpack_from('<4Q', data, offset)
+
+            offset += 16 * num_chunks
+
+        num_windows = _unpack('<i', data, offset)
+
+        offset += 4
+
+        window_offsets = list(struct.unpack_from('<{0}Q'.format(num_windows), data, offset))
+
+        offset += 8 * num_windows
+
+        # Older indexers leave windows without records set to zero
+        for i in range(1, num_windows):
+            window_offsets[i] = max(window_offsets[i], window_offsets[i - 1])
+
+        index[name.decode('utf-8')] = TabixReference(num_records, beg_offset, end_offset, window_offsets)
+
+    return index
+
+
+class BgzfBlockMap(object):
+    '''
+    Map BGZF virtual file offsets to uncompressed byte offsets.
+
+    Only the 18 byte header and 4 byte footer of each block are read, so building the map costs one seek per block
+    rather than decompressing the file.
+    '''
+
+    def __init__(self, file_name):
+        self.compressed_offsets = []
+
+        self.uncompressed_offsets = []
+
+        compressed_offset = 0
+
+        uncompressed_offset = 0
+
+        with open(file_name, 'rb') as fh:
+            while True:
+                fh.seek(compressed_offset)
+
+                header = fh.read(18)
+
+                if len(header) < 18:
+                    break
+
+                if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                    raise ValueError('{0} is not BGZF compressed'.format(file_name))
+
+                block_size = _unpack('<H', header, 16) + 1
+
+                fh.seek(compressed_offset + block_size - 4)
+
+                self.compressed_offsets.append(compressed_offset)
+
+                self.uncompressed_offsets.append(uncompressed_offset)
+
+                compressed_offset += block_size
+
+                uncompressed_offset += _unpack('<I', fh.read(4), 0)
+
+    def get_uncompressed_offset(self, virtual_offset):
+        compressed_offset = virtual_offset >> 16
+
+        block_idx = bisect.bisect_right(self.compressed_offsets, compressed_offset) - 1
+
+        return self.uncompressed_offsets[max(block_idx, 0)] + (virtual_offset & 0xffff)
+
+
+def _unpack(fmt, data, offset):
+    return struct.unpack_from(fmt, data, offset)[0]
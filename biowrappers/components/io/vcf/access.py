@@ -0,0 +1,142 @@
+'''
+VCF access layer built on pysam.VariantFile.
+
+htslib only decodes the INFO and FORMAT fields of a record when they are accessed, so loops which need a few fields do
+not pay for the full parse PyVCF performs on every record. Readers opened with `drop_samples` skip the sample columns
+entirely.
+'''
+import re
+
+import pysam
+
+snv_alleles = frozenset(['A', 'C', 'G', 'T', 'N', '*'])
+
+_sequence_allele_regex = re.compile('^[ACGTNacgtn*]+$')
+
+
+def open_reader(file_name, drop_samples=False):
+    ''' Open a VCF or BCF file for reading.
+
+    :param drop_samples: If True the sample columns are not parsed, for loops which only use site level fields.
+
+    '''
+    reader = pysam.VariantFile(file_name)
+
+    if drop_samples:
+        reader.subset_samples([])
+
+    return reader
+
+
+def open_writer(file_name, header, compress=False):
+    ''' Open a VCF file for writing records with the given header. The file is plain text unless `compress` is set, in
+    which case it is written with bgzip compression.
+    '''
+    if compress:
+        mode = 'wz'
+
+    else:
+        mode = 'w'
+
+    return pysam.VariantFile(file_name, mode, header=header)
+
+
+def fetch(reader, chrom, beg=None, end=None):
+    ''' Fetch records overlapping a region of an indexed file. Coordinates are 0 based and half open.
+
+    Chromosomes missing from the index give no records. Files without an index raise a ValueError, rather than silently
+    giving no records.
+    '''
+    if reader.index is None:
+        raise ValueError('Fetching a region of {0} requires an index'.format(_get_file_name(reader)))
+
+    if chrom not in reader.index:
+        return iter(())
+
+    return reader.fetch(chrom, beg, end)
+
+
+def fetch_starts(reader, chrom, beg=None, end=None):
+    ''' Fetch records which start in a region of an indexed file. Coordinates are 0 based and half open.
+
+    Unlike `fetch`, records which only overlap the region are skipped, so a chromosome split into adjacent regions
+    gives every record exactly once.
+    '''
+    for record in fetch(reader, chrom, beg, end):
+        if (beg is not None) and (record.start < beg):
+            continue
+
+        yield record
+
+
+def add_filter(header, filter_id, description):
+    ''' Add a FILTER definition to a header, replacing any existing definition with the same id.
+    '''
+    if filter_id in header.filters:
+        header.filters[filter_id].remove_header()
+
+    header.filters.add(filter_id, None, None, description)
+
+
+def add_format(header, format_id, number, value_type, description):
+    ''' Add a FORMAT definition to a header, replacing any existing definition with the same id.
+    '''
+    if format_id in header.formats:
+        header.formats[format_id].remove_header()
+
+    header.formats.add(format_id, number, value_type, description)
+
+
+def get_filters(record):
+    ''' Get the list of filters set on a record. Passing records, with FILTER set to PASS or missing, give an empty list.
+    '''
+    return [x for x in record.filter.keys() if x != 'PASS']
+
+
+def get_alts(record):
+    ''' Get the alternate alleles of a record as a tuple, which is empty if ALT is missing.
+    '''
+    if record.alts is None:
+        return ()
+
+    return record.alts
+
+
+def is_snv(record):
+    ''' Check if all alleles of a record are single bases, matching PyVCF's is_snp.
+    '''
+    if (len(record.ref) > 1) or (record.alts is None):
+        return False
+
+    return all(x in snv_alleles for x in record.alts)
+
+
+def is_indel(record):
+    ''' Check if a record is an insertion or deletion, matching PyVCF 0.6.8's is_indel. Records with an SVTYPE are not
+    indels, and records without an alternate allele are, as PyVCF treats a missing ALT as an indel.
+    '''
+    is_sv = 'SVTYPE' in record.info
+
+    if (len(record.ref) > 1) and (not is_sv):
+        return True
+
+    if record.alts is None:
+        return True
+
+    for alt in record.alts:
+        if _sequence_allele_regex.match(alt) is None:
+            return False
+
+        elif len(alt) != len(record.ref):
+            return not is_sv
+
+    return False
+
+
+def _get_file_name(reader):
+    file_name = reader.filename
+
+    if isinstance(file_name, bytes):
+        file_name = file_name.decode('utf-8')
+
+    return file_name
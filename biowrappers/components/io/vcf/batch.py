@@ -0,0 +1,98 @@
+'''
+Batched access to the fields of VCF records.
+
+Records are read with `access.open_reader` in batches, so filters can pull the INFO and FORMAT values they need for a
+whole batch into numpy arrays and be evaluated vectorised. Values are set and records written through pysam, so the
+output is the same as filtering the records one at a time.
+'''
+import itertools
+
+import numpy as np
+
+import biowrappers.components.io.vcf.access as access
+
+
+def iter_record_batches(file_name, header=None, batch_size=int(1e4)):
+    ''' Iterate over the records of a VCF file in batches of at most `batch_size` records.
+
+    :param header: Header the records are translated to, which must be given to set fields or filters which are not
+        defined in the header of the file.
+
+    '''
+    reader = access.open_reader(file_name)
+
+    try:
+        while True:
+            records = list(itertools.islice(reader, batch_size))
+
+            if len(records) == 0:
+                break
+
+            if header is not None:
+                for record in records:
+                    record.translate(header)
+
+            yield RecordBatch(records)
+
+    finally:
+        reader.close()
+
+
+class RecordBatch(object):
+    '''
+    Batch of pysam VCF records. Samples are referred to by their index in the sample columns.
+    '''
+
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_chroms(self):
+        return np.array([x.chrom for x in self.records], dtype=object)
+
+    def get_positions(self):
+        return np.array([x.pos for x in self.records], dtype=np.int64)
+
+    def get_info(self, key, dtype=float, missing=np.nan):
+        ''' Get the values of a single valued INFO field as an array, with `missing` for records without the field.
+        '''
+        values = [x.info.get(key, missing) for x in self.records]
+
+        if dtype is float:
+            return np.array(values, dtype=np.float64)
+
+        return np.array(values, dtype=object)
+
+    def get_format(self, sample_idx, key, missing=np.nan):
+        ''' Get the values of a single valued numeric FORMAT field for a sample as a float array, with `missing` for
+        records where the value is absent.
+        '''
+        values = np.full(len(self), missing, dtype=np.float64)
+
+        for i, record in enumerate(self.records):
+            value = record.samples[sample_idx].get(key)
+
+            if value is not None:
+                values[i] = value
+
+        return values
+
+    def set_format(self, sample_idx, key, values):
+        ''' Set a single valued Float FORMAT field for a sample. Records with a NaN value are left unchanged.
+        '''
+        for record, value in zip(self.records, values):
+            if not np.isnan(value):
+                record.samples[sample_idx][key] = float(value)
+
+    def add_filter(self, filter_id, mask):
+        ''' Add a filter to the records selected by a boolean array.
+        '''
+        for record, is_filtered in zip(self.records, mask):
+            if is_filtered:
+                record.filter.add(filter_id)
+
+    def write(self, writer):
+        for record in self.records:
+            writer.write(record)
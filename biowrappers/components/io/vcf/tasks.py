@@ -4,17 +4,31 @@ Created on Oct 31, 2015
 @author: Andrew Roth
 '''
 
+import array
+import gzip
+import heapq
 import itertools
 import os
+import re
+import shutil
+import tempfile
 
+import numpy as np
 import pandas as pd
 import pypeliner
-import vcf
+import pysam
+import biowrappers.components.io.vcf._tabix as _tabix
+import biowrappers.components.io.vcf.access as access
+from biowrappers.components.io.store import open_store
 from biowrappers.components.utils import flatten_input
-from pandas.api.types import CategoricalDtype
 
 from ._merge import merge_vcfs
 
+_contig_id_regex = re.compile(b'^##contig=<(?:.*,)?ID=([^,>]+)')
+
+# Approximate memory used by the key and tuple of a record held for sorting, in addition to the line
+_sort_record_overhead = 192
+
 
 def compress_vcf(in_file, out_file):
     """ Compress a VCF file using bgzip.
@@ -37,16 +51,17 @@ def filter_vcf(in_file, out_file):
 
     """
 
-    reader = vcf.Reader(filename=in_file)
+    reader = access.open_reader(in_file)
+
+    writer = access.open_writer(out_file, reader.header)
 
-    with open(out_file, 'wb') as out_fh:
-        writer = vcf.Writer(out_fh, reader)
+    for record in reader:
+        if len(access.get_filters(record)) == 0:
+            writer.write(record)
 
-        for record in reader:
-            if (record.FILTER is None) or (len(record.FILTER) == 0):
-                writer.write_record(record)
+    writer.close()
 
-        writer.close()
+    reader.close()
 
 
 def _rename_index(in_file, index_suffix):
@@ -71,14 +86,32 @@ def index_bcf(in_file, docker_config={}):
     pypeliner.commandline.execute('bcftools', 'index', in_file, **docker_config)
 
 
-def finalise_vcf(in_file, compressed_file, docker_config={}):
+def finalise_vcf(in_file, compressed_file, docker_config={}, in_process=True, max_buffer_size=int(5e8)):
     """ Compress a VCF using bgzip and create index.
 
     :param in_file: Path of file to compressed and index.
     :param compressed_file: Path where compressed file will be written. Index files will written to `out_file` + `.tbi` and `out_file` + `.csi`.
+    :param in_process: If True the file is sorted, compressed and indexed with pysam, otherwise `vcf-sort`, `bgzip`,
+        `bcftools` and `tabix` are run using `docker_config`.
+    :param max_buffer_size: Approximate maximum number of bytes of memory used by records held when sorting in process,
+        estimated from the length of each record plus a fixed per record overhead. Larger inputs are sorted in runs
+        which are merged from disk.
+
+    In process, records are ordered by chromosome, in the order of the header contig lines followed by other
+    chromosomes by name, then by position. Records at the same position keep their input order. Input which is already
+    in this order is compressed as is in a single pass.
 
     """
 
+    if in_process:
+        _write_sorted_bgzf(in_file, compressed_file, max_buffer_size)
+
+        pysam.tabix_index(compressed_file, preset='vcf', force=True, index=compressed_file + '.tbi')
+
+        pysam.tabix_index(compressed_file, preset='vcf', force=True, index=compressed_file + '.csi', csi=True)
+
+        return
+
     uncompressed_file = compressed_file + '.uncompressed'
     pypeliner.commandline.execute('vcf-sort', in_file, '>', uncompressed_file, **docker_config)
     pypeliner.commandline.execute('bgzip', uncompressed_file, '-c', '>', compressed_file, **docker_config)
@@ -88,6 +121,198 @@ def finalise_vcf(in_file, compressed_file, docker_config={}):
     index_vcf(compressed_file, docker_config=docker_config)
 
 
+def _write_sorted_bgzf(in_file, out_file, max_buffer_size):
+    # Optimistically copy the input, falling back to sorting at the first out of order record
+    if _copy_sorted_vcf(in_file, out_file):
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_file) + '.', dir=os.path.dirname(os.path.abspath(out_file)))
+
+    try:
+        _sort_vcf(in_file, out_file, max_buffer_size, tmp_dir)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _copy_sorted_vcf(in_file, out_file):
+    header = []
+
+    contig_ranks = None
+
+    prev_key = None
+
+    with _open_text_vcf(in_file) as in_fh, _BgzfLineWriter(out_file) as writer:
+        for line in in_fh:
+            if line.startswith(b'#'):
+                header.append(line)
+
+                writer.write(line)
+
+                continue
+
+            if not line.strip():
+                continue
+
+            if contig_ranks is None:
+                contig_ranks = _get_contig_ranks(header)
+
+            key = _get_sort_key(line, contig_ranks)
+
+            if (prev_key is not None) and (key < prev_key):
+                return False
+
+            prev_key = key
+
+            writer.write(line)
+
+    return True
+
+
+def _sort_vcf(in_file, out_file, max_buffer_size, tmp_dir):
+    header = []
+
+    run_files = []
+
+    records = []
+
+    contig_ranks = None
+
+    buffer_size = 0
+
+    with _open_text_vcf(in_file) as in_fh:
+        for line in in_fh:
+            if line.startswith(b'#'):
+                header.append(line)
+
+                continue
+
+            if not line.strip():
+                continue
+
+            if contig_ranks is None:
+                contig_ranks = _get_contig_ranks(header)
+
+            line = _ensure_newline(line)
+
+            records.append((_get_sort_key(line, contig_ranks), line))
+
+            buffer_size += len(line) + _sort_record_overhead
+
+            if buffer_size >= max_buffer_size:
+                run_files.append(_write_sort_run(records, tmp_dir, len(run_files)))
+
+                records = []
+
+                buffer_size = 0
+
+    records.sort(key=_get_record_sort_key)
+
+    run_fhs = [open(x, 'rb') for x in run_files]
+
+    try:
+        # Runs hold consecutive records of the input, so ties are broken by run index to keep records at the same
+        # position in input order
+        runs = [_iter_sort_run(fh, contig_ranks, run_idx) for run_idx, fh in enumerate(run_fhs)]
+
+        runs.append((key, len(run_files), line) for key, line in records)
+
+        with _BgzfLineWriter(out_file) as writer:
+            writer.writelines(header)
+
+            for _, _, line in heapq.merge(*runs):
+                writer.write(line)
+
+    finally:
+        for fh in run_fhs:
+            fh.close()
+
+
+def _write_sort_run(records, tmp_dir, run_idx):
+    records.sort(key=_get_record_sort_key)
+
+    run_file = os.path.join(tmp_dir, 'run_{0}.vcf'.format(run_idx))
+
+    with open(run_file, 'wb') as out_fh:
+        out_fh.writelines(x[1] for x in records)
+
+    return run_file
+
+
+def _iter_sort_run(fh, contig_ranks, run_idx):
+    for line in fh:
+        yield _get_sort_key(line, contig_ranks), run_idx, line
+
+
+def _get_sort_key(line, contig_ranks):
+    chrom, pos = line.split(b'\t', 2)[:2]
+
+    return contig_ranks.get(chrom, len(contig_ranks)), chrom, int(pos)
+
+
+def _get_record_sort_key(record):
+    return record[0]
+
+
+def _get_contig_ranks(header):
+    contig_ranks = {}
+
+    for line in header:
+        match = _contig_id_regex.match(line)
+
+        if (match is not None) and (match.group(1) not in contig_ranks):
+            contig_ranks[match.group(1)] = len(contig_ranks)
+
+    return contig_ranks
+
+
+class _BgzfLineWriter(object):
+    """ Write lines to a BGZF file in large chunks.
+    """
+
+    def __init__(self, file_name, buffer_size=2 ** 16):
+        self._fh = pysam.BGZFile(file_name, 'wb')
+
+        self._buffer = []
+
+        self._buffer_len = 0
+
+        self._buffer_size = buffer_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, line):
+        line = _ensure_newline(line)
+
+        self._buffer.append(line)
+
+        self._buffer_len += len(line)
+
+        if self._buffer_len >= self._buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buffer_len > 0:
+            self._fh.write(b''.join(self._buffer))
+
+        self._buffer = []
+
+        self._buffer_len = 0
+
+    def close(self):
+        self.flush()
+
+        self._fh.close()
+
+
 def index_vcf(vcf_file, docker_config={}):
     """ Create a tabix index for a VCF file
 
@@ -158,141 +383,289 @@ def extract_variant_type(in_file, out_file, variant_type):
 def split_vcf(in_file, out_files, lines_per_file):
     """ Split a VCF file into smaller files.
 
-    :param in_file: Path of VCF file to split.
+    :param in_file: Path of VCF file to split, which may be plain text or gzip/bgzip compressed.
 
     :param out_files: Callback function which supplies file name given index of split.
 
     :param lines_per_file: Maximum number of lines to be written per file.
 
+    The header is written once to each file and the record lines are copied verbatim, without being parsed. BCF files
+    are split record by record.
+
      """
 
-    def line_group(line, line_idx=itertools.count()):
-        return int(next(line_idx) / lines_per_file)
+    if _is_bcf(in_file):
+        _split_bcf(in_file, out_files, lines_per_file)
 
-    reader = vcf.Reader(filename=in_file)
+        return
 
-    for file_idx, records in itertools.groupby(reader, key=line_group):
-        file_name = out_files[file_idx]
+    with _open_text_vcf(in_file) as in_fh:
+        header = []
 
-        with open(file_name, 'w') as out_fh:
-            writer = vcf.Writer(out_fh, reader)
+        for line in in_fh:
+            if not line.startswith(b'#'):
+                break
 
-            for record in records:
-                writer.write_record(record)
+            header.append(line)
 
-            writer.close()
+        else:
+            line = None
 
+        if line is None:
+            lines = iter(())
 
-def _convert_vcf_to_df(in_file, score_callback=None):
-    def line_group(line, line_idx=itertools.count()):
-        return int(next(line_idx) / chunk_size)
+        else:
+            lines = itertools.chain([line], in_fh)
 
-    chunk_size = 1000
+        lines = (_ensure_newline(x) for x in lines if x.strip())
 
-    # ===================================================================================================================
-    # find all entries in categories
-    # ===================================================================================================================
-    reader = vcf.Reader(filename=in_file)
+        for file_idx in itertools.count():
+            records = list(itertools.islice(lines, lines_per_file))
 
-    chrom_categories = set()
+            if len(records) == 0:
+                break
 
-    ref_categories = set()
+            with open(out_files[file_idx], 'wb') as out_fh:
+                out_fh.writelines(header)
 
-    alt_categories = set()
+                out_fh.writelines(records)
 
-    for record in reader:
 
-        chrom_categories.add(str(record.CHROM))
+def _split_bcf(in_file, out_files, lines_per_file):
+    reader = access.open_reader(in_file)
+
+    for file_idx in itertools.count():
+        records = list(itertools.islice(reader, lines_per_file))
+
+        if len(records) == 0:
+            break
+
+        writer = access.open_writer(out_files[file_idx], reader.header)
+
+        for record in records:
+            writer.write(record)
+
+        writer.close()
+
+    reader.close()
+
+
+def get_vcf_split_regions(in_file, records_per_region, chromosomes=None):
+    """ Split a sorted VCF file into regions of roughly `records_per_region` records.
+
+    :param in_file: Path of VCF file to split.
+
+    :param records_per_region: Approximate number of records per region.
+
+    :param chromosomes: Optional list of chromosomes to restrict the regions to.
+
+    Returns a dict mapping region index to a region string of the form chrom:beg-end, which tasks can fetch from the
+    indexed file with `access.fetch_starts` instead of reading split files. Adjacent regions do not overlap, so every
+    record starts in exactly one region.
+
+    The file must be bgzip compressed with a tabix index. Regions are computed from the index and the BGZF block layout
+    alone, assuming records are evenly sized within a chromosome.
+
+    """
+
+    if not os.path.exists(in_file + '.tbi'):
+        raise ValueError('Splitting {0} into regions requires a tabix index'.format(in_file))
+
+    regions = _get_tabix_split_regions(in_file, records_per_region)
+
+    if chromosomes is not None:
+        chromosomes = set(chromosomes)
+
+        regions = [x for x in regions if x[0] in chromosomes]
+
+    return dict(enumerate('{0}:{1}-{2}'.format(*x) for x in regions))
+
+
+def _get_tabix_split_regions(in_file, records_per_region):
+    index = _tabix.read_tabix_index(in_file + '.tbi')
+
+    # Indexes without record counts can not be used to size regions
+    if any(x.num_records is None for x in index.values()):
+        raise ValueError('Tabix index of {0} does not record the number of records per chromosome'.format(in_file))
+
+    block_map = _tabix.BgzfBlockMap(in_file)
+
+    regions = []
+
+    for chrom, ref in index.items():
+        if (ref.num_records == 0) or (len(ref.window_offsets) == 0):
+            continue
 
-        ref_categories.add(str(record.REF))
+        chrom_beg = block_map.get_uncompressed_offset(ref.beg_offset)
 
-        for alt in record.ALT:
-            alt_categories.add(str(alt))
+        chrom_end = block_map.get_uncompressed_offset(ref.end_offset)
 
-    chrom_categories = sorted(chrom_categories)
+        region_size = max(chrom_end - chrom_beg, 1) * records_per_region / float(ref.num_records)
 
-    ref_categories = sorted(ref_categories)
+        num_windows = len(ref.window_offsets)
 
-    alt_categories = sorted(alt_categories)
+        region_beg_window = 0
 
-    if len(chrom_categories) > 0:
-        min_itemsize = {
-            'chrom': max([len(x) for x in chrom_categories]),
-            'ref': max([len(x) for x in ref_categories]),
-            'alt': max([len(x) for x in alt_categories])
-        }
+        region_beg_offset = chrom_beg
+
+        for window_idx in range(1, num_windows):
+            window_offset = block_map.get_uncompressed_offset(ref.window_offsets[window_idx])
+
+            if window_offset - region_beg_offset >= region_size:
+                regions.append((
+                    chrom,
+                    region_beg_window * _tabix.linear_window_size + 1,
+                    window_idx * _tabix.linear_window_size
+                ))
+
+                region_beg_window = window_idx
+
+                region_beg_offset = window_offset
+
+        regions.append((
+            chrom,
+            region_beg_window * _tabix.linear_window_size + 1,
+            num_windows * _tabix.linear_window_size
+        ))
+
+    return regions
+
+
+def _open_text_vcf(in_file):
+    with open(in_file, 'rb') as fh:
+        magic = fh.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(in_file, 'rb')
 
     else:
-        min_itemsize = {}
+        return open(in_file, 'rb')
 
-    # ===================================================================================================================
-    # convert
-    # ===================================================================================================================
 
-    # reopen reader to restart iter
-    reader = vcf.Reader(filename=in_file)
+def _is_bcf(in_file):
+    with _open_text_vcf(in_file) as fh:
+        return fh.read(3) == b'BCF'
 
-    no_data = True
 
-    for file_idx, records in itertools.groupby(reader, key=line_group):
+def _ensure_newline(line):
+    if line.endswith(b'\n'):
+        return line
 
-        df = []
+    return line + b'\n'
 
-        for record in records:
-            if score_callback is not None:
-                score = score_callback(record)
 
-            else:
-                score = record.QUAL
+def _convert_vcf_to_df(in_file, score_callback=None, chunk_size=int(1e5)):
+    """ Convert the sites of a VCF file to DataFrames with one row per alternate allele. Records without an alternate
+    allele give a single row with alt '.'.
+
+    The file is parsed once with pysam. Chromosome, reference and alternate alleles are stored as integer codes while
+    their categories are discovered, then remapped to sorted categories and yielded in chunks of `chunk_size` rows.
+
+    :param score_callback: Function taking a pysam VariantRecord and returning the score. Defaults to the QUAL field.
+
+    """
+    columns = ['chrom', 'coord', 'ref', 'alt', 'score']
+
+    chrom_codes = {}
+
+    ref_codes = {}
+
+    alt_codes = {}
+
+    data = {
+        'chrom': array.array('l'),
+        'coord': array.array('l'),
+        'ref': array.array('l'),
+        'alt': array.array('l'),
+    }
+
+    scores = []
+
+    # Sample columns are only parsed if the score callback may need them
+    reader = access.open_reader(in_file, drop_samples=(score_callback is None))
 
-            for alt in record.ALT:
-                row = {
-                    'chrom': record.CHROM,
-                    'coord': record.POS,
-                    'ref': str(record.REF),
-                    'alt': str(alt),
-                    'score': score
-                }
+    for record in reader:
+        if score_callback is not None:
+            score = score_callback(record)
+
+        else:
+            score = record.qual
+
+        chrom_code = chrom_codes.setdefault(record.chrom, len(chrom_codes))
+
+        ref_code = ref_codes.setdefault(record.ref, len(ref_codes))
+
+        alts = record.alts
+
+        if alts is None:
+            alts = ('.',)
+
+        for alt in alts:
+            data['chrom'].append(chrom_code)
+
+            data['coord'].append(record.pos)
+
+            data['ref'].append(ref_code)
 
-                df.append(row)
+            data['alt'].append(alt_codes.setdefault(alt, len(alt_codes)))
 
-        beg = file_idx * chunk_size
+            scores.append(score)
 
-        end = beg + len(df)
+    reader.close()
 
-        df = pd.DataFrame(df, index=range(beg, end))
+    num_rows = len(scores)
 
-        chrom_cat_type = CategoricalDtype(categories=chrom_categories)
-        df['chrom'] = df['chrom'].astype(chrom_cat_type)
+    if num_rows == 0:
+        yield pd.DataFrame(columns=columns), None
 
-        alt_cat_type = CategoricalDtype(categories=alt_categories)
-        df['alt'] = df['alt'].astype(alt_cat_type)
+        return
 
-        ref_cat_type = CategoricalDtype(categories=ref_categories)
-        df['ref'] = df['ref'].astype(ref_cat_type)
+    data = dict((col, np.frombuffer(data[col], dtype=np.dtype(data[col].typecode))) for col in data)
 
-        df = df[['chrom', 'coord', 'ref', 'alt', 'score']]
+    data['score'] = pd.Series(scores).values
+
+    min_itemsize = {}
+
+    for col, codes in (('chrom', chrom_codes), ('ref', ref_codes), ('alt', alt_codes)):
+        categories, data[col] = _sort_codes(codes, data[col])
+
+        data[col] = pd.Categorical.from_codes(data[col], categories=categories)
+
+        min_itemsize[col] = max([len(x) for x in categories])
+
+    for beg in range(0, num_rows, chunk_size):
+        end = min(beg + chunk_size, num_rows)
+
+        df = pd.DataFrame(dict((col, data[col][beg:end]) for col in columns), index=range(beg, end))
+
+        yield df[columns], min_itemsize
+
+
+def _sort_codes(codes, values):
+    """ Remap integer codes assigned in order of appearance so they index the sorted categories.
+    """
+    categories = sorted(codes)
 
-        yield df, min_itemsize
+    remap = np.empty(len(codes), dtype=np.int64)
 
-        no_data = False
+    for new_code, category in enumerate(categories):
+        remap[codes[category]] = new_code
 
-    if no_data:
-        yield pd.DataFrame(columns=['chrom', 'coord', 'ref', 'alt', 'score']), None
+    return categories, remap[values]
 
 
-def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None):
-    hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None, chunk_size=int(1e5)):
+    hdf_store = open_store(out_file, 'w', complevel=9, complib='blosc')
 
-    for (df, min_itemsize) in _convert_vcf_to_df(in_file, score_callback=score_callback):
+    for (df, min_itemsize) in _convert_vcf_to_df(in_file, score_callback=score_callback, chunk_size=chunk_size):
         hdf_store.append(table_name, df, min_itemsize=min_itemsize)
 
     hdf_store.close()
 
 
-def convert_vcf_to_csv(in_file, out_file, score_callback=None):
+def convert_vcf_to_csv(in_file, out_file, score_callback=None, chunk_size=int(1e5)):
     header = False
-    for (df, _) in _convert_vcf_to_df(in_file, score_callback=score_callback):
+    for (df, _) in _convert_vcf_to_df(in_file, score_callback=score_callback, chunk_size=chunk_size):
         if not header:
             df.to_csv(out_file, mode='w', header=True, index=False)
             header = True
@@ -8,6 +8,10 @@ import random
 import time
 import errno
 
+# Resources for merges which read their inputs in a pool of processes. Tasks pass num_workers=ctx['ncpus'] from the ctx
+# they request, so the pool always matches the allocation.
+merge_ctx = {'mem': 8, 'ncpus': 4}
+
 
 def find(name, path):
     for root, _, files in os.walk(path):
@@ -6,34 +6,39 @@ def create_vcf_db_annotation_workflow(
         target_vcf_file,
         out_file,
         docker_config={},
-        split_size=int(1e4)):
+        split_size=int(1e4),
+        db_index_dir=None):
 
     ctx = dict(mem=2, num_retry=3, mem_retry_increment=2, **docker_config)
 
     workflow = pypeliner.workflow.Workflow()
 
     workflow.transform(
-        name='split_vcf',
+        name='get_regions',
+        ret=mgd.TempOutputObj('regions_obj', 'regions'),
         ctx=ctx,
-        func='biowrappers.components.io.vcf.tasks.split_vcf',
+        func='biowrappers.components.io.vcf.tasks.get_vcf_split_regions',
         args=(
-            mgd.InputFile(target_vcf_file),
-            mgd.TempOutputFile('split.vcf', 'split')
+            mgd.InputFile(target_vcf_file, extensions=['.tbi']),
+            split_size,
         ),
-        kwargs={'lines_per_file': split_size}
     )
 
     workflow.transform(
         name='annotate_db_status',
-        axes=('split',),
+        axes=('regions',),
         ctx=ctx,
         func='biowrappers.components.variant_calling.annotated_db_status.tasks.annotate_db_status',
         args=(
             db_vcf_file,
-            mgd.TempInputFile('split.vcf', 'split'),
-            mgd.TempOutputFile('annotated.csv.gz', 'split',
+            mgd.InputFile(target_vcf_file, extensions=['.tbi']),
+            mgd.TempOutputFile('annotated.csv.gz', 'regions',
                                extensions=['.yaml'])
-        )
+        ),
+        kwargs={
+            'region': mgd.TempInputObj('regions_obj', 'regions'),
+            'db_index_dir': db_index_dir,
+        },
     )
 
     workflow.transform(
@@ -41,7 +46,7 @@ def create_vcf_db_annotation_workflow(
         ctx=ctx,
         func='single_cell.utils.csvutils.concatenate_csv',
         args=(
-            mgd.TempInputFile('annotated.csv.gz', 'split'),
+            mgd.TempInputFile('annotated.csv.gz', 'regions'),
             mgd.OutputFile(out_file, extensions=['.yaml'])
         )
     )
@@ -0,0 +1,296 @@
+'''
+Compact position index of a variant database such as COSMIC or dbSNP.
+
+The index is a directory of numpy arrays which are memory mapped when loaded, so concurrent jobs share the page cache
+instead of each decoding the database VCF. Records are stored sorted by position within each chromosome, with
+chromosome record ranges kept in a small JSON manifest:
+
+    pos           int64 position of each record
+    ref_hash      uint64 hash of the reference allele
+    indel         uint8 flag set for insertions and deletions
+    alt_offsets   int64 offsets of each record's alleles in alt_hash, with one extra entry
+    alt_hash      uint64 hash of each alternate allele
+    id_offsets    int64 offsets of each record's ID in ids, with one extra entry
+    ids           uint8 bytes of the concatenated IDs
+
+Indexes are built in a temporary directory and renamed into place, and the manifest is written after the arrays, so a
+directory with a manifest older than any of its arrays was not completely written.
+'''
+from array import array
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+import biowrappers.components.io.vcf.access as access
+
+index_version = 1
+
+manifest_file_name = 'manifest.json'
+
+array_names = ('pos', 'ref_hash', 'indel', 'alt_offsets', 'alt_hash', 'id_offsets', 'ids')
+
+
+def hash_allele(allele):
+    ''' Stable 64 bit hash of an allele string.
+    '''
+    return struct.unpack('<Q', hashlib.md5(allele.encode('utf-8')).digest()[:8])[0]
+
+
+def build_position_index(db_vcf_file, out_dir):
+    '''
+    Build the position index of a sorted database VCF in `out_dir`, replacing any existing index.
+    '''
+    out_dir = os.path.abspath(out_dir)
+
+    parent_dir = os.path.dirname(out_dir)
+
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_dir) + '.', dir=parent_dir)
+
+    try:
+        _write_position_index(db_vcf_file, tmp_dir)
+
+        os.chmod(tmp_dir, 0o755)
+
+        if os.path.exists(out_dir):
+            old_dir = tmp_dir + '.old'
+
+            os.rename(out_dir, old_dir)
+
+            os.rename(tmp_dir, out_dir)
+
+            shutil.rmtree(old_dir)
+
+        else:
+            os.rename(tmp_dir, out_dir)
+
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def _write_position_index(db_vcf_file, out_dir):
+    data = dict(
+        pos=array('q'),
+        ref_hash=array('Q'),
+        indel=array('B'),
+        alt_offsets=array('q', [0]),
+        alt_hash=array('Q'),
+        id_offsets=array('q', [0]),
+    )
+
+    ids = bytearray()
+
+    allele_hashes = {}
+
+    chroms = []
+
+    reader = access.open_reader(db_vcf_file, drop_samples=True)
+
+    for record in reader:
+        if (len(chroms) == 0) or (chroms[-1][0] != record.chrom):
+            chroms.append([record.chrom, len(data['pos']), len(data['pos'])])
+
+        chroms[-1][2] += 1
+
+        data['pos'].append(record.pos)
+
+        data['ref_hash'].append(_get_allele_hash(record.ref, allele_hashes))
+
+        data['indel'].append(int(access.is_indel(record)))
+
+        for alt in access.get_alts(record):
+            data['alt_hash'].append(_get_allele_hash(alt, allele_hashes))
+
+        data['alt_offsets'].append(len(data['alt_hash']))
+
+        if record.id is not None:
+            ids.extend(record.id.encode('utf-8'))
+
+        data['id_offsets'].append(len(ids))
+
+    reader.close()
+
+    arrays = dict((name, np.frombuffer(x, dtype=np.dtype(x.typecode))) for name, x in data.items())
+
+    arrays['ids'] = np.frombuffer(bytes(ids), dtype=np.uint8)
+
+    if len(set(x[0] for x in chroms)) != len(chroms):
+        raise ValueError('Chromosomes are not contiguous in {0}'.format(db_vcf_file))
+
+    # Database records are normally sorted, but records within a chromosome are only required to be grouped
+    for chrom, beg, end in chroms:
+        order = np.argsort(arrays['pos'][beg:end], kind='mergesort')
+
+        if np.any(order != np.arange(end - beg)):
+            _reorder_records(arrays, beg, end, order)
+
+    for name in array_names:
+        np.save(os.path.join(out_dir, name + '.npy'), arrays[name])
+
+    manifest = {
+        'version': index_version,
+        'source': _get_file_signature(db_vcf_file),
+        'chroms': dict((chrom, [beg, end]) for chrom, beg, end in chroms),
+    }
+
+    # Written last, see `PositionIndex`
+    with open(os.path.join(out_dir, manifest_file_name), 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+
+
+class PositionIndex(object):
+    '''
+    Memory mapped position index built by `build_position_index`.
+    '''
+
+    def __init__(self, index_dir):
+        manifest_file = os.path.join(index_dir, manifest_file_name)
+
+        with open(manifest_file) as fh:
+            manifest = json.load(fh)
+
+        if manifest['version'] != index_version:
+            raise ValueError('Position index {0} has version {1}, expected {2}'.format(
+                index_dir, manifest['version'], index_version))
+
+        self.chroms = manifest['chroms']
+
+        self.source = manifest['source']
+
+        manifest_time = os.path.getmtime(manifest_file)
+
+        for name in array_names:
+            array_file = os.path.join(index_dir, name + '.npy')
+
+            if os.path.getmtime(array_file) > manifest_time:
+                raise ValueError('Position index {0} is incomplete, {1} was written after the manifest'.format(
+                    index_dir, array_file))
+
+            setattr(self, name, np.load(array_file, mmap_mode='r'))
+
+    def is_current(self, db_vcf_file):
+        ''' Check if the index was built from the current version of a database file.
+        '''
+        return self.source == _get_file_signature(db_vcf_file)
+
+    def lookup(self, chrom, coords):
+        '''
+        Find the records at each of an array of positions on a chromosome.
+
+        Returns `target_idx`, the index into `coords`, and `record_idx`, the index of the record, for every match.
+        Matches are ordered by target and then by database order.
+        '''
+        coords = np.asarray(coords, dtype=np.int64)
+
+        if chrom not in self.chroms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        beg, end = self.chroms[chrom]
+
+        chrom_pos = self.pos[beg:end]
+
+        left = np.searchsorted(chrom_pos, coords, side='left')
+
+        right = np.searchsorted(chrom_pos, coords, side='right')
+
+        counts = right - left
+
+        target_idx = np.repeat(np.arange(len(coords)), counts)
+
+        record_idx = beg + expand_ranges(left, counts)
+
+        return target_idx, record_idx
+
+    def get_ids(self, record_idx):
+        id_begs = self.id_offsets[record_idx]
+
+        id_ends = self.id_offsets[record_idx + 1]
+
+        return [_decode_id(self.ids[beg:end].tobytes()) for beg, end in zip(id_begs, id_ends)]
+
+    def has_alt(self, record_idx, alt_hashes):
+        '''
+        Check if each record has the matching entry of `alt_hashes` as an alternate allele.
+        '''
+        alt_beg = self.alt_offsets[record_idx]
+
+        num_alts = self.alt_offsets[record_idx + 1] - alt_beg
+
+        pair_idx = np.repeat(np.arange(len(record_idx)), num_alts)
+
+        is_match = self.alt_hash[expand_ranges(alt_beg, num_alts)] == np.asarray(alt_hashes)[pair_idx]
+
+        return np.bincount(pair_idx[is_match], minlength=len(record_idx)) > 0
+
+
+def _decode_id(db_id):
+    if len(db_id) == 0:
+        return None
+
+    return db_id.decode('utf-8')
+
+
+def expand_ranges(begs, counts):
+    ''' Concatenate the ranges begs[i]:begs[i] + counts[i].
+    '''
+    begs = np.asarray(begs, dtype=np.int64)
+
+    counts = np.asarray(counts, dtype=np.int64)
+
+    range_begs = np.cumsum(counts) - counts
+
+    return np.repeat(begs, counts) + np.arange(counts.sum()) - np.repeat(range_begs, counts)
+
+
+def _get_allele_hash(allele, cache):
+    if allele not in cache:
+        cache[allele] = hash_allele(allele)
+
+    return cache[allele]
+
+
+def _get_file_signature(file_name):
+    stat = os.stat(file_name)
+
+    return [os.path.basename(file_name), stat.st_size, int(stat.st_mtime)]
+
+
+def _reorder_records(arrays, beg, end, order):
+    idx = beg + order
+
+    alt_beg = arrays['alt_offsets'][idx]
+
+    alt_counts = arrays['alt_offsets'][idx + 1] - alt_beg
+
+    id_beg = arrays['id_offsets'][idx]
+
+    id_counts = arrays['id_offsets'][idx + 1] - id_beg
+
+    for name in ('pos', 'ref_hash', 'indel'):
+        arrays[name] = arrays[name].copy()
+
+        arrays[name][beg:end] = arrays[name][idx]
+
+    for name, offsets_name, begs, counts in (('alt_hash', 'alt_offsets', alt_beg, alt_counts), ('ids', 'id_offsets', id_beg, id_counts)):
+        values = arrays[name].copy()
+
+        offsets = arrays[offsets_name].copy()
+
+        values_beg = offsets[beg]
+
+        values[values_beg:offsets[end]] = arrays[name][expand_ranges(begs, counts)]
+
+        offsets[beg + 1:end + 1] = values_beg + np.cumsum(counts)
+
+        arrays[name] = values
+
+        arrays[offsets_name] = offsets
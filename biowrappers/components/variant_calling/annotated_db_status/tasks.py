@@ -3,42 +3,111 @@ Created on Nov 2, 2015
 
 @author: Andrew Roth
 '''
+from collections import defaultdict
+
+import numpy as np
 import pandas as pd
-import vcf
+import warnings
 from single_cell.utils import csvutils
 
-def annotate_db_status(db_vcf_file, target_vcf_file, out_file):
-    db_reader = vcf.Reader(filename=db_vcf_file)
+import biowrappers.components.io.vcf._tabix as _tabix
+import biowrappers.components.io.vcf.access as access
+import biowrappers.components.variant_calling.utils as utils
+from biowrappers.components.variant_calling.annotated_db_status.position_index import PositionIndex, \
+    build_position_index, expand_ranges, hash_allele
 
-    reader = vcf.Reader(filename=target_vcf_file)
+out_columns = ['chrom', 'coord', 'ref', 'alt', 'db_id', 'exact_match', 'indel']
+
+
+def build_db_position_index(db_vcf_file, out_dir):
+    '''
+    Build a memory mappable position index of a database VCF for `annotate_db_status`, unless `out_dir` already holds
+    a complete index of the current database file.
+    '''
+    if _load_position_index(out_dir, db_vcf_file) is not None:
+        return
+
+    build_position_index(db_vcf_file, out_dir)
+
+
+def _load_position_index(index_dir, db_vcf_file):
+    ''' Load a position index, returning None if it is missing, incomplete or out of date with the database file.
+    '''
+    try:
+        db_index = PositionIndex(index_dir)
+
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not db_index.is_current(db_vcf_file):
+        return None
+
+    return db_index
 
-    data = []
+
+def annotate_db_status(
+        db_vcf_file,
+        target_vcf_file,
+        out_file,
+        region=None,
+        max_scan_gap=_tabix.linear_window_size,
+        db_index_dir=None):
+    '''
+    Annotate each alternate allele of the target records with the database records at the same position.
+
+    The database is joined to the targets of each chromosome in position order, streaming the database records between
+    consecutive targets so each BGZF block is decompressed once. A new fetch is only started when the gap to the next
+    target is more than `max_scan_gap` bases.
+
+    If `db_index_dir` is a position index built by `build_db_position_index` from the current database file all targets
+    are instead looked up in the memory mapped index at once, without reading the database VCF.
+    '''
+    reader = access.open_reader(target_vcf_file, drop_samples=True)
+
+    if region is not None:
+        chrom, beg, end = utils.parse_region_for_vcf(region)
+        reader = access.fetch_starts(reader, chrom, beg, end)
+
+    targets = []
+
+    target_positions = defaultdict(set)
 
     for record in reader:
-        chrom = record.CHROM
+        targets.append((record.chrom, record.pos, record.ref, access.get_alts(record)))
 
-        coord = record.POS
+        target_positions[record.chrom].add(record.pos)
 
-        try:
-            db_position_records = [x for x in db_reader.fetch(chrom, coord - 1, coord)]
+    if db_index_dir is not None:
+        db_index = _load_position_index(db_index_dir, db_vcf_file)
 
-        except ValueError:
-            db_position_records = []
+        if db_index is not None:
+            data = _annotate_from_index(db_index, targets)
 
-        for db_record in db_position_records:
+            csvutils.write_dataframe_to_csv_and_yaml(data, out_file, data.dtypes.to_dict(),
+                                                     write_header=True)
 
-            if (db_record.CHROM != chrom) or (db_record.POS != coord):
-                continue
+            return
 
-            if db_record.is_indel:
-                indel = 1
+        warnings.warn('Position index {0} is not a complete index of {1}, reading the database VCF'.format(
+            db_index_dir, db_vcf_file))
 
-            else:
-                indel = 0
+    db_reader = access.open_reader(db_vcf_file, drop_samples=True)
 
-            for alt in record.ALT:
+    db_records = {}
 
-                if (record.REF == db_record.REF) and (alt in db_record.ALT):
+    for chrom, positions in target_positions.items():
+        db_records[chrom] = _get_db_position_records(db_reader, chrom, sorted(positions), max_scan_gap)
+
+    data = []
+
+    for chrom, coord, ref, alts in targets:
+        db_position_records = db_records[chrom].get(coord, ())
+
+        for db_ref, db_alts, db_id, indel in db_position_records:
+
+            for alt in alts:
+
+                if (ref == db_ref) and (alt in db_alts):
                     exact_match = 1
 
                 else:
@@ -47,9 +116,9 @@ def annotate_db_status(db_vcf_file, target_vcf_file, out_file):
                 out_row = {
                     'chrom': chrom,
                     'coord': coord,
-                    'ref': record.REF,
-                    'alt': str(alt),
-                    'db_id': db_record.ID,
+                    'ref': ref,
+                    'alt': alt,
+                    'db_id': db_id,
                     'exact_match': exact_match,
                     'indel': indel
                 }
@@ -59,4 +128,121 @@ def annotate_db_status(db_vcf_file, target_vcf_file, out_file):
     data = pd.DataFrame(data)
 
     csvutils.write_dataframe_to_csv_and_yaml(data, out_file, data.dtypes.to_dict(),
-                                             write_header=True)
\ No newline at end of file
+                                             write_header=True)
+
+
+def _get_db_position_records(db_reader, chrom, positions, max_scan_gap):
+    '''
+    Merge join the sorted target `positions` of a chromosome with the database records starting at them.
+
+    Returns a dict from position to a list of (ref, alts, id, indel) tuples in database order.
+    '''
+    db_position_records = defaultdict(list)
+
+    if len(positions) == 0:
+        return db_position_records
+
+    end = positions[-1]
+
+    db_iter = None
+
+    db_record = None
+
+    for coord in positions:
+        if (db_iter is None) or ((db_record is not None) and (coord - db_record.pos > max_scan_gap)):
+            db_iter = access.fetch(db_reader, chrom, coord - 1, end)
+
+            db_record = next(db_iter, None)
+
+        while (db_record is not None) and (db_record.pos < coord):
+            db_record = next(db_iter, None)
+
+        while (db_record is not None) and (db_record.pos == coord):
+            if access.is_indel(db_record):
+                indel = 1
+
+            else:
+                indel = 0
+
+            db_position_records[coord].append((db_record.ref, access.get_alts(db_record), db_record.id, indel))
+
+            db_record = next(db_iter, None)
+
+    return db_position_records
+
+
+def _annotate_from_index(db_index, targets):
+    '''
+    Vectorised equivalent of the merge join for a position index.
+    '''
+    target_chroms = np.array([x[0] for x in targets], dtype=object)
+
+    target_coords = np.array([x[1] for x in targets], dtype=np.int64)
+
+    target_ref_hashes = np.array([hash_allele(x[2]) for x in targets], dtype=np.uint64)
+
+    target_alts = [alt for x in targets for alt in x[3]]
+
+    target_alt_hashes = np.array([hash_allele(x) for x in target_alts], dtype=np.uint64)
+
+    num_target_alts = np.array([len(x[3]) for x in targets], dtype=np.int64)
+
+    target_alt_offsets = np.cumsum(num_target_alts) - num_target_alts
+
+    target_idx = []
+
+    record_idx = []
+
+    for chrom in set(target_chroms):
+        chrom_target_idx = np.flatnonzero(target_chroms == chrom)
+
+        chrom_match_idx, chrom_record_idx = db_index.lookup(chrom, target_coords[chrom_target_idx])
+
+        target_idx.append(chrom_target_idx[chrom_match_idx])
+
+        record_idx.append(chrom_record_idx)
+
+    if len(targets) > 0:
+        target_idx = np.concatenate(target_idx)
+
+        record_idx = np.concatenate(record_idx)
+
+    else:
+        target_idx = record_idx = np.zeros(0, dtype=np.int64)
+
+    # Rows follow the target file order, keeping database order at each position
+    order = np.argsort(target_idx, kind='mergesort')
+
+    target_idx = target_idx[order]
+
+    record_idx = record_idx[order]
+
+    # One row per match and target alternate allele
+    pair_idx = np.repeat(np.arange(len(target_idx)), num_target_alts[target_idx])
+
+    alt_idx = expand_ranges(target_alt_offsets[target_idx], num_target_alts[target_idx])
+
+    row_target_idx = target_idx[pair_idx]
+
+    row_record_idx = record_idx[pair_idx]
+
+    if len(pair_idx) == 0:
+        return pd.DataFrame([])
+
+    ref_match = target_ref_hashes[row_target_idx] == db_index.ref_hash[row_record_idx]
+
+    alt_match = db_index.has_alt(row_record_idx, target_alt_hashes[alt_idx])
+
+    db_ids = np.array(db_index.get_ids(record_idx), dtype=object)
+
+    data = pd.DataFrame({
+        'chrom': target_chroms[row_target_idx],
+        'coord': target_coords[row_target_idx],
+        'ref': [targets[i][2] for i in row_target_idx],
+        'alt': [target_alts[i] for i in alt_idx],
+        'db_id': db_ids[pair_idx],
+        'exact_match': (ref_match & alt_match).astype(np.int64),
+        'indel': db_index.indel[row_record_idx].astype(np.int64),
+    })
+
+    return data[out_columns]
@@ -5,61 +5,127 @@ Created on Nov 2, 2015
 '''
 from bx.bbi.bigwig_file import BigWigFile
 
+import numpy as np
 import pandas as pd
-import vcf
 
+import biowrappers.components.io.vcf.access as access
 import biowrappers.components.variant_calling.utils as utils
 
-from single_cell.utils import csvutils
 
 def get_mappability(
         mappability_file,
         vcf_file,
         out_file,
         region=None,
-        append_chr=True):
+        append_chr=True,
+        window_size=100,
+        max_block_size=int(1e6)):
+    '''
+    Annotate VCF records with the mean mappability of the `window_size` bases either side of each position.
+
+    Rather than querying the bigWig per record, records are sorted and the bigWig data is read once for each block of at
+    most `max_block_size` bases covering nearby records. Window means over the block are computed from prefix sums of
+    the values and of the number of covered bases.
+    '''
+    # Only needed for the output, so the window computation can be used without single_cell installed
+    from single_cell.utils import csvutils
 
     map_reader = BigWigFile(open(mappability_file, 'rb'))
 
-    vcf_reader = vcf.Reader(filename=vcf_file)
+    vcf_reader = access.open_reader(vcf_file, drop_samples=True)
 
     if region is not None:
         chrom, beg, end = utils.parse_region_for_vcf(region)
-        try:
-            vcf_reader = vcf_reader.fetch(chrom, start=beg, end=end)
-        except ValueError:
-            print("no data for region {} in vcf".format(region))
-            vcf_reader = []
+        vcf_reader = access.fetch(vcf_reader, chrom, beg, end)
 
-    data = []
+    chroms = []
+
+    coords = []
 
     for record in vcf_reader:
-        if append_chr:
-            chrom = 'chr{0}'.format(record.CHROM)
+        chroms.append(record.chrom)
+
+        coords.append(record.pos)
 
-        else:
-            chrom = record.CHROM
+    if len(coords) == 0:
+        data = pd.DataFrame([])
 
-        coord = record.POS
+    else:
+        chroms = np.array(chroms, dtype=object)
 
-        beg = coord - 100
+        coords = np.array(coords, dtype=np.int64)
 
-        beg = max(beg, 0)
+        mappability = np.zeros(len(coords))
 
-        end = coord + 100
+        for chrom in pd.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
 
-        result = map_reader.query(chrom, beg, end, 1)
+            if append_chr:
+                map_chrom = 'chr{0}'.format(chrom)
 
-        if result is None:
-            mappability = 0
+            else:
+                map_chrom = chrom
 
-        else:
-            mappability = result[0]['mean']
+            mappability[idx] = _get_window_means(map_reader, map_chrom, coords[idx], window_size, max_block_size)
 
-        data.append({'chrom': record.CHROM, 'coord': record.POS, 'mappability': mappability})
+        data = pd.DataFrame({'chrom': chroms, 'coord': coords, 'mappability': mappability})
 
-    data = pd.DataFrame(data)
+        data = data[['chrom', 'coord', 'mappability']]
 
     csvutils.write_dataframe_to_csv_and_yaml(data, out_file, data.dtypes.to_dict()
                                              ,write_header=True)
 
+
+def _get_window_means(map_reader, chrom, coords, window_size, max_block_size):
+    '''
+    Mean bigWig value over the half open windows [coord - window_size, coord + window_size), clipped at 0. Windows
+    without data have mean NaN and chromosomes missing from the bigWig have mean 0, as with `BigWigFile.query`.
+    '''
+    order = np.argsort(coords, kind='mergesort')
+
+    begs = np.maximum(coords[order] - window_size, 0)
+
+    ends = coords[order] + window_size
+
+    means = np.zeros(len(coords))
+
+    # Unlike query, get_as_array only accepts the chromosome as bytes
+    if not isinstance(chrom, bytes):
+        chrom = chrom.encode('utf-8')
+
+    block_start = 0
+
+    while block_start < len(order):
+        block_beg = begs[block_start]
+
+        block_stop = np.searchsorted(ends, block_beg + max_block_size, side='right')
+
+        block_stop = max(block_stop, block_start + 1)
+
+        block_end = ends[block_stop - 1]
+
+        values = map_reader.get_as_array(chrom, int(block_beg), int(block_end))
+
+        if values is not None:
+            # Values are single precision, sum in double precision so long blocks do not accumulate rounding error
+            values = values.astype(np.float64)
+
+            is_valid = ~np.isnan(values)
+
+            value_sums = np.concatenate([[0], np.cumsum(np.where(is_valid, values, 0))])
+
+            valid_counts = np.concatenate([[0], np.cumsum(is_valid)])
+
+            window_begs = begs[block_start:block_stop] - block_beg
+
+            window_ends = ends[block_start:block_stop] - block_beg
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means[order[block_start:block_stop]] = (
+                    (value_sums[window_ends] - value_sums[window_begs]) /
+                    (valid_counts[window_ends] - valid_counts[window_begs])
+                )
+
+        block_start = block_stop
+
+    return means
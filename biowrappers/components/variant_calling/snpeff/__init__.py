@@ -12,7 +12,14 @@ def create_snpeff_annotation_workflow(
         snpeff_docker={},
         classic_mode=True,
         split_size=int(1e3),
-        table_name='snpeff'):
+        table_name='snpeff',
+        annotated_vcf_file=None,
+        use_server=False):
+    ''' Annotate a VCF with snpEff and write the annotations as a table.
+
+    snpEff output is parsed as it is produced, the annotated VCF is only kept if `annotated_vcf_file` is given. With
+    `use_server` the jobs on a node share one snpEff process, see `biowrappers.components.variant_calling.snpeff.server`.
+    '''
 
     ctx = {'num_retry': 3, 'mem_retry_increment': 2}
 
@@ -32,35 +39,32 @@ def create_snpeff_annotation_workflow(
         kwargs={'lines_per_file': split_size}
     )
 
+    if annotated_vcf_file is None:
+        split_annotated_vcf_file = None
+
+    else:
+        split_annotated_vcf_file = mgd.TempOutputFile('snpeff.vcf', 'split')
+
     workflow.transform(
         name='run_snpeff',
         axes=('split',),
         ctx=dict(mem=8, **ctx),
-        func='biowrappers.components.variant_calling.snpeff.tasks.run_snpeff',
+        func='biowrappers.components.variant_calling.snpeff.tasks.run_snpeff_to_table',
         args=(
             db,
             data_dir,
             mgd.TempInputFile('split.vcf', 'split'),
-            mgd.TempOutputFile('snpeff.vcf', 'split')
+            mgd.TempOutputFile('snpeff.csv.gz', 'split', extensions=['.yaml']),
+            table_name
         ),
         kwargs={
+            'annotated_vcf_file': split_annotated_vcf_file,
             'classic_mode': classic_mode,
-            'docker_config': snpeff_docker
+            'docker_config': snpeff_docker,
+            'use_server': use_server
         }
     )
 
-    workflow.transform(
-        name='convert_vcf_to_csv',
-        axes=('split',),
-        ctx=dict(mem=4, **ctx),
-        func='biowrappers.components.variant_calling.snpeff.tasks.convert_vcf_to_table',
-        args=(
-            mgd.TempInputFile('snpeff.vcf', 'split'),
-            mgd.TempOutputFile('snpeff.csv.gz', 'split', extensions=['.yaml']),
-            table_name
-        )
-    )
-
     workflow.transform(
         name='concatenate_tables',
         ctx=dict(mem=4, **ctx),
@@ -71,4 +75,15 @@ def create_snpeff_annotation_workflow(
         )
     )
 
+    if annotated_vcf_file is not None:
+        workflow.transform(
+            name='concatenate_vcfs',
+            ctx=dict(mem=2, **ctx),
+            func='biowrappers.components.io.vcf.tasks.concatenate_vcf',
+            args=(
+                mgd.TempInputFile('snpeff.vcf', 'split'),
+                mgd.OutputFile(annotated_vcf_file, extensions=['.tbi', '.csi'])
+            )
+        )
+
     return workflow
\ No newline at end of file
@@ -3,20 +3,26 @@ Created on 3 Apr 2017
 
 @author: Andrew Roth
 '''
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
+import pandas as pd
 import re
-import vcf
+
+import biowrappers.components.io.vcf.access as access
 
 
 class SnpEffParser(object):
 
+    info_field = 'ANN'
+
     def __init__(self, file_name):
-        self._reader = vcf.Reader(filename=file_name)
+        self._reader = access.open_reader(file_name, drop_samples=True)
 
         self.fields = self._get_field_names()
 
-        self._buffer = []
+        self.columns = ['chrom', 'coord', 'ref', 'alt'] + self.fields
+
+        self._buffer = deque()
 
     def __iter__(self):
         while True:
@@ -29,18 +35,30 @@ class SnpEffParser(object):
         while len(self._buffer) == 0:
             record = next(self._reader)
 
-            if 'ANN' not in record.INFO:
+            if self.info_field not in record.info:
                 continue
 
-            for row in self._parse_record(record):
-                self._buffer.append(row)
+            for values in self._parse_record(record):
+                self._buffer.append(OrderedDict(zip(self.columns, values)))
+
+        return self._buffer.popleft()
 
-        return self._buffer.pop(0)
+    __next__ = next
+
+    def close(self):
+        self._reader.close()
+
+    def iter_chunks(self, chunk_size=int(1e5)):
+        '''
+        Iterate over the annotations as DataFrames of about `chunk_size` rows, built from per column buffers. Should not
+        be mixed with row iteration on the same parser.
+        '''
+        return _iter_column_chunks(self, chunk_size)
 
     def _get_field_names(self):
         fields = []
 
-        match = re.search(":(.*)", self._reader.infos['ANN'].desc).groups()[0].replace("'", "")
+        match = re.search(":(.*)", self._reader.header.info['ANN'].description).groups()[0].replace("'", "")
 
         for x in match.split('|'):
             fields.append(x.strip().lower())
@@ -48,30 +66,28 @@ class SnpEffParser(object):
         return fields
 
     def _parse_record(self, record):
-        for annotation in record.INFO['ANN']:
-            out_row = OrderedDict((
-                ('chrom', record.CHROM),
-                ('coord', record.POS),
-                ('ref', record.REF),
-                ('alt', ','.join([str(x) for x in record.ALT])),
-            ))
+        site = [record.chrom, record.pos, record.ref, ','.join(access.get_alts(record))]
 
-            fields = annotation.split('|')
+        num_fields = len(self.fields)
 
-            for i, key in enumerate(self.fields):
-                out_row[key] = fields[i]
+        for annotation in record.info['ANN']:
+            fields = annotation.split('|')
 
-            yield out_row
+            yield site + [fields[i] for i in range(num_fields)]
 
 
 class ClassicSnpEffParser(object):
 
+    info_field = 'EFF'
+
     def __init__(self, file_name):
-        self._reader = vcf.Reader(filename=file_name)
+        self._reader = access.open_reader(file_name, drop_samples=True)
 
         self.fields = self._get_field_names()
 
-        self._buffer = []
+        self.columns = ['chrom', 'coord', 'ref', 'alt', 'effect'] + self.fields
+
+        self._buffer = deque()
 
         self._effect_matcher = re.compile(r'(.*)\(')
 
@@ -88,18 +104,30 @@ class ClassicSnpEffParser(object):
         while len(self._buffer) == 0:
             record = next(self._reader)
 
-            if 'EFF' not in record.INFO:
+            if self.info_field not in record.info:
                 continue
 
-            for row in self._parse_record(record):
-                self._buffer.append(row)
+            for values in self._parse_record(record):
+                self._buffer.append(OrderedDict(zip(self.columns, values)))
+
+        return self._buffer.popleft()
 
-        return self._buffer.pop(0)
+    __next__ = next
+
+    def close(self):
+        self._reader.close()
+
+    def iter_chunks(self, chunk_size=int(1e5)):
+        '''
+        Iterate over the annotations as DataFrames of about `chunk_size` rows, built from per column buffers. Should not
+        be mixed with row iteration on the same parser.
+        '''
+        return _iter_column_chunks(self, chunk_size)
 
     def _get_field_names(self):
         fields = []
 
-        match = re.search(r'\((.*)\[', self._reader.infos['EFF'].desc)
+        match = re.search(r'\((.*)\[', self._reader.header.info['EFF'].description)
 
         for x in match.groups()[0].split('|'):
             fields.append(x.strip().lower())
@@ -107,20 +135,45 @@ class ClassicSnpEffParser(object):
         return fields
 
     def _parse_record(self, record):
-        for annotation in record.INFO['EFF']:
-            effect = self._effect_matcher.search(annotation).groups()[0]
+        site = [record.chrom, record.pos, record.ref, ','.join(access.get_alts(record))]
 
-            out_row = OrderedDict((
-                ('chrom', record.CHROM),
-                ('coord', record.POS),
-                ('ref', record.REF),
-                ('alt', ','.join([str(x) for x in record.ALT])),
-                ('effect', effect),
-            ))
+        num_fields = len(self.fields)
+
+        for annotation in record.info['EFF']:
+            effect = self._effect_matcher.search(annotation).groups()[0]
 
             fields = self._fields_matcher.search(annotation).groups()[0].split('|')
 
-            for i, key in enumerate(self.fields):
-                out_row[key] = fields[i]
+            yield site + [effect] + [fields[i] for i in range(num_fields)]
+
+
+def _iter_column_chunks(parser, chunk_size):
+    columns = parser.columns
+
+    buffers = [[] for _ in columns]
+
+    num_rows = 0
+
+    for record in parser._reader:
+        if parser.info_field not in record.info:
+            continue
+
+        for values in parser._parse_record(record):
+            for buf, value in zip(buffers, values):
+                buf.append(value)
+
+            num_rows += 1
+
+        if num_rows >= chunk_size:
+            yield _build_chunk(columns, buffers)
+
+            buffers = [[] for _ in columns]
+
+            num_rows = 0
+
+    if num_rows > 0:
+        yield _build_chunk(columns, buffers)
+
 
-            yield out_row
+def _build_chunk(columns, buffers):
+    return pd.DataFrame(OrderedDict(zip(columns, buffers)), columns=columns)
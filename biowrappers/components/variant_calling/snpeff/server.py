@@ -0,0 +1,565 @@
+'''
+Persistent snpEff worker shared by the jobs on a node.
+
+Every snpEff run pays for a JVM start up and a load of the genome database, which for small inputs takes longer than the
+annotation itself. A server process keeps one snpEff instance reading VCF records from stdin, and jobs send it the
+paths of their input and output files over a unix socket. The socket lives in the abstract namespace, so it is local to
+the node and disappears with the server. Abstract sockets have no file permissions, so the server checks the
+credentials of each connection and only serves processes of its own user, and only writes the temporary output file
+named after the client's pid. The first job to find no server starts one, and the server exits after
+`idle_timeout` seconds without requests. Requests are served concurrently by a pool of `num_workers` snpEff processes,
+which are started as they are first needed, so a node runs at most `num_workers` snpEff instances at a time.
+
+The server is started by the job which first needs it and is not known to the cluster scheduler. On SLURM or SGE it
+runs inside the cgroup of that job, so it is killed when the job ends and its memory counts against the job's request.
+Clients which lose the server, wait longer than `timeout` seconds for a response or get an error back, get a
+`socket.error` and are expected to run snpEff themselves.
+
+Chunks are separated in the snpEff input by a marker record on an unknown chromosome, with as many columns as the
+header, so the annotated records of each chunk can be split back out of the output stream. This relies on snpEff,
+which is given `-` as input and run with `-noStats` so it does not hold records back for a summary, writing out each
+record, including the marker, before it reads the next chunk. If the marker is not written within the timeout of the
+request the snpEff process is killed and the request fails, so the client runs snpEff itself and the worker does not
+wait forever. snpEff is restarted whenever a chunk has a
+different header from the one it was started with.
+'''
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+
+except ImportError:
+    import SocketServer as socketserver
+
+marker_chrom = b'__snpeff_worker_chunk__'
+
+# Linux value of SO_PEERCRED, which is missing from the socket module of Python 2
+_so_peercred = getattr(socket, 'SO_PEERCRED', 17)
+
+
+def get_address(cmd):
+    ''' Socket address of the server running a snpEff command, which is unique per user and command.
+    '''
+    key = json.dumps([os.getuid(), cmd])
+
+    return '\0biowrappers.snpeff.{0}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def annotate(cmd, in_file, out_file, idle_timeout=600, start_timeout=300, timeout=3600, num_workers=2):
+    ''' Annotate a VCF file using the server for a snpEff command, starting the server if it is not running.
+
+    Raises a `socket.error` if the server can not be reached, does not respond in time or fails to annotate the file,
+    in which case `out_file` is not created.
+
+    :param cmd: snpEff command line without the input file.
+
+    :param idle_timeout: Seconds without requests before a newly started server exits.
+
+    :param start_timeout: Seconds to wait for a newly started server to accept connections.
+
+    :param timeout: Seconds to wait for the server to annotate the file, including time queued behind other requests.
+
+    :param num_workers: Number of snpEff processes of a newly started server.
+
+    '''
+    address = get_address(cmd)
+
+    sock = _connect(address)
+
+    if sock is None:
+        _start_server(cmd, idle_timeout, num_workers)
+
+        start_time = time.time()
+
+        while sock is None:
+            if time.time() - start_time > start_timeout:
+                raise socket.timeout('snpEff server for `{0}` did not start'.format(' '.join(cmd)))
+
+            time.sleep(0.1)
+
+            sock = _connect(address)
+
+    # The server writes to a temporary file, so a server which is still running after the client gives up does not
+    # write to the output of a fallback run
+    tmp_file = '{0}.{1}.tmp'.format(os.path.abspath(out_file), os.getpid())
+
+    request = {'in_file': os.path.abspath(in_file), 'out_file': tmp_file, 'timeout': timeout}
+
+    sock.settimeout(timeout)
+
+    try:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with sock.makefile('rb') as fh:
+            response = fh.readline()
+
+    except socket.error:
+        _remove(tmp_file)
+
+        raise
+
+    finally:
+        sock.close()
+
+    if len(response) == 0:
+        _remove(tmp_file)
+
+        raise socket.error('snpEff server for `{0}` closed the connection'.format(' '.join(cmd)))
+
+    response = json.loads(response.decode('utf-8'))
+
+    if response['status'] != 'ok':
+        _remove(tmp_file)
+
+        raise socket.error('snpEff server failed to annotate {0}. {1}'.format(in_file, response['message']))
+
+    os.rename(tmp_file, out_file)
+
+
+def serve(cmd, idle_timeout=600, num_workers=2):
+    ''' Run a server for a snpEff command until it has been idle for `idle_timeout` seconds. Returns immediately if a
+    server for the command is already running.
+    '''
+    try:
+        server = _SnpEffServer(get_address(cmd), cmd, num_workers)
+
+    except socket.error:
+        return
+
+    server.timeout = idle_timeout
+
+    try:
+        while not server.is_idle:
+            server.handle_request()
+
+    finally:
+        server.server_close()
+
+        for worker in server.workers:
+            worker.close()
+
+
+class SnpEffWorker(object):
+    '''
+    Long running snpEff process annotating a stream of VCF chunks.
+    '''
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+        self._proc = None
+
+        self._in_header = None
+
+        self._out_header = None
+
+        self._log = None
+
+        self._num_chunks = 0
+
+    def annotate(self, in_file, out_file, timeout=None):
+        ''' Annotate a VCF file. If `timeout` is given and snpEff has not finished the file after `timeout` seconds,
+        snpEff is killed and an exception raised.
+        '''
+        in_fh = _open_vcf(in_file)
+
+        try:
+            self._annotate(in_fh, out_file, timeout)
+
+        except Exception:
+            # The snpEff streams are in an unknown state, so start a new process for the next chunk
+            self.close(kill=True)
+
+            raise
+
+        finally:
+            in_fh.close()
+
+    def _annotate(self, in_fh, out_file, timeout):
+        header = []
+
+        line = in_fh.readline()
+
+        while line.startswith(b'#'):
+            header.append(line)
+
+            line = in_fh.readline()
+
+        if (self._proc is None) or (self._proc.poll() is not None) or (header != self._in_header):
+            self._start(header)
+
+        self._num_chunks += 1
+
+        marker_id = 'chunk_{0}'.format(self._num_chunks).encode('ascii')
+
+        marker_fields = [marker_chrom, b'1', marker_id, b'N', b'.', b'.', b'.', b'.']
+
+        # Match the columns of the header, so inputs with sample columns get a valid marker record
+        if len(header) > 0:
+            num_columns = len(header[-1].rstrip(b'\n').split(b'\t'))
+
+            marker_fields.extend([b'.'] * (num_columns - len(marker_fields)))
+
+        marker = b'\t'.join(marker_fields) + b'\n'
+
+        errors = []
+
+        def write():
+            try:
+                for record in itertools.chain([line], in_fh):
+                    if len(record) == 0:
+                        continue
+
+                    if not record.endswith(b'\n'):
+                        record += b'\n'
+
+                    self._proc.stdin.write(record)
+
+                self._proc.stdin.write(marker)
+
+                self._proc.stdin.flush()
+
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=write)
+
+        thread.daemon = True
+
+        thread.start()
+
+        # Kill snpEff if the marker does not come back, which ends its output and fails the chunk
+        watchdog = None
+
+        if timeout is not None:
+            watchdog = threading.Timer(timeout, self._kill, args=(self._proc,))
+
+            watchdog.daemon = True
+
+            watchdog.start()
+
+        try:
+            is_complete = self._write_output(out_file, marker_id)
+
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+
+        thread.join()
+
+        if not is_complete:
+            raise Exception('snpEff exited or timed out before annotating the file. {0}'.format(self._get_log_tail()))
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _write_output(self, out_file, marker_id):
+        ''' Write the output records up to the chunk marker. Returns False if the output ends first.
+        '''
+        with open(out_file, 'wb') as out_fh:
+            is_header_written = False
+
+            for out_line in self._iter_output():
+                if not is_header_written:
+                    out_fh.writelines(self._out_header)
+
+                    is_header_written = True
+
+                if out_line.startswith(marker_chrom + b'\t'):
+                    if out_line.split(b'\t', 3)[2] != marker_id:
+                        raise Exception('snpEff output is out of step with its input')
+
+                    return True
+
+                out_fh.write(out_line)
+
+        return False
+
+    def _kill(self, proc):
+        if proc.poll() is None:
+            proc.kill()
+
+    def close(self, kill=False):
+        if self._proc is not None:
+            if kill and (self._proc.poll() is None):
+                self._proc.kill()
+
+            try:
+                self._proc.stdin.close()
+
+            except (IOError, OSError):
+                pass
+
+            self._proc.wait()
+
+            self._proc.stdout.close()
+
+            self._log.close()
+
+        self._proc = None
+
+        self._out_header = None
+
+    def _start(self, header):
+        self.close()
+
+        self._log = tempfile.TemporaryFile()
+
+        self._proc = subprocess.Popen(
+            self.cmd + ['-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._log,
+        )
+
+        self._in_header = header
+
+        self._proc.stdin.writelines(header)
+
+    def _iter_output(self):
+        ''' Iterate over the output record lines, reading the header snpEff writes with the first record.
+        '''
+        readline = self._proc.stdout.readline
+
+        if self._out_header is None:
+            self._out_header = []
+
+            for line in iter(readline, b''):
+                if not line.startswith(b'#'):
+                    yield line
+
+                    break
+
+                self._out_header.append(line)
+
+        for line in iter(readline, b''):
+            yield line
+
+    def _get_log_tail(self, size=4096):
+        self._log.seek(0, os.SEEK_END)
+
+        self._log.seek(max(self._log.tell() - size, 0))
+
+        return self._log.read().decode('utf-8', 'replace')
+
+
+class _SnpEffServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    request_queue_size = 128
+
+    def __init__(self, address, cmd, num_workers):
+        socketserver.UnixStreamServer.__init__(self, address, _SnpEffRequestHandler)
+
+        self.is_idle = False
+
+        self.workers = [SnpEffWorker(cmd) for _ in range(num_workers)]
+
+        self.idle_workers = queue.Queue()
+
+        for worker in self.workers:
+            self.idle_workers.put(worker)
+
+        self._num_active = 0
+
+        self._lock = threading.Lock()
+
+    def verify_request(self, request, client_address):
+        # Only serve processes of the same user, as the server reads and writes files with its permissions
+        return _get_peer_credentials(request)[1] == os.getuid()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._num_active += 1
+
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+
+        finally:
+            with self._lock:
+                self._num_active -= 1
+
+    def handle_timeout(self):
+        # Requests still being annotated keep the server alive
+        with self._lock:
+            if self._num_active == 0:
+                self.is_idle = True
+
+
+class _SnpEffRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = self.rfile.readline()
+
+        # Connections closed without a request, such as checks that the server is running
+        if len(request) == 0:
+            return
+
+        try:
+            request = json.loads(request.decode('utf-8'))
+
+            _check_request(request, _get_peer_credentials(self.connection)[0])
+
+        except Exception as e:
+            self.wfile.write((json.dumps({'status': 'error', 'message': str(e)}) + '\n').encode('utf-8'))
+
+            return
+
+        worker = self.server.idle_workers.get()
+
+        try:
+            # Skip requests whose client gave up while they were queued
+            if _is_closed(self.connection):
+                return
+
+            worker.annotate(request['in_file'], request['out_file'], timeout=request['timeout'])
+
+            response = {'status': 'ok'}
+
+        except Exception as e:
+            response = {'status': 'error', 'message': str(e)}
+
+        finally:
+            self.server.idle_workers.put(worker)
+
+        if _is_closed(self.connection):
+            _remove(request['out_file'])
+
+            return
+
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def _connect(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(address)
+
+    except socket.error:
+        sock.close()
+
+        return None
+
+    return sock
+
+
+def _check_request(request, client_pid):
+    ''' Check a request only writes the temporary output file `annotate` builds for the client, an absolute path ending
+    in the pid of the client.
+    '''
+    in_file = request['in_file']
+
+    out_file = request['out_file']
+
+    if not os.path.isabs(in_file):
+        raise ValueError('Input file {0} is not an absolute path'.format(in_file))
+
+    suffix = '.{0}.tmp'.format(client_pid)
+
+    if (not os.path.isabs(out_file)) or (os.path.normpath(out_file) != out_file) or (not out_file.endswith(suffix)):
+        raise ValueError('Output file {0} is not a temporary file of process {1}'.format(out_file, client_pid))
+
+    if request.get('timeout') is not None:
+        request['timeout'] = float(request['timeout'])
+
+    else:
+        request['timeout'] = None
+
+
+def _get_peer_credentials(sock):
+    ''' Get the pid, uid and gid of the process at the other end of a unix socket.
+    '''
+    return struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, _so_peercred, struct.calcsize('3i')))
+
+
+def _is_closed(sock):
+    ''' Check if the client has closed its end of a connection. Clients send nothing after the request, so a readable
+    socket means the connection was closed.
+    '''
+    if len(select.select([sock], [], [], 0)[0]) == 0:
+        return False
+
+    try:
+        return len(sock.recv(1, socket.MSG_PEEK)) == 0
+
+    except socket.error:
+        return True
+
+
+def _remove(file_name):
+    try:
+        os.remove(file_name)
+
+    except OSError:
+        pass
+
+
+def _start_server(cmd, idle_timeout, num_workers):
+    # The server runs in its own session so it outlives the job which started it, but not an allocation the cluster
+    # scheduler cleans up when that job ends
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [
+                sys.executable,
+                '-m',
+                __name__,
+                '--idle_timeout',
+                str(idle_timeout),
+                '--num_workers',
+                str(num_workers),
+                json.dumps(cmd)
+            ],
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            preexec_fn=os.setsid,
+        )
+
+
+def _open_vcf(in_file):
+    with open(in_file, 'rb') as fh:
+        is_compressed = fh.read(2) == b'\x1f\x8b'
+
+    if is_compressed:
+        return gzip.open(in_file, 'rb')
+
+    return open(in_file, 'rb')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('cmd')
+
+    parser.add_argument('--idle_timeout', type=float, default=600)
+
+    parser.add_argument('--num_workers', type=int, default=2)
+
+    args = parser.parse_args()
+
+    serve(json.loads(args.cmd), idle_timeout=args.idle_timeout, num_workers=args.num_workers)
@@ -4,19 +4,73 @@ Created on Nov 2, 2015
 @author: Andrew Roth
 '''
 
+import errno
+import itertools
 import pandas as pd
 import pypeliner
 import os
-import vcf
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import warnings
 
 import biowrappers.components.variant_calling.snpeff.parser
+import biowrappers.components.variant_calling.snpeff.server
 
 from single_cell.utils import csvutils
 
-def run_snpeff(db, data_dir, in_vcf_file, out_file, classic_mode=True, docker_config={}):
+def run_snpeff(
+        db,
+        data_dir,
+        in_vcf_file,
+        out_file,
+        classic_mode=True,
+        docker_config={},
+        use_server=False,
+        server_timeout=3600):
+    """ Annotate a VCF file with snpEff.
+
+    :param use_server: If True the file is sent to a snpEff server shared by the jobs on the node, which is started if
+        it is not running, so the JVM start up and database load are paid once per node rather than once per file. The
+        server runs the local snpEff install so this cannot be combined with `docker_config`.
+
+    :param server_timeout: Seconds to wait for the server before running snpEff in this job instead. snpEff is also run
+        in this job if the server can not be reached or fails to annotate the file.
+
+    """
 
     os.environ['MALLOC_ARENA_MAX'] = '2'
 
+    if use_server:
+        if docker_config:
+            raise ValueError('The snpEff server does not support running snpEff with docker')
+
+        cmd = _get_snpeff_cmd(db, os.path.abspath(data_dir), classic_mode)
+
+        try:
+            biowrappers.components.variant_calling.snpeff.server.annotate(
+                cmd, in_vcf_file, out_file, timeout=server_timeout)
+
+            return
+
+        except socket.error as e:
+            warnings.warn('snpEff server failed, running snpEff in the job. {0}'.format(e))
+
+    cmd = _get_snpeff_cmd(db, data_dir, classic_mode)
+
+    cmd.extend([
+        in_vcf_file,
+        '>',
+        out_file
+    ])
+
+    pypeliner.commandline.execute(*cmd, **docker_config)
+
+
+def _get_snpeff_cmd(db, data_dir, classic_mode):
     cmd = [
         'snpEff',
         '-noStats',
@@ -31,29 +85,174 @@ def run_snpeff(db, data_dir, in_vcf_file, out_file, classic_mode=True, docker_co
     if classic_mode:
         cmd.append('-classic')
 
-    cmd.extend([
+    cmd.append(db)
+
+    return cmd
+
+
+def run_snpeff_to_table(
         db,
+        data_dir,
         in_vcf_file,
-        '>',
-        out_file
-    ])
+        out_file,
+        table_name,
+        annotated_vcf_file=None,
+        classic_mode=True,
+        chunk_size=int(1e5),
+        docker_config={},
+        use_server=False):
+    """ Run snpEff and convert its annotations to a table in one task.
 
-    pypeliner.commandline.execute(*cmd, **docker_config)
+    snpEff writes to a named pipe which is parsed as the output is produced, so the annotated VCF never touches the disk.
+    If `annotated_vcf_file` is given the annotated VCF is instead written there and then converted.
+
+    """
+    if annotated_vcf_file is not None:
+        run_snpeff(db, data_dir, in_vcf_file, annotated_vcf_file, classic_mode=classic_mode, docker_config=docker_config,
+                   use_server=use_server)
+
+        convert_vcf_to_table(annotated_vcf_file, out_file, table_name, classic_mode=classic_mode, chunk_size=chunk_size)
+
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_file) + '.', dir=os.path.dirname(os.path.abspath(out_file)))
+
+    pipe_file = os.path.join(tmp_dir, 'snpeff.vcf')
+
+    os.mkfifo(pipe_file)
+
+    errors = []
+
+    is_parsed = threading.Event()
+
+    def run():
+        try:
+            run_snpeff(db, data_dir, in_vcf_file, pipe_file, classic_mode=classic_mode, docker_config=docker_config,
+                       use_server=use_server)
 
+        except Exception as e:
+            errors.append(e)
 
-def convert_vcf_to_table(in_file, out_file, table_name, classic_mode=True):
-    data = []
+            _release_pipe(pipe_file, is_parsed)
 
+    thread = threading.Thread(target=run)
+
+    thread.daemon = True
+
+    thread.start()
+
+    try:
+        convert_vcf_to_table(pipe_file, out_file, table_name, classic_mode=classic_mode, chunk_size=chunk_size)
+
+    except Exception:
+        is_parsed.set()
+
+        # The parser may have failed before opening the pipe, drain it so snpEff is not left waiting for a reader
+        _drain_pipe(pipe_file, thread)
+
+        # A failed snpEff run usually shows up first as a truncated VCF, report the snpEff error instead
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        raise
+
+    finally:
+        is_parsed.set()
+
+        thread.join()
+
+        shutil.rmtree(tmp_dir)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def _release_pipe(pipe_file, is_parsed):
+    """ Open and close the write end of a named pipe, so a reader waiting to open it sees an empty file if the writer
+    failed before opening it.
+    """
+    while not is_parsed.is_set():
+        try:
+            os.close(os.open(pipe_file, os.O_WRONLY | os.O_NONBLOCK))
+
+            return
+
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+
+        time.sleep(0.1)
+
+
+def _drain_pipe(pipe_file, thread):
+    """ Read and discard the output written to a named pipe until the writing thread finishes. The read end is opened
+    non-blocking, so this does not wait for the writer to open the pipe.
+    """
+    fd = os.open(pipe_file, os.O_RDONLY | os.O_NONBLOCK)
+
+    try:
+        while thread.is_alive():
+            if fd in select.select([fd], [], [], 0.1)[0]:
+                # Reads give no data until the writer has opened the pipe
+                if len(os.read(fd, 2 ** 16)) > 0:
+                    continue
+
+            thread.join(0.1)
+
+    finally:
+        os.close(fd)
+
+
+def convert_vcf_to_table(in_file, out_file, table_name, classic_mode=True, chunk_size=int(1e5)):
+    """ Convert the snpEff annotations of a VCF to a table with one row per annotation.
+
+    Annotations are parsed into column buffers and written in chunks of about `chunk_size` rows, so memory does not
+    grow with the number of annotations. Chunks are written to a temporary directory next to `out_file` and then
+    concatenated.
+
+    """
     if classic_mode:
         parser = biowrappers.components.variant_calling.snpeff.parser.ClassicSnpEffParser(in_file)
 
     else:
         parser = biowrappers.components.variant_calling.snpeff.parser.SnpEffParser(in_file)
 
-    for row in parser:
-        data.append(row)
+    try:
+        _write_table_chunks(parser.iter_chunks(chunk_size), out_file)
+
+    finally:
+        parser.close()
+
+
+def _write_table_chunks(chunks, out_file):
+    chunks = iter(chunks)
+
+    data = next(chunks, None)
+
+    if data is None:
+        data = pd.DataFrame([])
+
+    next_data = next(chunks, None)
+
+    if next_data is None:
+        csvutils.write_dataframe_to_csv_and_yaml(data, out_file, data.dtypes.to_dict(),
+                                                 write_header=True)
+
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_file) + '.', dir=os.path.dirname(os.path.abspath(out_file)))
+
+    try:
+        chunk_files = {}
+
+        for chunk_idx, data in enumerate(itertools.chain([data, next_data], chunks)):
+            chunk_files[chunk_idx] = os.path.join(tmp_dir, '{0}.csv.gz'.format(chunk_idx))
+
+            csvutils.write_dataframe_to_csv_and_yaml(data, chunk_files[chunk_idx], data.dtypes.to_dict(),
+                                                     write_header=True)
 
-    data = pd.DataFrame(data)
+        csvutils.concatenate_csv(chunk_files, out_file)
 
-    csvutils.write_dataframe_to_csv_and_yaml(data, out_file, data.dtypes.to_dict(),
-                                             write_header=True)
\ No newline at end of file
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,6 +1,7 @@
 import pypeliner
 import pypeliner.managed as mgd
 import biowrappers
+import biowrappers.components.utils
 
 default_chromosomes = [str(x) for x in range(1, 23)] + ['X', 'Y']
 
@@ -8,12 +9,16 @@ default_chromosomes = [str(x) for x in range(1, 23)] + ['X', 'Y']
 sml_ctx = {'mem': 2, 'num_retry': 3, 'mem_retry_increment': 2}
 med_ctx = {'mem': 4, 'num_retry': 3, 'mem_retry_increment': 4}
 
+merge_ctx = dict(med_ctx, **biowrappers.components.utils.merge_ctx)
+
 
 def create_snv_allele_counts_for_vcf_targets_workflow(
         bam_file,
         vcf_file,
         out_file,
         chromosomes=default_chromosomes,
+        complevel=1,
+        complib='blosc',
         count_duplicates=False,
         hdf5_output=True,
         min_bqual=0,
@@ -55,6 +60,8 @@ def create_snv_allele_counts_for_vcf_targets_workflow(
             table_name
         ),
         kwargs={
+            'complevel': complevel,
+            'complib': complib,
             'count_duplicates': count_duplicates,
             'min_bqual': min_bqual,
             'min_mqual': min_mqual,
@@ -65,7 +72,7 @@ def create_snv_allele_counts_for_vcf_targets_workflow(
 
     workflow.transform(
         name='merge_snv_allele_counts',
-        ctx=med_ctx,
+        ctx=merge_ctx,
         func='biowrappers.components.io.hdf5.tasks.concatenate_tables',
         args=(
             mgd.TempInputFile('counts.h5', 'regions'),
@@ -73,6 +80,7 @@ def create_snv_allele_counts_for_vcf_targets_workflow(
         ),
         kwargs={
             'in_memory': False,
+            'num_workers': merge_ctx['ncpus'],
         }
     )
 
@@ -99,6 +107,8 @@ def create_snv_allele_counts_workflow(
         out_file,
         table_name,
         chromosomes=default_chromosomes,
+        complevel=1,
+        complib='blosc',
         count_duplicates=False,
         min_bqual=0,
         min_mqual=0,
@@ -125,6 +135,8 @@ def create_snv_allele_counts_workflow(
             table_name
         ),
         kwargs={
+            'complevel': complevel,
+            'complib': complib,
             'count_duplicates': count_duplicates,
             'min_bqual': min_bqual,
             'min_mqual': min_mqual,
@@ -135,12 +147,15 @@ def create_snv_allele_counts_workflow(
 
     workflow.transform(
         name='concatenate_counts',
-        ctx=med_ctx,
+        ctx=merge_ctx,
         func='biowrappers.components.io.hdf5.tasks.concatenate_tables',
         args=(
             mgd.TempInputFile('counts.h5', 'regions'),
             mgd.OutputFile(out_file)
-        )
+        ),
+        kwargs={
+            'num_workers': merge_ctx['ncpus'],
+        }
     )
 
     return workflow
@@ -151,6 +166,8 @@ def create_snv_variant_position_counts_workflow(
         tumour_bam_files,
         out_file,
         chromosomes=default_chromosomes,
+        complevel=1,
+        complib='blosc',
         count_duplicates=False,
         min_bqual=0,
         min_mqual=0,
@@ -159,7 +176,8 @@ def create_snv_variant_position_counts_workflow(
         min_variant_depth=0,
         report_strand_counts=False,
         split_size=int(1e7),
-        table_group=''):
+        table_group='',
+        window_size=int(1e5)):
 
     workflow = pypeliner.workflow.Workflow()
 
@@ -186,25 +204,31 @@ def create_snv_variant_position_counts_workflow(
             table_group
         ),
         kwargs={
+            'complevel': complevel,
+            'complib': complib,
             'count_duplicates': count_duplicates,
             'min_bqual': min_bqual,
             'min_mqual': min_mqual,
             'min_normal_depth': min_normal_depth,
             'min_tumour_depth': min_tumour_depth,
             'min_variant_depth': min_variant_depth,
-            'report_strand_counts': report_strand_counts
+            'report_strand_counts': report_strand_counts,
+            'window_size': window_size
         }
     )
 
     workflow.transform(
         name='concatenate_counts',
         axes=(),
-        ctx=med_ctx,
+        ctx=merge_ctx,
         func='biowrappers.components.io.hdf5.tasks.concatenate_tables',
         args=(
             mgd.TempInputFile('counts.h5', 'regions'),
             mgd.OutputFile(out_file),
-        )
+        ),
+        kwargs={
+            'num_workers': merge_ctx['ncpus'],
+        }
     )
 
     return workflow
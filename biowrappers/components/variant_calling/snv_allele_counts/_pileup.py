@@ -0,0 +1,336 @@
+'''
+Vectorised nucleotide pileup used by the allele counting tasks.
+
+Counts follow the semantics of pysam's AlignmentFile.count_coverage: only aligned (M, =, X) bases are counted, reads
+without a sequence or CIGAR are skipped and base qualities are only checked when the quality threshold is positive.
+'''
+from operator import attrgetter
+
+import itertools
+import numpy as np
+
+nucleotides = ('A', 'C', 'G', 'T')
+
+# Maps ASCII bases to 0-3 for A, C, G, T and 4 for anything else
+base_codes = np.full(256, len(nucleotides), dtype=np.uint8)
+
+for _code, _base in enumerate(nucleotides):
+    base_codes[ord(_base)] = _code
+
+# CIGAR operations which consume query and reference (M, =, X), query only (I, S) and reference only (D, N)
+_cigar_match_ops = frozenset((0, 7, 8))
+
+_cigar_query_ops = frozenset((1, 4))
+
+_cigar_ref_ops = frozenset((2, 3))
+
+# SAM flag bits used for read filtering
+BAM_FUNMAP = 0x4
+
+BAM_FREVERSE = 0x10
+
+BAM_FSECONDARY = 0x100
+
+BAM_FQCFAIL = 0x200
+
+BAM_FDUP = 0x400
+
+_get_flag = attrgetter('flag')
+
+_get_mapping_quality = attrgetter('mapping_quality')
+
+_get_reference_end = attrgetter('reference_end')
+
+
+def count_target_positions(
+        bam,
+        chrom,
+        positions,
+        count_duplicates=False,
+        min_bqual=0,
+        min_mqual=0,
+        strand='both',
+        chunk_size=10000,
+        max_gap=1000):
+    '''
+    Count A/C/G/T at a set of 1 based positions on one chromosome.
+
+    Positions are sorted and grouped into clusters no more than `max_gap` apart. Each cluster is fetched once, in
+    coordinate order, so reads overlapping several targets are only decoded once.
+
+    Returns the sorted unique positions and an array of shape (len(positions), 4) with counts for each.
+    '''
+    positions = np.unique(np.asarray(positions, dtype=np.int64))
+
+    counts = np.zeros((len(positions), len(nucleotides)), dtype=np.int64)
+
+    for beg_idx, end_idx in _get_clusters(positions, max_gap):
+        cluster_positions = positions[beg_idx:end_idx] - 1
+
+        reads = bam.fetch(chrom, int(cluster_positions[0]), int(cluster_positions[-1]) + 1)
+
+        counts[beg_idx:end_idx] = count_reads(
+            reads,
+            cluster_positions,
+            count_duplicates=count_duplicates,
+            min_bqual=min_bqual,
+            min_mqual=min_mqual,
+            strand=strand,
+            chunk_size=chunk_size
+        )
+
+    return positions, counts
+
+
+def count_reads(
+        reads,
+        positions,
+        count_duplicates=False,
+        min_bqual=0,
+        min_mqual=0,
+        strand='both',
+        split_strands=False,
+        chunk_size=10000):
+    '''
+    Count A/C/G/T from an iterable of reads at a sorted array of unique 0 based positions.
+
+    Reads are consumed in chunks of `chunk_size` so memory does not depend on the number of reads. Each chunk is
+    filtered in bulk with `filter_reads`.
+
+    If `split_strands` is set the returned array has eight columns, A/C/G/T from forward reads followed by A/C/G/T from
+    reverse reads, so both strands are counted in one traversal.
+    '''
+    if split_strands:
+        num_cols = 2 * len(nucleotides)
+
+    else:
+        num_cols = len(nucleotides)
+
+    counts = np.zeros((len(positions), num_cols), dtype=np.int64)
+
+    if len(positions) == 0:
+        return counts
+
+    reads = iter(reads)
+
+    while True:
+        chunk = list(itertools.islice(reads, chunk_size))
+
+        if len(chunk) == 0:
+            break
+
+        chunk = filter_reads(
+            chunk,
+            count_duplicates=count_duplicates,
+            min_mqual=min_mqual,
+            strand=strand
+        )
+
+        _add_counts(chunk, positions, counts, min_bqual, split_strands)
+
+    return counts
+
+
+def filter_reads(reads, count_duplicates=False, min_mqual=0, strand='both'):
+    '''
+    Filter a list of reads on flag bits and mapping quality.
+
+    Flags and mapping qualities are loaded into arrays and tested against precomputed bit masks, so each read costs a few
+    attribute lookups instead of a Python predicate. Unmapped, secondary and QC fail reads are always removed. Duplicates
+    are removed unless `count_duplicates` is set, and `strand` can be one of both, forward or reverse. Mapped reads
+    without a CIGAR, which have no reference end, are also removed.
+    '''
+    if len(reads) == 0:
+        return reads
+
+    exclude, require = get_read_flag_masks(count_duplicates=count_duplicates, strand=strand)
+
+    flags = np.fromiter(map(_get_flag, reads), dtype=np.int64, count=len(reads))
+
+    valid = ((flags & exclude) == 0) & ((flags & require) == require)
+
+    if min_mqual > 0:
+        valid &= np.fromiter(map(_get_mapping_quality, reads), dtype=np.int64, count=len(reads)) >= min_mqual
+
+    valid &= np.fromiter((x is not None for x in map(_get_reference_end, reads)), dtype=bool, count=len(reads))
+
+    if valid.all():
+        return reads
+
+    return [reads[i] for i in np.flatnonzero(valid)]
+
+
+def get_read_flag_masks(count_duplicates=False, strand='both'):
+    '''
+    Get the flag bits which must be unset (exclude) and set (require) for a read to be counted.
+    '''
+    exclude = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL
+
+    require = 0
+
+    if not count_duplicates:
+        exclude |= BAM_FDUP
+
+    if strand == 'forward':
+        exclude |= BAM_FREVERSE
+
+    elif strand == 'reverse':
+        require |= BAM_FREVERSE
+
+    elif strand != 'both':
+        raise ValueError('Unknown strand {0}'.format(strand))
+
+    return exclude, require
+
+
+def _add_counts(reads, positions, counts, min_bqual, split_strands):
+    seqs = []
+
+    quals = bytearray()
+
+    q_starts = []
+
+    r_starts = []
+
+    lengths = []
+
+    # Column offset of each block, used to separate reverse strand counts
+    col_offsets = []
+
+    offset = 0
+
+    for read in reads:
+        seq = read.query_sequence
+
+        if seq is None:
+            continue
+
+        qual = read.query_qualities
+
+        if not qual:
+            # Without base qualities nothing passes a positive threshold
+            if min_bqual > 0:
+                continue
+
+            qual = bytearray(len(seq))
+
+        if split_strands and read.is_reverse:
+            col_offset = len(nucleotides)
+
+        else:
+            col_offset = 0
+
+        q_pos = 0
+
+        r_pos = read.reference_start
+
+        for op, length in read.cigartuples:
+            if op in _cigar_match_ops:
+                q_starts.append(offset + q_pos)
+
+                r_starts.append(r_pos)
+
+                lengths.append(length)
+
+                col_offsets.append(col_offset)
+
+                q_pos += length
+
+                r_pos += length
+
+            elif op in _cigar_query_ops:
+                q_pos += length
+
+            elif op in _cigar_ref_ops:
+                r_pos += length
+
+        seqs.append(seq)
+
+        quals.extend(qual)
+
+        offset += len(seq)
+
+    if len(lengths) == 0:
+        return
+
+    q_idx, r_idx = _expand_blocks(q_starts, r_starts, lengths)
+
+    codes = base_codes[np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)[q_idx]]
+
+    keep = codes < len(nucleotides)
+
+    if min_bqual > 0:
+        keep &= np.frombuffer(bytes(quals), dtype=np.uint8)[q_idx] >= min_bqual
+
+    pos_idx, in_positions = _index_positions(positions, r_idx)
+
+    keep &= in_positions
+
+    if not keep.any():
+        return
+
+    pos_idx = pos_idx[keep]
+
+    codes = codes[keep]
+
+    if split_strands:
+        codes = codes + np.repeat(np.asarray(col_offsets, dtype=np.uint8), lengths)[keep]
+
+    # Only bin over the span of positions covered by this chunk of reads
+    lo = pos_idx.min()
+
+    hi = pos_idx.max() + 1
+
+    num_cols = counts.shape[1]
+
+    bin_counts = np.bincount((pos_idx - lo) * num_cols + codes, minlength=(hi - lo) * num_cols)
+
+    counts[lo:hi] += bin_counts.reshape(hi - lo, num_cols)
+
+
+def _expand_blocks(q_starts, r_starts, lengths):
+    '''
+    Expand aligned blocks given as start and length into per base query and reference indices.
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    q_idx = np.repeat(np.asarray(q_starts, dtype=np.int64), lengths) + within
+
+    r_idx = np.repeat(np.asarray(r_starts, dtype=np.int64), lengths) + within
+
+    return q_idx, r_idx
+
+
+def _index_positions(positions, r_idx):
+    '''
+    Find the index of each reference coordinate in the sorted array of positions, and whether it is present.
+    '''
+    if positions[-1] - positions[0] == len(positions) - 1:
+        pos_idx = r_idx - positions[0]
+
+        in_positions = (pos_idx >= 0) & (pos_idx < len(positions))
+
+    else:
+        pos_idx = np.searchsorted(positions, r_idx)
+
+        in_positions = positions[np.minimum(pos_idx, len(positions) - 1)] == r_idx
+
+    pos_idx[~in_positions] = 0
+
+    return pos_idx, in_positions
+
+
+def _get_clusters(positions, max_gap):
+    '''
+    Split a sorted array of positions into (beg, end) index ranges wherever consecutive positions are more than
+    `max_gap` apart.
+    '''
+    breaks = np.flatnonzero(np.diff(positions) > max_gap) + 1
+
+    begs = np.concatenate(([0], breaks))
+
+    ends = np.concatenate((breaks, [len(positions)]))
+
+    return [(int(b), int(e)) for b, e in zip(begs, ends) if e > b]
@@ -3,6 +3,9 @@ Created on Oct 31, 2015
 
 @author: Andrew Roth
 '''
+from collections import defaultdict
+
+import itertools
 import numpy as np
 import pandas as pd
 import pysam
@@ -10,7 +13,9 @@ import vcf
 
 import biowrappers.components.variant_calling.utils as utils
 
-nucleotides = ('A', 'C', 'G', 'T')
+from biowrappers.components.io.hdf5.writer import HDFTableWriter
+
+from ._pileup import count_reads, count_target_positions, nucleotides
 
 #=======================================================================================================================
 # Allele counting
@@ -28,6 +33,8 @@ def get_snv_allele_counts_for_vcf_targets(
         region=None,
         vcf_to_bam_chrom_map=None,
         report_zero_count_positions=False,
+        complevel=1,
+        complib='blosc',
         **extra_columns):
 
     bam = pysam.AlignmentFile(bam_file, 'rb')
@@ -43,7 +50,10 @@ def get_snv_allele_counts_for_vcf_targets(
         except ValueError:
             vcf_reader = ()
 
-    data = []
+    # Group targets by chromosome so each chromosome can be counted in a single sorted pass over the BAM
+    records = []
+
+    target_positions = defaultdict(set)
 
     for record in vcf_reader:
         if vcf_to_bam_chrom_map is not None:
@@ -52,64 +62,90 @@ def get_snv_allele_counts_for_vcf_targets(
         else:
             bam_chrom = record.CHROM
 
-        df = _get_counts_df(
+        records.append((bam_chrom, record))
+
+        target_positions[bam_chrom].add(record.POS)
+
+    target_counts = {}
+
+    for bam_chrom, positions in target_positions.items():
+        positions, counts = count_target_positions(
             bam,
             bam_chrom,
-            record.POS,
-            record.POS + 1,
+            list(positions),
             count_duplicates=count_duplicates,
             min_bqual=min_bqual,
             min_mqual=min_mqual,
-            strand='both',
-            report_zero_count_positions=report_zero_count_positions,
+            strand='both'
         )
 
-        if df is None:
-            continue
+        # Match the dtype of pysam count_coverage
+        counts = counts.astype(np.uint64)
 
-        counts = df.iloc[0]
+        for pos, pos_counts in zip(positions, counts):
+            target_counts[(bam_chrom, pos)] = dict(zip(nucleotides, pos_counts))
 
-        ref_base = record.REF
+    categories = {
+        'chrom': sorted(set(str(record.CHROM) for _, record in records)),
+        'ref': list(nucleotides),
+        'alt': list(nucleotides),
+    }
 
-        # Skip record with reference base == N
-        if ref_base not in nucleotides:
-            continue
+    writer = HDFTableWriter(out_file, categories=categories, complevel=complevel, complib=complib)
 
-        for alt_base in record.ALT:
-            alt_base = str(alt_base)
+    # Write each chromosome as it is formatted so only one chromosome of output rows is held in memory
+    for bam_chrom, chrom_records in itertools.groupby(records, key=lambda x: x[0]):
+        data = []
 
-            if (len(ref_base) != 1) or (len(alt_base) != 1):
-                continue
+        for _, record in chrom_records:
+            counts = target_counts[(bam_chrom, record.POS)]
 
-            # Skip record with alt base == N
-            if alt_base not in nucleotides:
-                continue
+            ref_base = record.REF
 
-            if not report_zero_count_positions and counts[ref_base] == 0 and counts[alt_base] == 0:
+            # Skip record with reference base == N
+            if ref_base not in nucleotides:
                 continue
 
-            # Format output record
-            out_row = {
-                'chrom': record.CHROM,
-                'coord': record.POS,
-                'ref': ref_base,
-                'alt': alt_base,
-                'ref_counts': counts[ref_base],
-                'alt_counts': counts[alt_base]
-            }
+            for alt_base in record.ALT:
+                alt_base = str(alt_base)
+
+                if (len(ref_base) != 1) or (len(alt_base) != 1):
+                    continue
+
+                # Skip record with alt base == N
+                if alt_base not in nucleotides:
+                    continue
+
+                if not report_zero_count_positions and counts[ref_base] == 0 and counts[alt_base] == 0:
+                    continue
+
+                # Format output record
+                out_row = {
+                    'chrom': record.CHROM,
+                    'coord': record.POS,
+                    'ref': ref_base,
+                    'alt': alt_base,
+                    'ref_counts': counts[ref_base],
+                    'alt_counts': counts[alt_base]
+                }
+
+                data.append(out_row)
+
+        writer.write(table_name, _get_snv_allele_counts_df(data, extra_columns))
+
+    # Ensure the table exists even if there are no targets
+    writer.write(table_name, _get_snv_allele_counts_df([], extra_columns))
 
-            data.append(out_row)
+    writer.close()
 
+
+def _get_snv_allele_counts_df(data, extra_columns):
     data = pd.DataFrame(data, columns=['chrom', 'coord', 'ref', 'alt', 'ref_counts', 'alt_counts'])
 
     for col, value in extra_columns.items():
         data[col] = value
 
-    hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
-
-    hdf_store[table_name] = data
-
-    hdf_store.close()
+    return data
 
 
 def get_snv_allele_counts_for_region(
@@ -121,51 +157,40 @@ def get_snv_allele_counts_for_region(
         min_bqual=0,
         min_mqual=0,
         report_non_variant_positions=True,
-        report_zero_count_positions=False):
+        report_zero_count_positions=False,
+        complevel=1,
+        complib='blosc',
+        window_size=int(1e5)):
 
     bam = pysam.AlignmentFile(bam_file, 'rb')
 
     chrom, beg, end = _parse_region(region)
 
-    forward_df = _get_counts_df(
-        bam,
-        chrom,
-        beg,
-        end,
-        count_duplicates=count_duplicates,
-        min_bqual=min_bqual,
-        min_mqual=min_mqual,
-        strand='forward'
-    )
+    writer = HDFTableWriter(out_file, categories={'chrom': [chrom]}, complevel=complevel, complib=complib)
 
-    reverse_df = _get_counts_df(
-        bam,
-        chrom,
-        beg,
-        end,
-        count_duplicates=count_duplicates,
-        min_bqual=min_bqual,
-        min_mqual=min_mqual,
-        strand='reverse'
-    )
-
-    reverse_df = reverse_df.rename(columns=lambda x: x.lower())
-
-    df = pd.concat([forward_df, reverse_df], axis=1)
-
-    if not report_zero_count_positions:
-        df = df[df.sum(axis=1) > 0]
+    for window_beg, window_end in _get_windows(beg, end, window_size):
+        df = _get_counts_df(
+            bam,
+            chrom,
+            window_beg,
+            window_end,
+            count_duplicates=count_duplicates,
+            min_bqual=min_bqual,
+            min_mqual=min_mqual,
+            strand='split'
+        )
 
-    if (not report_non_variant_positions) and (df.shape[0] > 0):
-        df = df[df.apply(_get_variant_positions_strand, axis=1)]
+        if not report_zero_count_positions:
+            df = df[df.sum(axis=1) > 0]
 
-    df.reset_index(inplace=True)
+        if (not report_non_variant_positions) and (df.shape[0] > 0):
+            df = df[_get_variant_positions_strand(df)]
 
-    hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+        df.reset_index(inplace=True)
 
-    hdf_store[table_name] = df
+        writer.write(table_name, df)
 
-    hdf_store.close()
+    writer.close()
 
 
 def get_variant_position_counts(
@@ -180,12 +205,20 @@ def get_variant_position_counts(
         min_normal_depth=0,
         min_tumour_depth=0,
         min_variant_depth=0,
-        report_strand_counts=True):
+        report_strand_counts=True,
+        complevel=1,
+        complib='blosc',
+        window_size=int(1e5)):
     """ Get counts for positions with at least two alleles in one or more tumour samples.
 
     This function filters for all positions which exceed the minimum depth in the normal sample and at least one tumour
     sample. It further filters for positions which have at least two alleles present in one or more tumour samples.
 
+    Each BAM is traversed once over the region, and all samples are counted in lockstep over windows of `window_size`
+    bases. Reads overlapping the end of a window are carried into the next window rather than fetched again. Filters are
+    applied per window and only passing positions are written, so memory is bounded by the window size rather than the
+    region size.
+
     """
 
     chrom, beg, end = _parse_region(region)
@@ -197,47 +230,70 @@ def get_variant_position_counts(
     for sample in tumour_samples:
         bams[sample] = pysam.AlignmentFile(tumour_bam_files[sample], 'rb')
 
-    counts = {}
+    if report_strand_counts:
+        strand = 'split'
+
+    else:
+        strand = 'both'
+
+    writer = HDFTableWriter(out_file, categories={'chrom': [chrom]}, complevel=complevel, complib=complib)
+
+    # Fetch each BAM once, coordinates are 1 based so the 0 based fetch is shifted
+    streams = {}
 
     for sample in bams:
-        if report_strand_counts:
-            forward_df = _get_counts_df(
-                bams[sample],
-                chrom,
-                beg,
-                end,
-                count_duplicates=count_duplicates,
-                min_bqual=min_bqual,
-                min_mqual=min_mqual,
-                strand='forward'
-            )
+        streams[sample] = _WindowReadStream(bams[sample].fetch(chrom, beg - 1, end - 1))
+
+    for window_beg, window_end in _get_windows(beg, end, window_size):
+        counts = {}
 
-            reverse_df = _get_counts_df(
-                bams[sample],
+        for sample in bams:
+            counts[sample] = _get_counts_df_from_reads(
+                streams[sample].get_reads(window_beg - 1, window_end - 1),
                 chrom,
-                beg,
-                end,
+                window_beg,
+                window_end,
                 count_duplicates=count_duplicates,
                 min_bqual=min_bqual,
                 min_mqual=min_mqual,
-                strand='reverse'
+                strand=strand
             )
 
-            reverse_df.rename(columns=lambda x: x.lower(), inplace=True)
+        counts = _filter_variant_position_counts(
+            counts,
+            tumour_samples,
+            min_normal_depth=min_normal_depth,
+            min_tumour_depth=min_tumour_depth,
+            min_variant_depth=min_variant_depth,
+            report_strand_counts=report_strand_counts
+        )
 
-            counts[sample] = pd.concat([forward_df, reverse_df], axis=1)
+        # Only non-empty windows are written, so tables are omitted if no position passes
+        if counts['normal'].shape[0] == 0:
+            continue
 
-        else:
-            counts[sample] = _get_counts_df(
-                bams[sample],
-                chrom,
-                beg,
-                end,
-                count_duplicates=count_duplicates,
-                min_bqual=min_bqual,
-                min_mqual=min_mqual,
-                strand='both'
-            )
+        for sample in counts:
+            df = counts[sample]
+
+            df.reset_index(inplace=True)
+
+            table_name = '/'.join((table_group, sample))
+
+            writer.write(table_name, df)
+
+    writer.close()
+
+
+def _filter_variant_position_counts(
+        counts,
+        tumour_samples,
+        min_normal_depth=0,
+        min_tumour_depth=0,
+        min_variant_depth=0,
+        report_strand_counts=True):
+    '''
+    Filter a dictionary of per sample count tables for positions passing the depth and variant filters.
+    '''
 
     # Depth filtering
     valid_positions = np.zeros(counts['normal'].shape[0], dtype=bool)
@@ -257,29 +313,65 @@ def get_variant_position_counts(
 
         for sample in tumour_samples:
             if report_strand_counts:
-                variant_positions = np.logical_or(
-                    variant_positions, counts[sample].apply(_get_variant_positions_strand, axis=1))
+                variant_positions = np.logical_or(variant_positions, _get_variant_positions_strand(counts[sample]))
 
             else:
                 variant_positions = np.logical_or(
-                    variant_positions, counts[sample].apply(lambda x: _get_variant_positions(x, min_variant_depth), axis=1))
+                    variant_positions, _get_variant_positions(counts[sample], min_variant_depth))
 
         for sample in counts:
             counts[sample] = counts[sample][variant_positions]
 
-    # Write output
-    hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+    return counts
 
-    for sample in counts:
-        df = counts[sample]
 
-        df.reset_index(inplace=True)
+class _WindowReadStream(object):
+    '''
+    Split a coordinate sorted stream of reads into consecutive windows, without fetching the reads again for each window.
+    '''
+
+    def __init__(self, reads):
+        self._reads = iter(reads)
 
-        table_name = '/'.join((table_group, sample))
+        # Reads from earlier windows which extend past their end
+        self._carry = []
 
-        hdf_store.append(table_name, df)
+        # First read starting after the last window
+        self._next = None
 
-    hdf_store.close()
+    def get_reads(self, beg, end):
+        ''' Get the reads overlapping the 0 based half open window [beg, end). Windows must be adjacent and in order.
+        '''
+        reads = [x for x in self._carry if _get_read_end(x) > beg]
+
+        if self._next is not None:
+            if self._next.reference_start >= end:
+                return reads
+
+            reads.append(self._next)
+
+            self._next = None
+
+        for read in self._reads:
+            if read.reference_start >= end:
+                self._next = read
+
+                break
+
+            reads.append(read)
+
+        self._carry = [x for x in reads if _get_read_end(x) > end]
+
+        return reads
+
+
+def _get_read_end(read):
+    end = read.reference_end
+
+    if end is None:
+        return read.reference_start
+
+    return end
 
 
 def _get_counts_df(bam_file,
@@ -293,82 +385,109 @@ def _get_counts_df(bam_file,
                    report_zero_count_positions=True):
     '''
     Get counts 1 based indexing.
-    '''
 
-    x = bam_file.count_coverage(
+    Setting `strand` to split counts both strands in one traversal, with forward counts in columns A/C/G/T and reverse
+    counts in columns a/c/g/t.
+    '''
+    return _get_counts_df_from_reads(
+        bam_file.fetch(chrom, beg - 1, end - 1),
         chrom,
-        beg - 1,
-        end - 1,
-        quality_threshold=min_bqual,
-        read_callback=lambda x: _check_read(
-            x,
-            count_duplicates=count_duplicates,
-            min_mqual=min_mqual,
-            strand=strand)
+        beg,
+        end,
+        count_duplicates=count_duplicates,
+        min_bqual=min_bqual,
+        min_mqual=min_mqual,
+        strand=strand,
+        report_zero_count_positions=report_zero_count_positions
     )
 
-    if not report_zero_count_positions:
-        if np.array(x).sum() == 0:
-            return None
 
-    df = pd.DataFrame(pd.np.array(x).T, columns=['A', 'C', 'G', 'T'])
+def _get_counts_df_from_reads(reads,
+                              chrom,
+                              beg,
+                              end,
+                              count_duplicates=False,
+                              min_bqual=30,
+                              min_mqual=30,
+                              strand='both',
+                              report_zero_count_positions=True):
+    '''
+    Get counts 1 based indexing from reads overlapping the positions [beg, end).
+    '''
 
-    df.insert(0, 'chrom', chrom)
+    if strand == 'split':
+        columns = list(nucleotides) + [x.lower() for x in nucleotides]
 
-    df.insert(1, 'coord', np.arange(beg, end))
+        split_strands = True
 
-    df = df.set_index(['chrom', 'coord'])
+        strand = 'both'
 
-    return df
+    else:
+        columns = list(nucleotides)
 
+        split_strands = False
+
+    x = count_reads(
+        reads,
+        np.arange(beg - 1, end - 1),
+        count_duplicates=count_duplicates,
+        min_bqual=min_bqual,
+        min_mqual=min_mqual,
+        strand=strand,
+        split_strands=split_strands
+    )
 
-def _check_read(read, count_duplicates=False, min_mqual=30, strand='both'):
-    valid = True
+    if not report_zero_count_positions:
+        if x.sum() == 0:
+            return None
 
-    if read.mapping_quality < min_mqual:
-        valid = False
+    # Match the dtype of pysam count_coverage
+    df = pd.DataFrame(x.astype(np.uint64), columns=columns)
 
-    elif read.is_duplicate and (not count_duplicates):
-        valid = False
+    df.insert(0, 'chrom', chrom)
 
-    elif read.is_unmapped:
-        valid = False
+    df.insert(1, 'coord', np.arange(beg, end))
 
-    elif read.is_qcfail:
-        valid = False
+    df = df.set_index(['chrom', 'coord'])
 
-    elif read.is_secondary:
-        valid = False
+    return df
 
-    elif (strand == 'reverse') and (not read.is_reverse):
-        valid = False
 
-    elif (strand == 'forward') and (read.is_reverse):
-        valid = False
+def _get_variant_positions(df, min_variant_depth):
+    '''
+    Find positions where the second most common allele has more than `min_variant_depth` counts.
+    '''
+    counts = df[list(nucleotides)].values
 
-    return valid
+    return _get_second_largest_counts(counts) > min_variant_depth
 
 
-def _get_variant_positions(row, min_variant_depth):
-    counts = sorted(row, reverse=True)
+def _get_variant_positions_strand(df):
+    '''
+    Find positions where the second most common allele, summed over both strands, has non-zero counts.
+    '''
+    counts = df[list(nucleotides)].values + df[[x.lower() for x in nucleotides]].values
 
-    if counts[1] > min_variant_depth:
-        return True
+    return _get_second_largest_counts(counts) > 0
 
-    else:
-        return False
 
+def _get_second_largest_counts(counts):
+    '''
+    Get the second largest value in each row of an N x 4 count matrix.
+    '''
+    return np.partition(counts, -2, axis=1)[:, -2]
 
-def _get_variant_positions_strand(row):
-    counts = [row[x.lower()] + row[x.upper()] for x in nucleotides]
 
-    counts = sorted(counts, reverse=True)
+def _get_windows(beg, end, window_size):
+    '''
+    Split the half open interval [beg, end) into consecutive windows of at most `window_size` bases.
+    '''
+    windows = []
 
-    if counts[1] > 0:
-        return True
+    for window_beg in range(beg, end, window_size):
+        windows.append((window_beg, min(window_beg + window_size, end)))
 
-    else:
-        return False
+    return windows
 
 
 def _parse_region(region):
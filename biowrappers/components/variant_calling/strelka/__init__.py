@@ -19,7 +19,15 @@ def create_strelka_workflow(
         snv_vcf_file,
         chromosomes=default_chromosomes,
         split_size=int(1e7),
-        use_depth_thresholds=True):
+        use_depth_thresholds=True,
+        base_counts_dir=None):
+    ''' Call somatic SNVs and indels with Strelka.
+
+    :param base_counts_dir: Directory caching the reference base counts used for the known chromosome sizes. Defaults
+        to the directory of the reference FASTA, so the counts are computed once per reference. If the directory is
+        not writable the counts are computed in every run.
+
+    '''
 
     workflow = Workflow()
 
@@ -43,26 +51,18 @@ def create_strelka_workflow(
         )
     )
 
-    workflow.transform(
-        name='count_fasta_bases',
-        ctx={'mem': 2, 'num_retry': 3, 'mem_retry_increment': 2},
-        func=tasks.count_fasta_bases,
-        args=(
-            pypeliner.managed.InputFile(ref_genome_fasta_file),
-            pypeliner.managed.TempOutputFile('ref_base_counts.tsv')
-        )
-    )
-
     workflow.transform(
         name='get_known_chromosomes_sizes',
-        ctx={'local': True},
+        ctx={'mem': 2, 'num_retry': 3, 'mem_retry_increment': 2},
         func=get_known_chromosome_sizes,
         ret=pypeliner.managed.TempOutputObj('known_sizes', 'chrom', axes_origin=[]),
         args=(
             pypeliner.managed.InputFile(tumour_bam_file),
-            pypeliner.managed.TempInputFile('ref_base_counts.tsv'),
-            chromosomes
-        )
+            pypeliner.managed.InputFile(ref_genome_fasta_file),
+            chromosomes,
+            pypeliner.managed.TempSpace('base_counts.tsv')
+        ),
+        kwargs={'cache_dir': base_counts_dir}
     )
 
     workflow.transform(
@@ -215,7 +215,9 @@ def get_coords(bam_file, chrom, split_size):
     return coords
 
 
-def get_known_chromosome_sizes(bam_file, size_file, chromosomes):
+def get_known_chromosome_sizes(bam_file, ref_genome_fasta_file, chromosomes, tmp_file, cache_dir=None):
+    size_file = tasks.get_ref_base_counts_file(ref_genome_fasta_file, tmp_file, cache_dir=cache_dir)
+
     chromosomes = _get_chromosomes(bam_file, chromosomes)
 
     sizes = {}
@@ -9,11 +9,18 @@ from collections import OrderedDict
 
 import csv
 import ConfigParser
+import hashlib
 import math
+import numpy as np
+import os
 import pandas as pd
 import pypeliner
 import re
-import vcf
+import tempfile
+import warnings
+
+import biowrappers.components.io.vcf.access as access
+import biowrappers.components.io.vcf.batch as batch_access
 
 FILTER_ID_BASE = 'BCNoise'
 FILTER_ID_DEPTH = 'DP'
@@ -36,6 +43,60 @@ def count_fasta_bases(ref_genome_fasta_file, out_file):
     pypeliner.commandline.execute(*cmd)
 
 
+def get_ref_base_counts_file(ref_genome_fasta_file, tmp_file, cache_dir=None):
+    '''
+    Get the `countFastaBases` output for a reference FASTA from a cache, which is the reference directory unless
+    `cache_dir` is given. Bases are only counted when the cache has no entry for the current version of the reference,
+    with entries keyed by a signature of the path, size and modification time of the FASTA file. Entries for old
+    versions of a reference are not removed.
+
+    If the cache directory is not writable the bases are counted into `tmp_file` instead.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(ref_genome_fasta_file))
+
+    cache_file = os.path.join(cache_dir, '{0}.base_counts.{1}.tsv'.format(
+        os.path.basename(ref_genome_fasta_file), _get_fasta_signature(ref_genome_fasta_file)))
+
+    if os.path.exists(cache_file):
+        return cache_file
+
+    # Count to a temporary file and rename, so concurrent jobs never read a partial entry
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        fd, cache_tmp_file = tempfile.mkstemp(prefix=os.path.basename(cache_file) + '.', dir=cache_dir)
+
+    except (IOError, OSError):
+        count_fasta_bases(ref_genome_fasta_file, tmp_file)
+
+        return tmp_file
+
+    os.close(fd)
+
+    try:
+        count_fasta_bases(ref_genome_fasta_file, cache_tmp_file)
+
+        os.chmod(cache_tmp_file, 0o644)
+
+        os.rename(cache_tmp_file, cache_file)
+
+    finally:
+        if os.path.exists(cache_tmp_file):
+            os.remove(cache_tmp_file)
+
+    return cache_file
+
+
+def _get_fasta_signature(fasta_file):
+    stat = os.stat(fasta_file)
+
+    key = '{0}:{1}:{2}'.format(os.path.realpath(fasta_file), stat.st_size, int(stat.st_mtime))
+
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
 def call_somatic_variants(
         normal_bam_file,
         tumour_bam_file,
@@ -118,80 +179,99 @@ def filter_snv_file_list(
         max_filtered_basecall_frac=0.4,
         max_spanning_deletion_frac=0.75,
         quality_lower_bound=15,
-        use_depth_filter=True):
+        use_depth_filter=True,
+        chunk_size=int(1e4)):
+    '''
+    Filter the SNVs of the files in `in_files`, in sorted key order. Records are read in batches of `chunk_size` and
+    each filter is evaluated over the whole batch.
+    '''
 
     max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
 
+    header = None
+
     writer = None
 
-    with open(out_file, 'wb') as out_fh:
+    try:
         for key in sorted(in_files):
-            reader = vcf.Reader(filename=in_files[key])
+            if header is None:
+                header = _read_header(in_files[key])
 
-            if writer is None:
                 # Add filters to header
                 if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
+                    access.add_filter(
+                        header,
+                        FILTER_ID_DEPTH,
+                        'Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
                     )
 
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_BASE,
+                    'Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
                         max_filtered_basecall_frac)
                 )
 
-                reader.filters[FILTER_ID_SPANNING_DELETION] = vcf.parser._Filter(
-                    id=FILTER_ID_SPANNING_DELETION,
-                    desc='Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_SPANNING_DELETION,
+                    'Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
                         max_spanning_deletion_frac)
                 )
 
-                reader.filters[FILTER_ID_QSS] = vcf.parser._Filter(
-                    id=FILTER_ID_QSS,
-                    desc='Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_QSS,
+                    'Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
                         quality_lower_bound)
                 )
 
-                writer = vcf.Writer(out_fh, reader)
+                writer = access.open_writer(out_file, header)
+
+                normal_idx, tumour_idx = _get_sample_indices(header)
 
-            for record in reader:
-                normal = record.genotype('NORMAL')
+            for batch in batch_access.iter_record_batches(in_files[key], header=header, batch_size=chunk_size):
+                normal = _get_format_arrays(batch, normal_idx, ('DP', 'FDP', 'SDP'))
 
-                tumour = record.genotype('TUMOR')
+                tumour = _get_format_arrays(batch, tumour_idx, ('DP', 'FDP', 'SDP'))
 
                 # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
+                if use_depth_filter:
+                    batch.add_filter(FILTER_ID_DEPTH, normal['DP'] > max_normal_coverage)
 
                 # Filtered basecall fraction
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction(normal.data)
-
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction(tumour.data)
+                normal_filtered_base_call_fraction = _get_fraction(normal['FDP'], normal['DP'])
 
-                if (normal_filtered_base_call_fraction >= max_filtered_basecall_frac) or \
-                   (tumour_filtered_base_call_fraction >= max_filtered_basecall_frac):
+                tumour_filtered_base_call_fraction = _get_fraction(tumour['FDP'], tumour['DP'])
 
-                    record.add_filter(FILTER_ID_BASE)
+                batch.add_filter(
+                    FILTER_ID_BASE,
+                    (normal_filtered_base_call_fraction >= max_filtered_basecall_frac) |
+                    (tumour_filtered_base_call_fraction >= max_filtered_basecall_frac)
+                )
 
                 # Spanning deletion fraction
-                normal_spanning_deletion_fraction = _get_spanning_deletion_fraction(normal.data)
-
-                tumour_spanning_deletion_fraction = _get_spanning_deletion_fraction(tumour.data)
+                normal_spanning_deletion_fraction = _get_fraction(normal['SDP'], normal['DP'] + normal['SDP'])
 
-                if (normal_spanning_deletion_fraction > max_spanning_deletion_frac) or \
-                   (tumour_spanning_deletion_fraction > max_spanning_deletion_frac):
+                tumour_spanning_deletion_fraction = _get_fraction(tumour['SDP'], tumour['DP'] + tumour['SDP'])
 
-                    record.add_filter(FILTER_ID_SPANNING_DELETION)
+                batch.add_filter(
+                    FILTER_ID_SPANNING_DELETION,
+                    (normal_spanning_deletion_fraction > max_spanning_deletion_frac) |
+                    (tumour_spanning_deletion_fraction > max_spanning_deletion_frac)
+                )
 
                 # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSS_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSS)
+                batch.add_filter(
+                    FILTER_ID_QSS,
+                    (batch.get_info('NT', dtype=str) != 'ref') | (batch.get_info('QSS_NT') < quality_lower_bound)
+                )
 
-                writer.write_record(record)
+                batch.write(writer)
 
-        writer.close()
+    finally:
+        if writer is not None:
+            writer.close()
 
 
 def _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files):
@@ -227,22 +307,32 @@ def _get_normal_coverage(stats_files):
     return total_coverage
 
 
-def _get_filtered_base_call_fraction(data):
-    frac = 0
+def _read_header(file_name):
+    reader = access.open_reader(file_name)
 
-    if data.DP > 0:
-        frac = data.FDP / data.DP
+    header = reader.header.copy()
 
-    return frac
+    reader.close()
 
+    return header
 
-def _get_spanning_deletion_fraction(data):
-    total = data.DP + data.SDP
 
-    frac = 0
+def _get_sample_indices(header):
+    samples = list(header.samples)
 
-    if total > 0:
-        frac = data.SDP / total
+    return samples.index('NORMAL'), samples.index('TUMOR')
+
+
+def _get_format_arrays(batch, sample_idx, keys):
+    return dict((key, batch.get_format(sample_idx, key)) for key in keys)
+
+
+def _get_fraction(numerator, denominator):
+    frac = np.zeros(len(numerator))
+
+    is_positive = denominator > 0
+
+    frac[is_positive] = numerator[is_positive] / denominator[is_positive]
 
     return frac
 
@@ -263,177 +353,192 @@ def filter_indel_file_list(
         max_ref_repeat=8,
         max_window_filtered_basecall_frac=0.3,
         quality_lower_bound=30,
-        use_depth_filter=True):
-
-    window_cols = (
-        'chrom',
-        'coord',
-        'normal_window_used',
-        'normal_window_filtered',
-        'normal_window_submap',
-        'tumour_window_used',
-        'tumour_window_filtered',
-        'tumour_window_submap'
-    )
+        use_depth_filter=True,
+        chunk_size=int(1e4)):
+    '''
+    Filter the indels of the files in `vcf_files`, in sorted key order, adding the window depths from the matching
+    files in `window_files`. Records are read in batches of `chunk_size` and each filter is evaluated over the whole
+    batch. Records without a window row get no window depths and are not checked by the window base call filter.
+    '''
 
     max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
 
+    header = None
+
     writer = None
 
-    with open(out_file, 'wb') as out_fh:
+    try:
         for key in sorted(vcf_files):
-            window = pd.read_csv(
-                window_files[key],
-                comment='#',
-                        converters={'chrom': str},
-                header=None,
-                names=window_cols,
-                sep='\t')
-
-            reader = vcf.Reader(filename=vcf_files[key])
+            if header is None:
+                header = _read_header(vcf_files[key])
 
-            if writer is None:
                 # Add format to header
-                reader.formats['DP50'] = vcf.parser._Format(
-                    id='DP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 read depth within 50 bases'
-                )
-
-                reader.formats['FDP50'] = vcf.parser._Format(
-                    id='FDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 number of basecalls filtered from original read depth within 50 bases'
+                access.add_format(header, 'DP50', 1, 'Float', 'Average tier1 read depth within 50 bases')
+
+                access.add_format(
+                    header,
+                    'FDP50',
+                    1,
+                    'Float',
+                    'Average tier1 number of basecalls filtered from original read depth within 50 bases'
                 )
 
-                reader.formats['SUBDP50'] = vcf.parser._Format(
-                    id='SUBDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'
+                access.add_format(
+                    header,
+                    'SUBDP50',
+                    1,
+                    'Float',
+                    'Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'
                 )
 
                 # Add filters to header
                 if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
+                    access.add_filter(
+                        header,
+                        FILTER_ID_DEPTH,
+                        'Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
                     )
 
-                reader.filters[FILTER_ID_REPEAT] = vcf.parser._Filter(
-                    id=FILTER_ID_REPEAT,
-                    desc='Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
+                access.add_filter(
+                    header,
+                    FILTER_ID_REPEAT,
+                    'Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
                 )
 
-                reader.filters[FILTER_ID_INDEL_HPOL] = vcf.parser._Filter(
-                    id=FILTER_ID_INDEL_HPOL,
-                    desc='Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_INDEL_HPOL,
+                    'Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
                         max_int_hpol_length)
                 )
 
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_BASE,
+                    'Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
                         max_window_filtered_basecall_frac)
                 )
 
-                reader.filters[FILTER_ID_QSI] = vcf.parser._Filter(
-                    id=FILTER_ID_QSI,
-                    desc='Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
+                access.add_filter(
+                    header,
+                    FILTER_ID_QSI,
+                    'Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
                         quality_lower_bound)
                 )
 
-                writer = vcf.Writer(out_fh, reader)
+                writer = access.open_writer(out_file, header)
 
-            for record in reader:
-                window_row = window.loc[
-                    (window['chrom'] == str(record.CHROM)) & (window['coord'] == record.POS)].iloc[0]
+                normal_idx, tumour_idx = _get_sample_indices(header)
 
-                normal = record.genotype('NORMAL')
+            windows = _IndelWindows(window_files[key])
 
-                tumour = record.genotype('TUMOR')
+            for batch in batch_access.iter_record_batches(vcf_files[key], header=header, batch_size=chunk_size):
+                window = windows.get_rows(batch.get_chroms(), batch.get_positions())
 
-                normal_data = normal.data._asdict()
+                # Add window data to vcf record, values are rounded to single precision as they are stored
+                normal = {
+                    'DP50': _to_float32(window['normal_window_used'] + window['normal_window_filtered']),
+                    'FDP50': _to_float32(window['normal_window_filtered']),
+                    'SUBDP50': _to_float32(window['normal_window_submap']),
+                }
 
-                tumour_data = tumour.data._asdict()
+                tumour = {
+                    'DP50': _to_float32(window['tumour_window_used'] + window['tumour_window_filtered']),
+                    'FDP50': _to_float32(window['tumour_window_filtered']),
+                    'SUBDP50': _to_float32(window['tumour_window_submap']),
+                }
 
-                # Add window data to vcf record
-                record.add_format('DP50')
+                for sample_idx, data in ((normal_idx, normal), (tumour_idx, tumour)):
+                    for field in ('DP50', 'FDP50', 'SUBDP50'):
+                        batch.set_format(sample_idx, field, data[field])
 
-                record.add_format('FDP50')
+                normal['DP'] = batch.get_format(normal_idx, 'DP')
 
-                record.add_format('SUBDP50')
-
-                normal_data['DP50'] = window_row['normal_window_used'] + window_row['normal_window_filtered']
-
-                normal_data['FDP50'] = window_row['normal_window_filtered']
-
-                normal_data['SUBDP50'] = window_row['normal_window_submap']
-
-                tumour_data['DP50'] = window_row['tumour_window_used'] + window_row['tumour_window_filtered']
-
-                tumour_data['FDP50'] = window_row['tumour_window_filtered']
+                # Add filters
 
-                tumour_data['SUBDP50'] = window_row['tumour_window_submap']
+                # Normal depth filter
+                if use_depth_filter:
+                    batch.add_filter(FILTER_ID_DEPTH, normal['DP'] > max_normal_coverage)
 
-                normal.data = _convert_dict_to_call(normal_data)
+                # Ref repeat
+                batch.add_filter(FILTER_ID_REPEAT, batch.get_info('RC') > max_ref_repeat)
 
-                tumour.data = _convert_dict_to_call(tumour_data)
+                # Indel homopolymer
+                batch.add_filter(FILTER_ID_INDEL_HPOL, batch.get_info('IHP') > max_int_hpol_length)
 
-                # Add filters
+                # Base filter
+                normal_filtered_base_call_fraction = _get_fraction(normal['FDP50'], normal['DP50'])
 
-                # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
+                tumour_filtered_base_call_fraction = _get_fraction(tumour['FDP50'], tumour['DP50'])
 
-                # Ref repeat
-                if 'RC' in record.INFO:
-                    ref_repeat = record.INFO['RC']
+                batch.add_filter(
+                    FILTER_ID_BASE,
+                    (normal_filtered_base_call_fraction >= max_window_filtered_basecall_frac) |
+                    (tumour_filtered_base_call_fraction >= max_window_filtered_basecall_frac)
+                )
 
-                    if ref_repeat > max_ref_repeat:
-                        record.add_filter(FILTER_ID_REPEAT)
+                # Q-val filter
+                batch.add_filter(
+                    FILTER_ID_QSI,
+                    (batch.get_info('NT', dtype=str) != 'ref') | (batch.get_info('QSI_NT') < quality_lower_bound)
+                )
 
-                # Indel homopolymer
-                if 'IHP' in record.INFO:
-                    indel_homopolymer = record.INFO['IHP']
+                batch.write(writer)
 
-                    if indel_homopolymer > max_int_hpol_length:
-                        record.add_filter(FILTER_ID_INDEL_HPOL)
+            windows.warn_missing()
 
-                # Base filter
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(normal.data)
+    finally:
+        if writer is not None:
+            writer.close()
 
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(tumour.data)
 
-                if (normal_filtered_base_call_fraction >= max_window_filtered_basecall_frac) or \
-                   (tumour_filtered_base_call_fraction >= max_window_filtered_basecall_frac):
+def _to_float32(values):
+    return values.astype(np.float32).astype(np.float64)
 
-                    record.add_filter(FILTER_ID_BASE)
 
-                # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSI_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSI)
+class _IndelWindows(object):
+    '''
+    Rows of a Strelka indel window file, looked up by the chromosome and position of records.
+    '''
 
-                writer.write_record(record)
+    columns = (
+        'normal_window_used',
+        'normal_window_filtered',
+        'normal_window_submap',
+        'tumour_window_used',
+        'tumour_window_filtered',
+        'tumour_window_submap'
+    )
 
-        writer.close()
+    def __init__(self, file_name):
+        self.file_name = file_name
 
+        window = pd.read_csv(
+            file_name,
+            comment='#',
+            dtype={'chrom': str},
+            header=None,
+            names=('chrom', 'coord') + self.columns,
+            sep='\t'
+        )
 
-def _convert_dict_to_call(data_dict):
-    call_data_class = vcf.model.make_calldata_tuple(data_dict.keys())
+        # Use the first row at each position
+        self._window = window.drop_duplicates(['chrom', 'coord']).set_index(['chrom', 'coord'])
 
-    return call_data_class(**data_dict)
+        self._num_missing = 0
 
+    def get_rows(self, chroms, coords):
+        ''' Get the window values of each record as arrays, which are NaN for records without a window row.
+        '''
+        rows = self._window.reindex(pd.MultiIndex.from_arrays([chroms, coords]))
 
-def _get_filtered_base_call_fraction_indel(data):
-    frac = 0
+        self._num_missing += int(rows[self.columns[0]].isnull().sum())
 
-    if data.DP50 > 0:
-        frac = data.FDP50 / data.DP50
+        return dict((name, rows[name].values.astype(np.float64)) for name in self.columns)
 
-    return frac
+    def warn_missing(self):
+        if self._num_missing > 0:
+            warnings.warn('No window found for {0} records in {1}'.format(self._num_missing, self.file_name))
 
 #=======================================================================================================================
 # Write config file for make style strelka
@@ -530,7 +635,7 @@ def configure_run(normal_bam_file,
 def convert_vcf_to_hdf5(in_file, out_file, data_type='snv', table_name=None):
     out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
 
-    reader = vcf.Reader(filename=in_file)
+    reader = access.open_reader(in_file, drop_samples=True)
 
     if table_name is None:
         table_name = 'strelka_{0}'.format(data_type)
@@ -538,19 +643,19 @@ def convert_vcf_to_hdf5(in_file, out_file, data_type='snv', table_name=None):
     for record in reader:
         row = OrderedDict()
 
-        row['chrom'] = str(record.CHROM)
+        row['chrom'] = str(record.chrom)
 
-        row['coord'] = int(record.POS)
+        row['coord'] = int(record.pos)
 
-        row['ref_base'] = str(record.REF)
+        row['ref_base'] = str(record.ref)
 
-        row['alt_base'] = str(record.ALT[0])
+        row['alt_base'] = str(record.alts[0])
 
         if data_type == 'snv':
-            row['qual'] = float(record.INFO['QSS'])
+            row['qual'] = float(record.info['QSS'])
 
         elif data_type == 'indel':
-            row['qual'] = float(record.INFO['QSI'])
+            row['qual'] = float(record.info['QSI'])
 
         else:
             raise Exception('Unknown data type {0}'.format(data_type))
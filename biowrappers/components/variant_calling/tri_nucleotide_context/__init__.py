@@ -20,28 +20,31 @@ def create_vcf_tric_nucleotide_annotation_workflow(
     workflow = pypeliner.workflow.Workflow()
 
     workflow.transform(
-        name='split_vcf',
+        name='get_regions',
+        ret=mgd.TempOutputObj('regions_obj', 'regions'),
         ctx=dict(mem=2, **ctx),
-        func='biowrappers.components.io.vcf.tasks.split_vcf',
+        func='biowrappers.components.io.vcf.tasks.get_vcf_split_regions',
         args=(
-            mgd.InputFile(vcf_file),
-            mgd.TempOutputFile('split.vcf', 'split')
+            mgd.InputFile(vcf_file, extensions=['.tbi']),
+            split_size,
         ),
-        kwargs={'lines_per_file': split_size}
     )
 
     workflow.transform(
         name='annotate_db_status',
-        axes=('split',),
+        axes=('regions',),
         ctx=dict(mem=4, **ctx),
         func='biowrappers.components.variant_calling.tri_nucleotide_context.tasks.get_tri_nucelotide_context',
         args=(
             ref_genome_fasta_file,
-            mgd.TempInputFile('split.vcf', 'split'),
-            mgd.TempOutputFile('tri_nucleotide_context.csv.gz', 'split',
+            mgd.InputFile(vcf_file, extensions=['.tbi']),
+            mgd.TempOutputFile('tri_nucleotide_context.csv.gz', 'regions',
                                extensions=['.yaml']),
             table_name
-        )
+        ),
+        kwargs={
+            'region': mgd.TempInputObj('regions_obj', 'regions'),
+        },
     )
 
     workflow.transform(
@@ -49,7 +52,7 @@ def create_vcf_tric_nucleotide_annotation_workflow(
         ctx=dict(mem=2, **ctx),
         func='single_cell.utils.csvutils.concatenate_csv',
         args=(
-            mgd.TempInputFile('tri_nucleotide_context.csv.gz', 'split'),
+            mgd.TempInputFile('tri_nucleotide_context.csv.gz', 'regions'),
             mgd.OutputFile(out_file, extensions=['.yaml']))
     )
 
@@ -3,28 +3,56 @@ Created on Nov 2, 2015
 
 @author: Andrew Roth
 '''
+import numpy as np
 import pandas as pd
-import pysam
-import vcf
 from single_cell.utils import csvutils
 
-def get_tri_nucelotide_context(ref_genome_fasta_file, vcf_file, out_file, table_name):
-    vcf_reader = vcf.Reader(filename=vcf_file)
+import biowrappers.components.io.vcf.access as access
+import biowrappers.components.variant_calling.utils as utils
+from biowrappers.components.io.fasta import FastaWindowReader
 
-    fasta_reader = pysam.Fastafile(ref_genome_fasta_file)
+def get_tri_nucelotide_context(ref_genome_fasta_file, vcf_file, out_file, table_name, region=None, flank=1):
+    '''
+    Annotate VCF records with the reference sequence of `flank` bases either side of the position, the tri-nucleotide
+    context by default. Contexts for all records on a chromosome are read from the reference at once.
+    '''
+    vcf_reader = access.open_reader(vcf_file, drop_samples=True)
 
-    data = []
+    if region is not None:
+        chrom, beg, end = utils.parse_region_for_vcf(region)
+        vcf_reader = access.fetch_starts(vcf_reader, chrom, beg, end)
+
+    chroms = []
+
+    coords = []
 
     for record in vcf_reader:
-        chrom = record.CHROM
+        chroms.append(record.chrom)
+
+        coords.append(record.pos)
+
+    if len(coords) == 0:
+        data = pd.DataFrame([])
+
+    else:
+        fasta_reader = FastaWindowReader(ref_genome_fasta_file)
+
+        chroms = np.array(chroms, dtype=object)
+
+        coords = np.array(coords, dtype=np.int64)
+
+        contexts = np.empty(len(coords), dtype=object)
+
+        for chrom in pd.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
 
-        coord = record.POS
+            contexts[idx] = fasta_reader.get_contexts(chrom, coords[idx], flank=flank)
 
-        tri_nucleotide_context = fasta_reader.fetch(chrom, coord - 2, coord + 1)
+        fasta_reader.close()
 
-        data.append({'chrom': record.CHROM, 'coord': record.POS, 'tri_nucleotide_context': tri_nucleotide_context})
+        data = pd.DataFrame({'chrom': chroms, 'coord': coords, 'tri_nucleotide_context': contexts})
 
-    data = pd.DataFrame(data)
+        data = data[['chrom', 'coord', 'tri_nucleotide_context']]
 
     csvutils.write_dataframe_to_csv_and_yaml(data,  out_file, data.dtypes.to_dict(),
                                              write_header=True)
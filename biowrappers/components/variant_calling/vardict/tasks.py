@@ -7,7 +7,8 @@ Created on Nov 1, 2015
 import pipes
 import pypeliner
 import subprocess
-import vcf
+
+import biowrappers.components.io.vcf.access as access
 
 
 def run_single_sample_vardict(
@@ -93,15 +94,16 @@ def run_paired_sample_vardict(
 
 
 def filter_vcf(in_file, out_file, variant_type):
-    reader = vcf.Reader(filename=in_file)
-    with open(out_file, 'w') as out_fh:
-        writer = vcf.Writer(out_fh, reader)
-        for record in reader:
-            if record.INFO['STATUS'] != 'StrongSomatic':
-                continue
-            if len(record.FILTER) > 0:
-                continue
-            if (variant_type == 'indel') and (record.is_indel):
-                writer.write_record(record)
-            elif (variant_type == 'snv') and (record.is_snp):
-                writer.write_record(record)
+    reader = access.open_reader(in_file)
+    writer = access.open_writer(out_file, reader.header)
+    for record in reader:
+        if record.info['STATUS'] != 'StrongSomatic':
+            continue
+        if len(access.get_filters(record)) > 0:
+            continue
+        if (variant_type == 'indel') and access.is_indel(record):
+            writer.write(record)
+        elif (variant_type == 'snv') and access.is_snv(record):
+            writer.write(record)
+    writer.close()
+    reader.close()
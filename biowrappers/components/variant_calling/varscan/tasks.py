@@ -6,29 +6,31 @@ Created on 8 Apr 2017
 import os
 import pypeliner.commandline as cli
 import shutil
-import vcf
+
+import biowrappers.components.io.vcf.access as access
 
 from biowrappers.components.ngs.samtools.tasks import mpileup
 from biowrappers.components.io.vcf.tasks import index_vcf
 
 
 def filter_somatic_variants(in_file, out_file):
-    reader = vcf.Reader(filename=in_file)
+    reader = access.open_reader(in_file)
+
+    writer = access.open_writer(out_file, reader.header)
 
-    with open(out_file, 'wb') as out_fh:
-        writer = vcf.Writer(out_fh, reader)
+    for record in reader:
+        if len(access.get_filters(record)) == 0:
+            pass_filter = True
 
-        for record in reader:
-            if (record.FILTER is None) or (len(record.FILTER) == 0):
-                pass_filter = True
+        else:
+            pass_filter = False
 
-            else:
-                pass_filter = False
+        if pass_filter and ('SOMATIC' in record.info):
+            writer.write(record)
 
-            if pass_filter and ('SOMATIC' in record.INFO):
-                writer.write_record(record)
+    writer.close()
 
-        writer.close()
+    reader.close()
 
 
 def run_pileup2snp(in_file, out_file):
@@ -5,6 +5,7 @@ import pypeliner
 
 import biowrappers.components.io.hdf5.tasks as hdf5_tasks
 from biowrappers.components.utils import make_parent_directory
+from biowrappers.components.utils import merge_ctx
 
 import biowrappers.components.breakpoint_calling.destruct as destruct
 import biowrappers.components.breakpoint_calling.delly as delly
@@ -86,12 +87,15 @@ def call_and_annotate_pipeline(
 
     workflow.transform(
         name='merge_results',
-        ctx={'mem': 8},
+        ctx=merge_ctx,
         func=hdf5_tasks.merge_hdf5,
         args=(
             merge_inputs,
             pypeliner.managed.OutputFile(results_file),
-        )
+        ),
+        kwargs={
+            'num_workers': merge_ctx['ncpus'],
+        }
     )
 
     return workflow
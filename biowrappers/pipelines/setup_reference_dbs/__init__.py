@@ -39,6 +39,20 @@ def create_setup_reference_dbs_workflow(config):
             )
         )
 
+    # The index directory is replaced by a rename once complete. It is not a managed output, since pypeliner can not
+    # rename a rebuilt directory over an existing one, so the task runs every time and skips indexes which are current.
+    for db_name in ('cosmic', 'dbsnp'):
+        if (db_name in config) and ('position_index_path' in config[db_name]):
+            workflow.transform(
+                name='{0}_position_index'.format(db_name),
+                ctx={'mem': 16},
+                func='biowrappers.components.variant_calling.annotated_db_status.tasks.build_db_position_index',
+                args=(
+                    pypeliner.managed.InputFile(config[db_name]['local_path']),
+                    config[db_name]['position_index_path'],
+                )
+            )
+
     if 'mappability' in config:
         workflow.subworkflow(
             name='mappability',
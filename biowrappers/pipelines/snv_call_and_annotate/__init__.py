@@ -4,12 +4,15 @@ import os
 import pypeliner
 
 from biowrappers.components.utils import make_parent_directory
+from biowrappers.components.utils import merge_ctx
 from biowrappers.components.variant_calling.utils import default_chromosomes
 
 default_ctx = {'mem': 4, 'num_retry': 3, 'mem_retry_increment': 2}
 
 big_mem_ctx = {'mem': 8, 'num_retry': 3, 'mem_retry_increment': 2}
 
+big_mem_merge_ctx = dict(big_mem_ctx, **merge_ctx)
+
 
 def call_and_annotate_pipeline(
         config,
@@ -142,21 +145,16 @@ def call_and_annotate_pipeline(
     #===================================================================================================================
     workflow.transform(
         name='merge_indels',
-        ctx=big_mem_ctx,
-        func='biowrappers.components.io.vcf.tasks.vcf_tasks.merge_vcfs',
+        ctx=big_mem_merge_ctx,
+        func="biowrappers.components.io.vcf.tasks.merge_vcfs",
         args=(
             [x.as_input() for x in variant_files['indel']['vcf'].values()],
-            pypeliner.managed.TempOutputFile('all.indel.vcf')
-        )
-    )
-
-    workflow.transform(
-        name='finalise_indels',
-        func="biowrappers.components.io.vcf.tasks.finalise_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('all.indel.vcf'),
-            pypeliner.managed.TempOutputFile('all.indel.vcf.gz')
-        )
+            pypeliner.managed.TempOutputFile('all.indel.vcf.gz', extensions=['.tbi', '.csi'])
+        ),
+        kwargs={
+            'compress': True,
+            'num_workers': big_mem_merge_ctx['ncpus'],
+        }
     )
 
     workflow.subworkflow(
@@ -165,7 +163,7 @@ def call_and_annotate_pipeline(
         func=create_annotation_workflow,
         args=(
             config,
-            pypeliner.managed.TempInputFile('all.indel.vcf.gz'),
+            pypeliner.managed.TempInputFile('all.indel.vcf.gz', extensions=['.tbi', '.csi']),
             pypeliner.managed.TempOutputFile('indel_annotations.h5'),
             os.path.join(raw_data_dir, 'indel'),
         ),
@@ -179,21 +177,16 @@ def call_and_annotate_pipeline(
     #===================================================================================================================
     workflow.transform(
         name='merge_snvs',
-        ctx=big_mem_ctx,
+        ctx=big_mem_merge_ctx,
         func="biowrappers.components.io.vcf.tasks.merge_vcfs",
         args=(
             [x.as_input() for x in variant_files['snv']['vcf'].values()],
-            pypeliner.managed.TempOutputFile('all.snv.vcf')
-        )
-    )
-
-    workflow.transform(
-        name='finalise_snvs',
-        func="biowrappers.components.io.vcf.tasks.finalise_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('all.snv.vcf'),
-            pypeliner.managed.TempOutputFile('all.snv.vcf.gz')
-        )
+            pypeliner.managed.TempOutputFile('all.snv.vcf.gz', extensions=['.tbi', '.csi'])
+        ),
+        kwargs={
+            'compress': True,
+            'num_workers': big_mem_merge_ctx['ncpus'],
+        }
     )
 
     workflow.subworkflow(
@@ -202,7 +195,7 @@ def call_and_annotate_pipeline(
         func=create_annotation_workflow,
         args=(
             config,
-            pypeliner.managed.TempInputFile('all.snv.vcf.gz'),
+            pypeliner.managed.TempInputFile('all.snv.vcf.gz', extensions=['.tbi', '.csi']),
             pypeliner.managed.TempOutputFile('snv_annotations.h5'),
             os.path.join(raw_data_dir, 'snv'),
         ),
@@ -216,7 +209,7 @@ def call_and_annotate_pipeline(
         func='biowrappers.components.variant_calling.snv_allele_counts.create_snv_allele_counts_for_vcf_targets_workflow',
         args=(
             normal_bam_file.as_input(),
-            pypeliner.managed.TempInputFile('all.snv.vcf.gz'),
+            pypeliner.managed.TempInputFile('all.snv.vcf.gz', extensions=['.tbi', '.csi']),
             pypeliner.managed.OutputFile(os.path.join(raw_data_dir, 'snv', 'counts', 'normal.h5')),
         ),
         kwargs=get_kwargs(config['snv_counts']['kwargs'], '/snv/counts/normal')
@@ -228,7 +221,7 @@ def call_and_annotate_pipeline(
         func='biowrappers.components.variant_calling.snv_allele_counts.create_snv_allele_counts_for_vcf_targets_workflow',
         args=(
             tumour_bam_files.as_input(),
-            pypeliner.managed.TempInputFile('all.snv.vcf.gz'),
+            pypeliner.managed.TempInputFile('all.snv.vcf.gz', extensions=['.tbi', '.csi']),
             pypeliner.managed.OutputFile(
                 os.path.join(raw_data_dir, 'snv', 'counts', '{tumour_sample_id}.h5'), 'tumour_sample_id')
         ),
@@ -255,7 +248,7 @@ def call_and_annotate_pipeline(
 
     workflow.transform(
         name='build_results_file',
-        ctx=default_ctx,
+        ctx=big_mem_merge_ctx,
         func='biowrappers.components.io.hdf5.tasks.concatenate_tables',
         args=(
             tables,
@@ -263,6 +256,7 @@ def call_and_annotate_pipeline(
         ),
         kwargs={
             'drop_duplicates': True,
+            'num_workers': big_mem_merge_ctx['ncpus'],
         }
     )
 
@@ -310,10 +304,10 @@ def create_annotation_workflow(
         ctx=dict(mem=4, mem_retry_increment=2, **docker_config),
         args=(
             config['databases']['cosmic']['local_path'],
-            pypeliner.managed.InputFile(in_vcf_file),
+            pypeliner.managed.InputFile(in_vcf_file, extensions=['.tbi']),
             result_files['cosmic_status'].as_output(),
         ),
-        kwargs=config["cosmic_status"]['kwargs']
+        kwargs=get_db_annotation_kwargs(config, 'cosmic', 'cosmic_status')
     )
 
     workflow.subworkflow(
@@ -322,10 +316,10 @@ def create_annotation_workflow(
         ctx=dict(mem=4, mem_retry_increment=2, **docker_config),
         args=(
             config['databases']['dbsnp']['local_path'],
-            pypeliner.managed.InputFile(in_vcf_file),
+            pypeliner.managed.InputFile(in_vcf_file, extensions=['.tbi']),
             result_files['dbsnp_status'].as_output(),
         ),
-        kwargs=config["dbsnp_status"]['kwargs']
+        kwargs=get_db_annotation_kwargs(config, 'dbsnp', 'dbsnp_status')
     )
 
     workflow.subworkflow(
@@ -360,7 +354,7 @@ def create_annotation_workflow(
         ctx=dict(mem=4, mem_retry_increment=2, **docker_config),
         args=(
             config['databases']['ref_genome']['local_path'],
-            pypeliner.managed.InputFile(in_vcf_file),
+            pypeliner.managed.InputFile(in_vcf_file, extensions=['.tbi']),
             result_files['tri_nucleotide_context'].as_output(),
         ),
         kwargs=config["tri_nucleotide_context"]['kwargs']
@@ -461,16 +455,25 @@ def get_kwargs(config, table_name):
     return config
 
 
+def get_db_annotation_kwargs(config, db_name, annotator):
+    kwargs = config[annotator]['kwargs'].copy()
+
+    if 'position_index_path' in config['databases'][db_name]:
+        kwargs.setdefault('db_index_dir', config['databases'][db_name]['position_index_path'])
+
+    return kwargs
+
+
 def nuseq_callback(record):
-    return record.INFO['PS']
+    return record.info['PS']
 
 
 def strelka_indel_callback(record):
-    return record.INFO['QSI']
+    return record.info['QSI']
 
 
 def strelka_snv_callback(record):
-    return record.INFO['QSS']
+    return record.info['QSS']
 
 vcf_score_callbacks = {
     'indel': {
@@ -0,0 +1,110 @@
+'''
+Micro-benchmark of the bulk allele counting read filter against the previous per-read callback.
+
+Reads for the region are loaded once and then filtered repeatedly by each method. The end to end comparison runs
+pysam's count_coverage with the callback against the vectorised pileup over the same region.
+'''
+import pysam
+import timeit
+
+import numpy as np
+
+from biowrappers.components.variant_calling.snv_allele_counts._pileup import count_reads, filter_reads
+
+
+def check_read(read, count_duplicates=False, min_mqual=30, strand='both'):
+    '''
+    Per-read callback previously passed to count_coverage.
+    '''
+    valid = True
+
+    if read.mapping_quality < min_mqual:
+        valid = False
+
+    elif read.is_duplicate and (not count_duplicates):
+        valid = False
+
+    elif read.is_unmapped:
+        valid = False
+
+    elif read.is_qcfail:
+        valid = False
+
+    elif read.is_secondary:
+        valid = False
+
+    elif (strand == 'reverse') and (not read.is_reverse):
+        valid = False
+
+    elif (strand == 'forward') and (read.is_reverse):
+        valid = False
+
+    return valid
+
+
+def main(args):
+    chrom, coords = args.region.split(':')
+
+    beg, end = [int(x) for x in coords.split('-')]
+
+    bam = pysam.AlignmentFile(args.bam_file, 'rb')
+
+    reads = list(bam.fetch(chrom, beg - 1, end - 1))
+
+    kwargs = {'count_duplicates': args.count_duplicates, 'min_mqual': args.min_mqual, 'strand': args.strand}
+
+    callback = lambda x: check_read(x, **kwargs)
+
+    # Both filters must keep exactly the same reads
+    assert [x for x in reads if callback(x)] == filter_reads(reads, **kwargs)
+
+    print('Filtering {0} reads, best of {1} repeats'.format(len(reads), args.repeats))
+
+    report('callback', lambda: [x for x in reads if callback(x)], args.repeats)
+
+    report('bulk', lambda: filter_reads(reads, **kwargs), args.repeats)
+
+    print('Counting {0}'.format(args.region))
+
+    report(
+        'count_coverage',
+        lambda: bam.count_coverage(
+            chrom, beg - 1, end - 1, quality_threshold=args.min_bqual, read_callback=callback),
+        args.repeats
+    )
+
+    report(
+        'count_reads',
+        lambda: count_reads(
+            bam.fetch(chrom, beg - 1, end - 1), np.arange(beg - 1, end - 1), min_bqual=args.min_bqual, **kwargs),
+        args.repeats
+    )
+
+
+def report(name, func, repeats):
+    best = min(timeit.repeat(func, number=1, repeat=repeats))
+
+    print('{0:>16}: {1:.4f}s'.format(name, best))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bam_file', required=True)
+
+    parser.add_argument('--region', required=True)
+
+    parser.add_argument('--count_duplicates', default=False, action='store_true')
+
+    parser.add_argument('--min_bqual', default=0, type=int)
+
+    parser.add_argument('--min_mqual', default=0, type=int)
+
+    parser.add_argument('--strand', default='both', choices=['both', 'forward', 'reverse'])
+
+    parser.add_argument('--repeats', default=5, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,82 @@
+'''
+Throughput benchmark of the pysam VCF access layer against PyVCF.
+
+Each access pattern is timed over a full pass of the file: site fields only (CHROM/POS/FILTER, as used by the filters
+and annotators), one INFO field and every sample field. Throughput is reported in records per second.
+'''
+import timeit
+import vcf
+
+import biowrappers.components.io.vcf.access as access
+
+
+def pyvcf_sites(file_name):
+    for record in vcf.Reader(filename=file_name):
+        record.CHROM, record.POS, record.FILTER
+
+
+def pyvcf_info(file_name, info_field):
+    for record in vcf.Reader(filename=file_name):
+        record.INFO.get(info_field)
+
+
+def pyvcf_samples(file_name):
+    for record in vcf.Reader(filename=file_name):
+        for call in record.samples:
+            call.data
+
+
+def access_sites(file_name):
+    for record in access.open_reader(file_name, drop_samples=True):
+        record.chrom, record.pos, access.get_filters(record)
+
+
+def access_info(file_name, info_field):
+    for record in access.open_reader(file_name, drop_samples=True):
+        record.info.get(info_field)
+
+
+def access_samples(file_name):
+    for record in access.open_reader(file_name):
+        for sample in record.samples.values():
+            dict(sample)
+
+
+def main(args):
+    num_records = sum(1 for _ in access.open_reader(args.vcf_file, drop_samples=True))
+
+    print('Reading {0} records, best of {1} repeats'.format(num_records, args.repeats))
+
+    report('pyvcf sites', lambda: pyvcf_sites(args.vcf_file), num_records, args.repeats)
+
+    report('access sites', lambda: access_sites(args.vcf_file), num_records, args.repeats)
+
+    if args.info_field is not None:
+        report('pyvcf info', lambda: pyvcf_info(args.vcf_file, args.info_field), num_records, args.repeats)
+
+        report('access info', lambda: access_info(args.vcf_file, args.info_field), num_records, args.repeats)
+
+    report('pyvcf samples', lambda: pyvcf_samples(args.vcf_file), num_records, args.repeats)
+
+    report('access samples', lambda: access_samples(args.vcf_file), num_records, args.repeats)
+
+
+def report(name, func, num_records, repeats):
+    best = min(timeit.repeat(func, number=1, repeat=repeats))
+
+    print('{0:>16}: {1:.4f}s {2:>12.0f} records/s'.format(name, best, num_records / best))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--vcf_file', required=True)
+
+    parser.add_argument('--info_field', default=None)
+
+    parser.add_argument('--repeats', default=3, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+'''
+Check the batched mappability window means against per record bigWig queries on a small bigWig fixture. The window
+means are tested directly, so the test does not need single_cell for the CSV output.
+'''
+import numpy as np
+import pytest
+
+pyBigWig = pytest.importorskip('pyBigWig')
+
+pytest.importorskip('bx.bbi.bigwig_file')
+
+from bx.bbi.bigwig_file import BigWigFile
+
+import biowrappers.components.variant_calling.mappability.tasks as tasks
+
+chrom_lengths = [('chr1', 100000), ('chr2', 20000)]
+
+
+@pytest.fixture
+def bigwig_file(tmpdir):
+    file_name = str(tmpdir.join('map.bw'))
+
+    random_state = np.random.RandomState(0)
+
+    writer = pyBigWig.open(file_name, 'w')
+
+    writer.addHeader(chrom_lengths)
+
+    for chrom, length in chrom_lengths:
+        starts = []
+
+        ends = []
+
+        values = []
+
+        pos = 0
+
+        while pos < length:
+            # Leave a long region without data so some windows have no values
+            if 40000 <= pos < 45000:
+                pos = 45000
+
+                continue
+
+            if random_state.rand() < 0.2:
+                pos += random_state.randint(1, 300)
+
+                continue
+
+            end = min(pos + random_state.randint(1, 50), length)
+
+            starts.append(pos)
+
+            ends.append(end)
+
+            values.append(float(random_state.choice([0, 0.25, 0.333, 0.5, 1.0])))
+
+            pos = end
+
+        writer.addEntries([chrom] * len(starts), starts, ends=ends, values=values)
+
+    writer.close()
+
+    return file_name
+
+
+def _query_window_means(reader, chrom, coords, window_size):
+    means = []
+
+    for coord in coords:
+        result = reader.query(chrom, max(coord - window_size, 0), coord + window_size, 1)
+
+        if result is None:
+            means.append(0)
+
+        else:
+            means.append(result[0]['mean'])
+
+    return np.array(means, dtype=float)
+
+
+@pytest.mark.parametrize('max_block_size', [1000, int(1e6)])
+@pytest.mark.parametrize('chrom', ['chr1', 'chr2', 'chr3'])
+def test_window_means_match_query(bigwig_file, chrom, max_block_size):
+    reader = BigWigFile(open(bigwig_file, 'rb'))
+
+    random_state = np.random.RandomState(1)
+
+    coords = random_state.randint(1, 20000, size=500)
+
+    coords = np.concatenate([coords, [1, 50, 150, 42500, 42500, 44000]])
+
+    expected = _query_window_means(reader, chrom, coords, 100)
+
+    means = tasks._get_window_means(reader, chrom, coords, 100, max_block_size)
+
+    np.testing.assert_allclose(means, expected, rtol=1e-9, equal_nan=True)
@@ -0,0 +1,49 @@
+'''
+Check the vectorised pileup on reads built in memory.
+'''
+import numpy as np
+import pysam
+
+import biowrappers.components.variant_calling.snv_allele_counts._pileup as pileup
+
+
+def _make_read(name, seq, start, cigar, flag=0):
+    read = pysam.AlignedSegment()
+
+    read.query_name = name
+
+    read.query_sequence = seq
+
+    read.flag = flag
+
+    read.reference_id = 0
+
+    read.reference_start = start
+
+    read.mapping_quality = 60
+
+    if cigar is not None:
+        read.cigartuples = cigar
+
+    read.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+
+    return read
+
+
+def test_reads_without_cigar_are_skipped():
+    reads = [
+        _make_read('a', 'ACGT', 0, [(0, 4)]),
+        _make_read('b', 'AAAA', 0, None),
+        _make_read('c', 'ACGA', 0, [(0, 3), (4, 1)]),
+    ]
+
+    counts = pileup.count_reads(reads, np.arange(4), min_bqual=20, min_mqual=20)
+
+    expected = np.array([
+        [2, 0, 0, 0],
+        [0, 2, 0, 0],
+        [0, 0, 2, 0],
+        [0, 0, 0, 1],
+    ])
+
+    np.testing.assert_array_equal(counts, expected)
@@ -0,0 +1,299 @@
+'''
+Check the snpEff server protocol using `cat` in place of snpEff, which passes the header, records and chunk markers
+through unchanged.
+
+The protocol assumes snpEff writes out each record it reads from stdin, including the chunk marker, before it reads
+the next chunk, and that the marker is a valid record for the header of the chunk. Tests with stand ins which check
+the column count or only write at the end of their input document these assumptions.
+'''
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+import biowrappers.components.variant_calling.snpeff.server as server
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _write_vcf(file_name, contig, positions, samples=()):
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+
+    if len(samples) > 0:
+        columns += ['FORMAT'] + list(samples)
+
+    lines = [
+        '##fileformat=VCFv4.1\n',
+        '##contig=<ID={0}>\n'.format(contig),
+        '\t'.join(columns) + '\n',
+    ]
+
+    for pos in positions:
+        fields = [contig, str(pos), '.', 'A', 'C', '.', 'PASS', 'DP=10']
+
+        if len(samples) > 0:
+            fields += ['GT'] + ['0/1'] * len(samples)
+
+        lines.append('\t'.join(fields) + '\n')
+
+    with open(file_name, 'w') as fh:
+        fh.writelines(lines)
+
+    return ''.join(lines)
+
+
+def _read(file_name):
+    with open(file_name) as fh:
+        return fh.read()
+
+
+def test_worker_reuses_process_across_chunks(tmpdir):
+    worker = server.SnpEffWorker(['cat'])
+
+    try:
+        expected = []
+
+        for i, positions in enumerate([range(1, 1000), [5, 10]]):
+            in_file = str(tmpdir.join('in_{0}.vcf'.format(i)))
+
+            expected.append(_write_vcf(in_file, '1', positions))
+
+            worker.annotate(in_file, str(tmpdir.join('out_{0}.vcf'.format(i))))
+
+            if i == 0:
+                pid = worker._proc.pid
+
+        assert worker._proc.pid == pid
+
+        for i in range(2):
+            assert _read(str(tmpdir.join('out_{0}.vcf'.format(i)))) == expected[i]
+
+    finally:
+        worker.close()
+
+
+def test_worker_restarts_on_header_change(tmpdir):
+    worker = server.SnpEffWorker(['cat'])
+
+    try:
+        pids = []
+
+        for i, contig in enumerate(['1', '2', '2']):
+            in_file = str(tmpdir.join('in_{0}.vcf'.format(i)))
+
+            out_file = str(tmpdir.join('out_{0}.vcf'.format(i)))
+
+            expected = _write_vcf(in_file, contig, [i + 1, i + 100])
+
+            worker.annotate(in_file, out_file)
+
+            assert _read(out_file) == expected
+
+            pids.append(worker._proc.pid)
+
+        assert pids[0] != pids[1]
+
+        assert pids[1] == pids[2]
+
+    finally:
+        worker.close()
+
+
+def test_server_annotates_concurrent_requests(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', repo_dir)
+
+    # The socket address depends on the command, so make it unique to this test
+    cmd = ['sh', '-c', 'exec cat "$@"', str(tmpdir)]
+
+    expected = {}
+
+    errors = []
+
+    def run(i):
+        in_file = str(tmpdir.join('in_{0}.vcf'.format(i)))
+
+        out_file = str(tmpdir.join('out_{0}.vcf'.format(i)))
+
+        expected[out_file] = _write_vcf(in_file, str(i % 2), range(1, 100 * (i + 1)))
+
+        try:
+            server.annotate(cmd, in_file, out_file, idle_timeout=2, timeout=60)
+
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(6)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    for out_file, data in expected.items():
+        assert _read(out_file) == data
+
+
+def test_client_times_out(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', repo_dir)
+
+    cmd = ['sh', '-c', 'sleep 2; exec cat "$@"', str(tmpdir)]
+
+    in_file = str(tmpdir.join('in.vcf'))
+
+    out_file = str(tmpdir.join('out.vcf'))
+
+    _write_vcf(in_file, '1', [1, 2])
+
+    with pytest.raises(socket.timeout):
+        server.annotate(cmd, in_file, out_file, idle_timeout=1, timeout=0.5)
+
+    assert not os.path.exists(out_file)
+
+
+def test_worker_marker_matches_sample_columns(tmpdir):
+    # Fails on any record whose column count differs from the header, as a strict VCF parser would
+    script = (
+        'import sys\n'
+        'for line in iter(sys.stdin.readline, ""):\n'
+        '    if line.startswith("#CHROM"):\n'
+        '        num_columns = len(line.split("\\t"))\n'
+        '    elif (not line.startswith("#")) and (len(line.split("\\t")) != num_columns):\n'
+        '        sys.exit(1)\n'
+        '    sys.stdout.write(line)\n'
+        '    sys.stdout.flush()\n'
+    )
+
+    cmd = [sys.executable, '-c', script]
+
+    worker = server.SnpEffWorker(cmd)
+
+    try:
+        for i in range(2):
+            in_file = str(tmpdir.join('in_{0}.vcf'.format(i)))
+
+            out_file = str(tmpdir.join('out_{0}.vcf'.format(i)))
+
+            expected = _write_vcf(in_file, '1', [i + 1, i + 2], samples=['normal', 'tumour'])
+
+            worker.annotate(in_file, out_file, timeout=10)
+
+            assert _read(out_file) == expected
+
+    finally:
+        worker.close()
+
+
+def test_worker_times_out_without_marker(tmpdir):
+    # sort only writes once its input ends, so the marker never comes back while snpEff is running
+    worker = server.SnpEffWorker(['sort'])
+
+    in_file = str(tmpdir.join('in.vcf'))
+
+    _write_vcf(in_file, '1', [1, 2])
+
+    try:
+        with pytest.raises(Exception):
+            worker.annotate(in_file, str(tmpdir.join('out.vcf')), timeout=0.5)
+
+        assert worker._proc is None
+
+    finally:
+        worker.close()
+
+
+def _send_request(address, request):
+    sock = server._connect(address)
+
+    try:
+        sock.settimeout(10)
+
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with sock.makefile('rb') as fh:
+            return fh.readline()
+
+    finally:
+        sock.close()
+
+
+def test_server_rejects_other_output_files(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', repo_dir)
+
+    cmd = ['sh', '-c', 'exec cat "$@"', str(tmpdir)]
+
+    in_file = str(tmpdir.join('in.vcf'))
+
+    _write_vcf(in_file, '1', [1, 2])
+
+    # Start the server with a valid request
+    server.annotate(cmd, in_file, str(tmpdir.join('out.vcf')), idle_timeout=2, timeout=60)
+
+    out_files = [
+        str(tmpdir.join('other.vcf')),
+        str(tmpdir.join('other.vcf.1.tmp')),
+        'out.vcf.{0}.tmp'.format(os.getpid()),
+    ]
+
+    for out_file in out_files:
+        response = _send_request(server.get_address(cmd), {'in_file': in_file, 'out_file': out_file, 'timeout': 60})
+
+        assert json.loads(response.decode('utf-8'))['status'] == 'error'
+
+        assert not os.path.exists(out_file)
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason='connecting as another user requires root')
+def test_server_rejects_other_users(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', repo_dir)
+
+    cmd = ['sh', '-c', 'exec cat "$@"', str(tmpdir)]
+
+    in_file = str(tmpdir.join('in.vcf'))
+
+    _write_vcf(in_file, '1', [1, 2])
+
+    server.annotate(cmd, in_file, str(tmpdir.join('out.vcf')), idle_timeout=2, timeout=60)
+
+    # The address depends on the user, so use the address of this user's server
+    address = server.get_address(cmd)
+
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+
+    if pid == 0:
+        # Send a request which is otherwise valid as another user, and report the response
+        try:
+            os.setuid(65534)
+
+            out_file = str(tmpdir.join('out.vcf.{0}.tmp'.format(os.getpid())))
+
+            # The server closes the connection without reading the request, which may reset it
+            try:
+                response = _send_request(address, {'in_file': in_file, 'out_file': out_file, 'timeout': 10})
+
+            except socket.error:
+                response = b''
+
+            os.write(write_fd, json.dumps([out_file, response.decode('utf-8')]).encode('utf-8'))
+
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+
+    os.waitpid(pid, 0)
+
+    out_file, response = json.loads(os.read(read_fd, 4096).decode('utf-8'))
+
+    os.close(read_fd)
+
+    assert response == ''
+
+    assert not os.path.exists(out_file)